@@ -0,0 +1,266 @@
+"""
+Claudeセッションのメッセージ履歴の保存
+メッセージは書き込み待ちのバッファに積み、バックグラウンドのタスクがまとめて
+データベースに書き込む（write-behind）。履歴はIDをカーソルにしてページ単位で読み出す。
+"""
+
+import asyncio
+import logging
+import os
+from collections import deque
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import func
+from sqlalchemy.exc import DataError, IntegrityError
+
+from .database import SessionLocal
+from .models import ClaudeMessage
+
+logger = logging.getLogger(__name__)
+
+# メッセージ履歴をデータベースに保存するか
+CHAT_HISTORY_PERSIST = os.getenv("CHAT_HISTORY_PERSIST", "true").lower() == "true"
+# セッションごとにメモリに保持するメッセージ数
+CHAT_HISTORY_MEMORY_LIMIT = int(os.getenv("CHAT_HISTORY_MEMORY_LIMIT", "200"))
+# 書き込み待ちのメッセージをデータベースに書き込む間隔（秒）
+CHAT_HISTORY_FLUSH_INTERVAL = float(os.getenv("CHAT_HISTORY_FLUSH_INTERVAL", "1.0"))
+# この件数がたまったら間隔を待たずに書き込む
+CHAT_HISTORY_FLUSH_SIZE = int(os.getenv("CHAT_HISTORY_FLUSH_SIZE", "100"))
+# 書き込み待ちの上限（データベースに書き込めない間は古いものから破棄する）
+CHAT_HISTORY_PENDING_LIMIT = int(os.getenv("CHAT_HISTORY_PENDING_LIMIT", "10000"))
+# 1ページの最大件数
+CHAT_HISTORY_PAGE_LIMIT = 200
+
+class ChatHistoryStore:
+    """メッセージ履歴の書き込みバッファと読み出し"""
+
+    def __init__(
+        self,
+        session_factory: Callable = SessionLocal,
+        flush_interval: float = CHAT_HISTORY_FLUSH_INTERVAL,
+        flush_size: int = CHAT_HISTORY_FLUSH_SIZE,
+        pending_limit: int = CHAT_HISTORY_PENDING_LIMIT
+    ):
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._pending: deque = deque(maxlen=pending_limit)
+        # Event・Lock は作成時のイベントループに結び付くため、実行中のループで作り直す
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._write_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopped = False
+        self.written = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.failures = 0
+
+    def append(self, session_id: str, sender: str, content: str, timestamp: datetime):
+        """メッセージを書き込み待ちに追加（I/Oは行わない）"""
+        if len(self._pending) == self._pending.maxlen:
+            self.dropped += 1
+        self._pending.append({
+            "session_id": session_id,
+            "sender": sender,
+            "content": content,
+            "created_at": timestamp
+        })
+        self._ensure_writer()
+        if len(self._pending) >= self.flush_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    def _bind_loop(self, loop: asyncio.AbstractEventLoop):
+        """実行中のイベントループ用の Event・Lock を用意する"""
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._write_lock = asyncio.Lock()
+        self._task = None  # 以前のループのタスクはそのループとともに終了している
+
+    def _ensure_writer(self):
+        if self._stopped:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # イベントループ外では積むだけにし、次の呼び出しか start() で書き込みを始める
+        self._bind_loop(loop)
+        if self._task is None:
+            self._task = loop.create_task(self._writer())
+
+    def start(self):
+        """書き込みタスクを開始"""
+        self._stopped = False
+        self._ensure_writer()
+
+    async def stop(self):
+        """書き込みタスクを止め、残りを書き込む"""
+        self._stopped = True
+        self._bind_loop(asyncio.get_running_loop())
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _writer(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> bool:
+        """書き込み待ちのメッセージをまとめて書き込む
+
+        接続エラーなどで失敗した場合は次回に再試行する。データ自体が不正で
+        まとめて書き込めない場合は1件ずつ書き込み、書き込めないメッセージだけを破棄する。
+        """
+        self._bind_loop(asyncio.get_running_loop())
+        loop = asyncio.get_running_loop()
+        async with self._write_lock:
+            if not self._pending:
+                return True
+            batch = list(self._pending)
+            self._pending.clear()
+            try:
+                await loop.run_in_executor(None, self._write_batch, batch)
+            except (DataError, IntegrityError) as e:
+                logger.warning(f"メッセージ履歴をまとめて書き込めないため1件ずつ書き込みます（{len(batch)}件）: {e}")
+                remaining = await loop.run_in_executor(None, self._write_rows, batch)
+                if remaining:
+                    self.failures += 1
+                    self._requeue(remaining)
+                    return False
+                return True
+            except Exception as e:
+                self.failures += 1
+                logger.warning(f"メッセージ履歴の書き込みに失敗しました（{len(batch)}件）: {e}")
+                self._requeue(batch)
+                return False
+            self.written += len(batch)
+            return True
+
+    def _requeue(self, rows: List[Dict]):
+        """書き込めなかったメッセージを書き込み中に追加された分の前に戻す（上限を超えた分は古いものから破棄）"""
+        added = list(self._pending)
+        self._pending.clear()
+        self.dropped += max(0, len(rows) + len(added) - self._pending.maxlen)
+        self._pending.extend(rows)
+        self._pending.extend(added)
+
+    def _write_batch(self, batch: List[Dict]):
+        db = self.session_factory()
+        try:
+            db.bulk_insert_mappings(ClaudeMessage, batch)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _write_rows(self, batch: List[Dict]) -> List[Dict]:
+        """1件ずつ書き込み、再試行が必要な残りを返す（スレッドプール上で実行）
+
+        不正なメッセージ（DataError・IntegrityError）は破棄する。
+        それ以外のエラーではそのメッセージ以降を再試行に回す。
+        """
+        db = self.session_factory()
+        try:
+            for index, row in enumerate(batch):
+                try:
+                    db.bulk_insert_mappings(ClaudeMessage, [row])
+                    db.commit()
+                    self.written += 1
+                except (DataError, IntegrityError) as e:
+                    db.rollback()
+                    self.rejected += 1
+                    logger.error(f"不正なメッセージ履歴を破棄しました: session_id={row.get('session_id')}, {e}")
+                except Exception as e:
+                    db.rollback()
+                    logger.warning(f"メッセージ履歴の書き込みに失敗しました（{len(batch) - index}件）: {e}")
+                    return batch[index:]
+            return []
+        finally:
+            db.close()
+
+    async def get_page(
+        self,
+        session_id: str,
+        before: Optional[int] = None,
+        after: Optional[int] = None,
+        limit: int = 50
+    ) -> Dict:
+        """メッセージ履歴を1ページ取得
+
+        before を指定するとそのIDより古いメッセージのうち新しい順に limit 件、
+        after を指定するとそのIDより新しいメッセージを古い順に limit 件返す
+        （どちらもなければ最新の limit 件）。messages は常に古い順。
+        total（セッションの全件数）は最初のページでのみ数え、カーソル指定時は None。
+        """
+        await self.flush()
+        limit = max(1, min(limit, CHAT_HISTORY_PAGE_LIMIT))
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._read_page, session_id, before, after, limit
+        )
+
+    def _read_page(self, session_id: str, before: Optional[int], after: Optional[int], limit: int) -> Dict:
+        db = self.session_factory()
+        try:
+            query = db.query(ClaudeMessage).filter(ClaudeMessage.session_id == session_id)
+            if after is not None:
+                rows = query.filter(ClaudeMessage.id > after).order_by(ClaudeMessage.id.asc()).limit(limit + 1).all()
+                has_more = len(rows) > limit
+                rows = rows[:limit]
+            else:
+                if before is not None:
+                    query = query.filter(ClaudeMessage.id < before)
+                rows = query.order_by(ClaudeMessage.id.desc()).limit(limit + 1).all()
+                has_more = len(rows) > limit
+                rows = list(reversed(rows[:limit]))
+            total = None
+            if before is None and after is None:
+                total = db.query(func.count(ClaudeMessage.id)).filter(ClaudeMessage.session_id == session_id).scalar()
+
+            messages = [
+                {
+                    "id": row.id,
+                    "sender": row.sender,
+                    "content": row.content,
+                    "timestamp": row.created_at.isoformat()
+                }
+                for row in rows
+            ]
+            if after is not None:
+                next_cursor = messages[-1]["id"] if has_more and messages else None
+            else:
+                next_cursor = messages[0]["id"] if has_more and messages else None
+            return {
+                "messages": messages,
+                "total": total,
+                "has_more": has_more,
+                "next_cursor": next_cursor
+            }
+        finally:
+            db.close()
+
+    def get_stats(self) -> Dict:
+        return {
+            "pending": len(self._pending),
+            "written": self.written,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "failures": self.failures
+        }
+
+# グローバルインスタンス
+chat_history = ChatHistoryStore()
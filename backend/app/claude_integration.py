@@ -5,42 +5,387 @@ Claude Code SDK/CLIを使用してブラウザベースでClaude開発セッシ
 """
 
 import asyncio
+import codecs
+import importlib
+import importlib.util
 import json
 import logging
 import os
-import subprocess
+import shutil
+import signal
+import time
+from collections import deque
 from pathlib import Path
 from typing import Dict, List, Optional, AsyncGenerator
 from datetime import datetime
 
-# Claude Code SDKの利用可能性をチェック
-try:
-    from claude_code_sdk import query, ClaudeCodeOptions
-    SDK_AVAILABLE = True
-    logging.info("Claude Code SDK found and loaded")
-except ImportError:
-    SDK_AVAILABLE = False
-    logging.warning("Claude Code SDK not available")
+from .chat_history import CHAT_HISTORY_MEMORY_LIMIT, CHAT_HISTORY_PERSIST, chat_history
+from .claude_scheduler import PositionCallback, SchedulerFullError, claude_scheduler
 
-# Claude Code CLIの利用可能性をチェック
-try:
-    result = subprocess.run(['which', 'claude'], capture_output=True, text=True)
-    CLI_AVAILABLE = result.returncode == 0
-    if CLI_AVAILABLE:
-        # バージョン確認
-        version_result = subprocess.run(['claude', '--version'], capture_output=True, text=True)
-        logging.info(f"Claude Code CLI found: {version_result.stdout.strip()}")
-    else:
-        logging.warning("Claude Code CLI not found in PATH")
-except Exception as e:
-    CLI_AVAILABLE = False
-    logging.warning(f"Claude Code CLI check failed: {e}")
+logger = logging.getLogger(__name__)
 
-# 使用する方法を決定（SDK優先）
-USE_SDK = SDK_AVAILABLE
-USE_CLI = CLI_AVAILABLE and not SDK_AVAILABLE
+# Claude Code SDKがインストールされているか（インポートはしない）。
+# 実行時にどの方法を使うかは claude_capabilities で判定する
+SDK_AVAILABLE = importlib.util.find_spec("claude_code_sdk") is not None
 
-logger = logging.getLogger(__name__)
+# Claude Code SDK/CLIの利用可否を確認し直す間隔（秒）
+CLAUDE_PROBE_TTL = float(os.getenv("CLAUDE_PROBE_TTL", "300"))
+# claude --version の応答を待つ上限（秒）
+CLAUDE_PROBE_TIMEOUT = float(os.getenv("CLAUDE_PROBE_TIMEOUT", "10"))
+
+# CLIをセッションごとに常駐させるか（false の場合はメッセージごとに claude --print を起動する）
+CLAUDE_CLI_PERSISTENT = os.getenv("CLAUDE_CLI_PERSISTENT", "true").lower() == "true"
+# 常駐CLIが応答の途中で終了した場合に、起動し直して再送する回数
+CLAUDE_CLI_RESTART_ATTEMPTS = int(os.getenv("CLAUDE_CLI_RESTART_ATTEMPTS", "1"))
+# 常駐CLIの停止時に、標準入力を閉じてから強制終了するまでの秒数
+CLAUDE_CLI_STOP_TIMEOUT = float(os.getenv("CLAUDE_CLI_STOP_TIMEOUT", "3"))
+# stream-json の1行の上限（ツールの結果を含むため大きめにする）
+CLI_LINE_LIMIT = 16 * 1024 * 1024
+# エラー表示用に保持する stderr の行数
+CLI_STDERR_LINES = 50
+# 1回ごとに起動するCLIの標準出力を読み取る最大サイズ（届いた分だけすぐ返す）
+CLI_READ_SIZE = 4096
+
+class CLIWorkerError(Exception):
+    """CLIの実行エラー（output にはエラーの分類に使う出力を保持する）"""
+    
+    def __init__(self, message: str, output: str = ""):
+        super().__init__(message)
+        self.output = output or message
+
+class CLIResultError(CLIWorkerError):
+    """CLIは動作しているが、応答がエラーで終わった（APIエラーなど）"""
+
+def describe_cli_error(output: str) -> str:
+    """CLIのエラー出力を利用者向けのメッセージに変換"""
+    if "Credit balance is too low" in output:
+        return "Claude API クレジット残高が不足しています。Anthropic Console でクレジットを追加してください。"
+    if "api key" in output.lower():
+        return "Claude API キーが無効または未設定です。ANTHROPIC_API_KEY 環境変数を確認してください。"
+    if "rate limit" in output.lower():
+        return "Claude API のレート制限に達しました。しばらく待ってから再試行してください。"
+    return f"Claude Code CLI エラー: {output}"
+
+class ClaudeCLIWorker:
+    """セッションごとに常駐する Claude Code CLI
+    
+    claude --print を stream-json の入出力で起動し、標準入力に1行1メッセージの
+    JSONを書き込み、標準出力のイベントを読みながら応答のテキストを返す。
+    プロセスは複数のメッセージで使い回すため、起動の時間がかからず会話も引き継がれる。
+    プロセスが終了していた場合は次のメッセージで --resume を付けて起動し直す。
+    """
+    
+    def __init__(
+        self,
+        working_directory: Path,
+        env: Dict[str, str],
+        system_prompt: Optional[str] = None,
+        command: str = "claude"
+    ):
+        self.working_directory = working_directory
+        self.env = env
+        self.system_prompt = system_prompt
+        self.command = command
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.cli_session_id: Optional[str] = None  # --resume に使うCLI側のセッションID
+        self.restarts = 0
+        self._stderr: deque = deque(maxlen=CLI_STDERR_LINES)
+        self._stderr_task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+    
+    @property
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+    
+    @property
+    def stderr_output(self) -> str:
+        return "\n".join(self._stderr)
+    
+    def _build_command(self) -> List[str]:
+        cmd = [
+            self.command, "--print",
+            "--input-format", "stream-json",
+            "--output-format", "stream-json",
+            "--verbose", "--include-partial-messages"
+        ]
+        if self.system_prompt:
+            cmd += ["--append-system-prompt", self.system_prompt]
+        if self.cli_session_id:
+            cmd += ["--resume", self.cli_session_id]
+        return cmd
+    
+    async def start(self):
+        """CLIを起動"""
+        self._stderr.clear()
+        self.process = await asyncio.create_subprocess_exec(
+            *self._build_command(),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=str(self.working_directory),
+            env=self.env,
+            limit=CLI_LINE_LIMIT,
+            start_new_session=True  # ツールが起動した子プロセスもまとめて終了できるようにする
+        )
+        self._stderr_task = asyncio.create_task(self._drain_stderr(self.process))
+        logger.info(f"Claude Code CLI worker started: pid={self.process.pid}")
+    
+    async def _drain_stderr(self, process: asyncio.subprocess.Process):
+        """stderr を読み続ける（パイプが詰まってCLIが止まらないようにする）"""
+        while True:
+            line = await process.stderr.readline()
+            if not line:
+                break
+            self._stderr.append(line.decode("utf-8", errors="replace").rstrip())
+    
+    async def stop(self, timeout: float = CLAUDE_CLI_STOP_TIMEOUT):
+        """CLIを終了（標準入力を閉じ、終了しなければプロセスグループごと終了する）"""
+        process, self.process = self.process, None
+        if process is None:
+            return
+        if process.returncode is None:
+            try:
+                process.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            try:
+                await asyncio.wait_for(process.wait(), timeout)
+            except asyncio.TimeoutError:
+                for sig in (signal.SIGTERM, signal.SIGKILL):
+                    try:
+                        os.killpg(process.pid, sig)
+                    except ProcessLookupError:
+                        break
+                    try:
+                        await asyncio.wait_for(process.wait(), timeout)
+                        break
+                    except asyncio.TimeoutError:
+                        continue
+        if self._stderr_task:
+            self._stderr_task.cancel()
+            self._stderr_task = None
+    
+    async def _kill(self):
+        """応答の途中で中止された場合の終了（残りの出力が次の応答に混ざらないようにする）"""
+        if self.is_alive:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await self.process.wait()
+        await self.stop()
+    
+    async def send(self, message: str) -> AsyncGenerator[str, None]:
+        """メッセージを送信し、応答のテキストを届いた順に返す
+        
+        何も返さないうちにCLIが終了した場合は、起動し直して再送する。
+        応答の途中で終了した場合は CLIWorkerError を送出し、次のメッセージで起動し直す。
+        """
+        async with self._lock:
+            attempt = 0
+            while True:
+                if not self.is_alive:
+                    await self.start()
+                produced = False
+                try:
+                    async for chunk in self._turn(message):
+                        produced = True
+                        yield chunk
+                    return
+                except CLIResultError:
+                    raise
+                except CLIWorkerError as e:
+                    await self.stop(timeout=0)
+                    if produced or attempt >= CLAUDE_CLI_RESTART_ATTEMPTS:
+                        raise
+                    attempt += 1
+                    self.restarts += 1
+                    logger.warning(f"Claude Code CLI worker exited, restarting: {e}")
+                except BaseException:
+                    await self._kill()
+                    raise
+    
+    async def _turn(self, message: str) -> AsyncGenerator[str, None]:
+        """1メッセージ分のやり取り（result イベントで終わる）"""
+        payload = {
+            "type": "user",
+            "message": {"role": "user", "content": [{"type": "text", "text": message}]}
+        }
+        process = self.process
+        try:
+            process.stdin.write((json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8"))
+            await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError) as e:
+            raise CLIWorkerError(f"Claude Code CLIへの書き込みに失敗しました: {e}", self.stderr_output)
+        
+        streamed = False  # 現在のメッセージのテキストを差分で受け取ったか
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                returncode = await process.wait()
+                raise CLIWorkerError(
+                    f"Claude Code CLIが終了しました（終了コード: {returncode}）", self.stderr_output
+                )
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                logger.debug(f"Unexpected CLI output: {line[:200]!r}")
+                continue
+            
+            event_type = event.get("type")
+            if event.get("session_id"):
+                self.cli_session_id = event["session_id"]
+            
+            if event_type == "stream_event":
+                stream_event = event.get("event", {})
+                if stream_event.get("type") == "message_start":
+                    streamed = False
+                delta = stream_event.get("delta", {})
+                if delta.get("type") == "text_delta" and delta.get("text"):
+                    streamed = True
+                    yield delta["text"]
+            elif event_type == "assistant" and not streamed:
+                # 差分が届かなかった場合（古いCLIなど）はメッセージ全体を返す
+                for block in event.get("message", {}).get("content", []):
+                    if block.get("type") == "text" and block.get("text"):
+                        yield block["text"]
+            elif event_type == "result":
+                if event.get("is_error"):
+                    raise CLIResultError(str(event.get("result") or event.get("subtype") or "error"))
+                return
+
+class ClaudeCapabilities:
+    """Claude Code SDK/CLIの利用可否"""
+    
+    def __init__(
+        self,
+        sdk_available: bool = False,
+        cli_available: bool = False,
+        cli_version: Optional[str] = None,
+        checked_at: Optional[datetime] = None
+    ):
+        self.sdk_available = sdk_available
+        self.cli_available = cli_available
+        self.cli_version = cli_version
+        self.checked_at = checked_at
+    
+    @property
+    def use_sdk(self) -> bool:
+        # SDK優先
+        return self.sdk_available
+    
+    @property
+    def use_cli(self) -> bool:
+        return self.cli_available and not self.sdk_available
+    
+    @property
+    def mode(self) -> str:
+        if self.use_sdk:
+            return "sdk"
+        return "cli" if self.use_cli else "mock"
+    
+    def to_dict(self) -> Dict[str, any]:
+        return {
+            "mode": self.mode,
+            "sdk_available": self.sdk_available,
+            "cli_available": self.cli_available,
+            "cli_version": self.cli_version,
+            "checked_at": self.checked_at.isoformat() if self.checked_at else None
+        }
+
+class CapabilityProbe:
+    """Claude Code SDK/CLIの利用可否を非同期に確認してキャッシュする
+    
+    最初に必要になったとき（または起動時にバックグラウンドで）確認し、
+    ttl 秒が過ぎると次の利用時に確認し直す。確認中に呼ばれた場合は
+    同じ確認の完了を待つ。
+    """
+    
+    def __init__(self, ttl: float = CLAUDE_PROBE_TTL, timeout: float = CLAUDE_PROBE_TIMEOUT, command: str = "claude"):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.command = command
+        self._capabilities: Optional[ClaudeCapabilities] = None
+        self._expires_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+    
+    @property
+    def cached(self) -> Optional[ClaudeCapabilities]:
+        """最後の確認結果（未確認なら None）"""
+        return self._capabilities
+    
+    async def get(self) -> ClaudeCapabilities:
+        """利用可否を取得（期限切れなら確認し直す）"""
+        if self._capabilities is not None and time.monotonic() < self._expires_at:
+            return self._capabilities
+        return await self.refresh()
+    
+    async def refresh(self) -> ClaudeCapabilities:
+        """期限に関係なく確認し直す"""
+        self.start()
+        # 呼び出し元が中止されても、他の待機者のために確認は続ける
+        return await asyncio.shield(self._task)
+    
+    def start(self):
+        """確認をバックグラウンドで開始（確認中なら何もしない）"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._probe())
+    
+    async def _probe(self) -> ClaudeCapabilities:
+        loop = asyncio.get_running_loop()
+        sdk_available = await loop.run_in_executor(None, self._load_sdk)
+        
+        cli_available = False
+        cli_version = None
+        cli_path = shutil.which(self.command)
+        if cli_path:
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    cli_path, "--version",
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    start_new_session=True
+                )
+                try:
+                    stdout, _ = await asyncio.wait_for(process.communicate(), self.timeout)
+                except asyncio.TimeoutError:
+                    # 子プロセスがパイプを開いたまま残らないようグループごと終了する
+                    try:
+                        os.killpg(process.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                    await process.wait()
+                    raise
+                cli_available = process.returncode == 0
+                cli_version = stdout.decode("utf-8", errors="replace").strip() or None
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.warning(f"Claude Code CLI check failed: {e!r}")
+        
+        capabilities = ClaudeCapabilities(sdk_available, cli_available, cli_version, datetime.now())
+        previous = self._capabilities
+        if previous is None or previous.mode != capabilities.mode:
+            logger.info(
+                f"Claude Code mode: {capabilities.mode} "
+                f"(SDK: {sdk_available}, CLI: {cli_version if cli_available else 'not found'})"
+            )
+        self._capabilities = capabilities
+        self._expires_at = time.monotonic() + self.ttl
+        return capabilities
+    
+    @staticmethod
+    def _load_sdk() -> bool:
+        """SDKをインポートできるか（インポートしたモジュールはそのまま使う）"""
+        try:
+            importlib.import_module("claude_code_sdk")
+            return True
+        except ImportError:
+            return False
+        except Exception as e:
+            logger.warning(f"Claude Code SDK import failed: {e}")
+            return False
+
+# グローバルインスタンス
+claude_capabilities = CapabilityProbe()
 
 class ClaudeCodeSession:
     """Claude Code セッション管理クラス"""
@@ -51,8 +396,10 @@ class ClaudeCodeSession:
         self.system_prompt = system_prompt or "あなたは専門的なソフトウェア開発アシスタントです。常に日本語で応答してください。"
         self.is_active = False
         self.created_at = datetime.now()
-        self.messages: List[Dict] = []
+        self.messages: deque = deque(maxlen=CHAT_HISTORY_MEMORY_LIMIT)  # 直近のみ保持（全件はデータベース）
+        self.message_count = 0
         self.cli_env = self._create_cli_env()
+        self.cli_worker: Optional[ClaudeCLIWorker] = None
     
     def _create_cli_env(self) -> Dict[str, str]:
         """Claude Code CLI用の環境変数を作成"""
@@ -63,9 +410,8 @@ class ClaudeCodeSession:
     
     def _create_sdk_options(self) -> Optional["ClaudeCodeOptions"]:
         """Claude Code SDK用のオプションを作成"""
-        if not SDK_AVAILABLE:
-            return None
         try:
+            from claude_code_sdk import ClaudeCodeOptions
             return ClaudeCodeOptions(
                 system_prompt=self.system_prompt,
                 cwd=str(self.working_directory),
@@ -91,7 +437,8 @@ class ClaudeCodeSession:
     async def start_session(self) -> bool:
         """Claude Code セッションを開始"""
         try:
-            if not (USE_SDK or USE_CLI):
+            capabilities = await claude_capabilities.get()
+            if capabilities.mode == "mock":
                 logger.warning("Claude Code SDK/CLI not available, using mock mode")
                 self.is_active = True
                 self.add_message("system", "Claude Code セッション（モックモード）が開始されました")
@@ -102,7 +449,7 @@ class ClaudeCodeSession:
                 self.working_directory.mkdir(parents=True, exist_ok=True)
                 logger.info(f"作業ディレクトリを作成しました: {self.working_directory}")
             
-            method = "SDK" if USE_SDK else "CLI"
+            method = "SDK" if capabilities.use_sdk else "CLI"
             self.is_active = True
             self.add_message("system", f"Claude Code セッション（{method}）が開始されました（作業ディレクトリ: {self.working_directory}）")
             logger.info(f"Claude Code session started using {method}: {self.session_id}")
@@ -118,6 +465,9 @@ class ClaudeCodeSession:
         """Claude Code セッションを停止"""
         try:
             self.is_active = False
+            if self.cli_worker:
+                await self.cli_worker.stop()
+                self.cli_worker = None
             self.add_message("system", "Claude Code セッションが停止されました")
             logger.info(f"Claude Code session stopped: {self.session_id}")
             return True
@@ -131,9 +481,10 @@ class ClaudeCodeSession:
         """Claudeにメッセージを送信（ストリーミング応答）"""
         try:
             self.add_message("user", message)
+            capabilities = await claude_capabilities.get()
             
             # モック応答
-            if not (USE_SDK or USE_CLI):
+            if capabilities.mode == "mock":
                 if "hello" in message.lower() or "こんにちは" in message.lower():
                     mock_response = "こんにちは！Claude Code（モック）です。プロジェクトの開発をお手伝いします。ファイルの作成、編集、コマンド実行などをサポートできます。"
                 elif "file" in message.lower() or "ファイル" in message:
@@ -148,8 +499,10 @@ class ClaudeCodeSession:
                 return
 
             # SDKを使用する場合（開発者モード）
-            if USE_SDK:
+            if capabilities.use_sdk:
                 try:
+                    from claude_code_sdk import query
+                    
                     # 開発効率化: 短縮プロンプトで課金最小化
                     optimized_message = self._optimize_prompt_for_cost(message)
                     
@@ -160,8 +513,9 @@ class ClaudeCodeSession:
                     full_response = ""
                     
                     # TaskGroup例外を適切に処理するためtry-except内でasyncループを実行
+                    stream = query(prompt=optimized_message, options=options)
                     try:
-                        async for response_chunk in query(prompt=optimized_message, options=options):
+                        async for response_chunk in stream:
                             if hasattr(response_chunk, 'content') and response_chunk.content:
                                 chunk = str(response_chunk.content)
                                 full_response += chunk
@@ -171,6 +525,9 @@ class ClaudeCodeSession:
                         for exc in exc_group.exceptions:
                             logger.error(f"SDK TaskGroup exception: {exc}")
                         raise Exception(f"SDK TaskGroup error: {len(exc_group.exceptions)} sub-exceptions")
+                    finally:
+                        # 中止された場合もSDKのストリームを閉じてリソースを解放
+                        await stream.aclose()
                     
                     if full_response:
                         self.add_message("claude", full_response)
@@ -184,44 +541,26 @@ class ClaudeCodeSession:
                     return
 
             # CLIを使用する場合
-            if USE_CLI:
+            if capabilities.use_cli:
+                response = ""
                 try:
-                    # Claude Code CLIを実行（非対話型）
-                    cmd = ['claude', '--print', message]
-                    
-                    # プロセスを開始
-                    process = await asyncio.create_subprocess_exec(
-                        *cmd,
-                        stdout=asyncio.subprocess.PIPE,
-                        stderr=asyncio.subprocess.PIPE,
-                        cwd=str(self.working_directory),
-                        env=self.cli_env
-                    )
-                    
-                    # プロセス完了を待機
-                    stdout, stderr = await process.communicate()
+                    stream = self._send_cli(message)
+                    try:
+                        async for chunk in stream:
+                            response += chunk
+                            yield chunk
+                    finally:
+                        await stream.aclose()
+                    self.add_message("claude", response)
                     
-                    if process.returncode == 0:
-                        # 成功時の応答を処理
-                        response = stdout.decode('utf-8')
+                except CLIWorkerError as e:
+                    if response:
                         self.add_message("claude", response)
-                        yield response
-                    else:
-                        # エラー時の処理
-                        error_output = stderr.decode('utf-8').strip()
-                        if "Credit balance is too low" in error_output:
-                            error_msg = "Claude API クレジット残高が不足しています。Anthropic Console でクレジットを追加してください。"
-                        elif "API key" in error_output.lower():
-                            error_msg = "Claude API キーが無効または未設定です。ANTHROPIC_API_KEY 環境変数を確認してください。"
-                        elif "rate limit" in error_output.lower():
-                            error_msg = "Claude API のレート制限に達しました。しばらく待ってから再試行してください。"
-                        else:
-                            error_msg = f"Claude Code CLI エラー: {error_output}"
-                        
-                        logger.error(error_msg)
-                        self.add_message("error", error_msg)
-                        yield error_msg
-                        
+                    error_msg = describe_cli_error(e.output.strip())
+                    logger.error(error_msg)
+                    self.add_message("error", error_msg)
+                    yield error_msg
+                    
                 except FileNotFoundError:
                     error_msg = "Claude Code CLIが見つかりません。npm install -g @anthropic-ai/claude-code でインストールしてください。"
                     logger.error(error_msg)
@@ -234,23 +573,84 @@ class ClaudeCodeSession:
                     self.add_message("error", error_msg)
                     yield error_msg
                 
+        except asyncio.CancelledError:
+            self.add_message("system", "応答が中止されました")
+            raise
         except Exception as e:
             error_msg = f"予期しないエラー: {str(e)}"
             logger.error(error_msg, exc_info=True)
             self.add_message("error", error_msg)
             yield error_msg
     
+    def _send_cli(self, message: str) -> AsyncGenerator[str, None]:
+        """CLIにメッセージを送信（常駐ワーカー、または1回ごとの起動）"""
+        if CLAUDE_CLI_PERSISTENT:
+            if self.cli_worker is None:
+                self.cli_worker = ClaudeCLIWorker(self.working_directory, self.cli_env, self.system_prompt)
+            return self.cli_worker.send(message)
+        return self._send_cli_oneshot(message)
+    
+    async def _send_cli_oneshot(self, message: str) -> AsyncGenerator[str, None]:
+        """claude --print をメッセージごとに起動し、標準出力を届いた順に返す
+        
+        stderr は並行して読み切る（パイプが詰まってCLIが止まらないようにする）。
+        終了コードが0以外の場合は、stderr の内容で CLIWorkerError を送出する。
+        """
+        # Claude Code CLIを実行（非対話型）
+        cmd = ['claude', '--print', message]
+        
+        # プロセスを開始
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=str(self.working_directory),
+            env=self.cli_env
+        )
+        stderr_task = asyncio.create_task(process.stderr.read())
+        # マルチバイト文字がチャンクの境界で分かれても壊れないよう差分でデコードする
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        
+        # 中止された場合はプロセスを終了させる
+        try:
+            while True:
+                data = await process.stdout.read(CLI_READ_SIZE)
+                text = decoder.decode(data, final=not data)
+                if text:
+                    yield text
+                if not data:
+                    break
+            stderr = await stderr_task
+            await process.wait()
+        except BaseException:
+            stderr_task.cancel()
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+        
+        if process.returncode != 0:
+            raise CLIWorkerError("Claude Code CLI failed", stderr.decode('utf-8', errors='replace').strip())
+    
     def add_message(self, sender: str, content: str):
-        """メッセージを履歴に追加"""
+        """メッセージを履歴に追加
+        
+        メモリには直近の一定数だけを残し、全件はデータベースに書き込む
+        （書き込みはバックグラウンドでまとめて行う）。
+        """
+        timestamp = datetime.now()
         self.messages.append({
             "sender": sender,
             "content": content,
-            "timestamp": datetime.now().isoformat()
+            "timestamp": timestamp.isoformat()
         })
+        self.message_count += 1
+        if CHAT_HISTORY_PERSIST:
+            chat_history.append(self.session_id, sender, content, timestamp)
     
     def get_message_history(self) -> List[Dict]:
-        """メッセージ履歴を取得"""
-        return self.messages.copy()
+        """メモリに保持している直近のメッセージ履歴を取得"""
+        return list(self.messages)
 
 class ClaudeIntegrationManager:
     """Claude Code統合管理クラス"""
@@ -318,7 +718,7 @@ class ClaudeIntegrationManager:
                 "working_directory": str(session.working_directory),
                 "is_active": session.is_active,
                 "created_at": session.created_at.isoformat(),
-                "message_count": len(session.messages)
+                "message_count": session.message_count
             }
             for session_id, session in self.active_sessions.items()
         ]
@@ -344,8 +744,20 @@ class ClaudeIntegration:
     def __init__(self):
         self.manager = ClaudeIntegrationManager()
     
-    async def send_message_stream(self, message: str, session_id: str) -> AsyncGenerator[str, None]:
-        """メッセージをClaude Codeに送信（ストリーミング）"""
+    async def send_message_stream(
+        self,
+        message: str,
+        session_id: str,
+        user_id: Optional[str] = None,
+        plan_type: Optional[str] = None,
+        on_position: Optional[PositionCallback] = None
+    ) -> AsyncGenerator[str, None]:
+        """メッセージをClaude Codeに送信（ストリーミング）
+        
+        同時に実行できる数はスケジューラーで制限され、空きがなければ
+        順番が来るまで待つ（待ち順は on_position で通知する）。
+        user_id を省略した場合はセッション単位で公平に扱う。
+        """
         session = await self.manager.get_session(session_id)
         if not session:
             yield f"エラー: セッション {session_id} が見つかりません"
@@ -355,16 +767,26 @@ class ClaudeIntegration:
             yield f"エラー: セッション {session_id} が非アクティブです"
             return
         
-        async for response_chunk in session.send_message(message):
-            yield response_chunk
+        try:
+            async with claude_scheduler.admit(user_id or f"session:{session_id}", plan_type, on_position):
+                async for response_chunk in session.send_message(message):
+                    yield response_chunk
+        except SchedulerFullError as e:
+            yield f"エラー: {e}"
     
-    async def send_message(self, message: str, session_id: str = None) -> str:
+    async def send_message(
+        self,
+        message: str,
+        session_id: str = None,
+        user_id: Optional[str] = None,
+        plan_type: Optional[str] = None
+    ) -> str:
         """メッセージをClaude Codeに送信（非ストリーミング、下位互換性のため）"""
         if not session_id:
             return "エラー: セッションIDが必要です"
         
         full_response = ""
-        async for chunk in self.send_message_stream(message, session_id):
+        async for chunk in self.send_message_stream(message, session_id, user_id, plan_type):
             full_response += chunk
         
         return full_response
@@ -403,7 +825,7 @@ class ClaudeIntegration:
             "working_directory": str(session.working_directory),
             "is_active": session.is_active,
             "created_at": session.created_at.isoformat(),
-            "message_count": len(session.messages)
+            "message_count": session.message_count
         }
     
     async def get_session_history(self, session_id: str) -> Optional[List[Dict]]:
@@ -414,6 +836,31 @@ class ClaudeIntegration:
         
         return session.get_message_history()
     
+    async def get_session_history_page(
+        self,
+        session_id: str,
+        before: Optional[int] = None,
+        after: Optional[int] = None,
+        limit: int = 50
+    ) -> Optional[Dict]:
+        """セッションのメッセージ履歴をカーソルでページ単位に取得
+        
+        履歴はデータベースから読むため、再起動前のメッセージも取得できる。
+        保存が無効な場合はメモリに残っている直近のメッセージを返す。
+        """
+        if CHAT_HISTORY_PERSIST:
+            return await chat_history.get_page(session_id, before, after, limit)
+        
+        session = await self.manager.get_session(session_id)
+        if not session:
+            return None
+        return {
+            "messages": session.get_message_history()[-limit:],
+            "total": session.message_count,
+            "has_more": False,
+            "next_cursor": None
+        }
+    
     async def remove_session(self, session_id: str) -> bool:
         """セッションを削除"""
         return await self.manager.remove_session(session_id)
@@ -0,0 +1,257 @@
+"""
+Claudeリクエストのスケジューラー
+SDKの query() やCLIのプロセスを同時に起動する数を制限し、待機中のリクエストを
+プランの重みに応じて公平に実行する
+
+待機中のリクエストには start-time fair queuing のタグを付ける:
+
+- 開始タグ = max(仮想時刻, そのユーザーの前回の終了タグ)
+- 終了タグ = 開始タグ + 1 / プランの重み
+
+空きができると、ユーザーごとの上限に達していないリクエストのうち終了タグが
+最も小さいものから実行する。重みが大きいプランほど多く実行され、
+1人のユーザーが大量に送っても他のユーザーの順番は後ろにずれない。
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy.orm import Session as DBSession
+
+from .models import Subscription, User
+
+logger = logging.getLogger(__name__)
+
+# 同時に実行するClaudeリクエストの上限（全体）
+CLAUDE_MAX_CONCURRENT = int(os.getenv("CLAUDE_MAX_CONCURRENT", "8"))
+# 同時に実行するClaudeリクエストの上限（ユーザーごと）
+CLAUDE_MAX_CONCURRENT_PER_USER = int(os.getenv("CLAUDE_MAX_CONCURRENT_PER_USER", "2"))
+# 待機できるリクエストの上限（超えると受け付けない）
+CLAUDE_QUEUE_LIMIT = int(os.getenv("CLAUDE_QUEUE_LIMIT", "200"))
+# プランごとの重み（"プラン:重み" をカンマ区切りで指定）
+CLAUDE_PLAN_WEIGHTS = os.getenv("CLAUDE_PLAN_WEIGHTS", "free:1,pro:4,enterprise:8")
+# 待ち時間の統計に使う直近のリクエスト数
+WAIT_SAMPLES = 1000
+
+DEFAULT_PLAN = "free"
+
+def parse_plan_weights(value: str) -> Dict[str, float]:
+    """"free:1,pro:4" 形式の重みを読み込む"""
+    weights = {}
+    for item in value.split(","):
+        plan, _, weight = item.strip().partition(":")
+        if plan and weight:
+            try:
+                weights[plan] = max(float(weight), 0.01)
+            except ValueError:
+                logger.warning(f"プランの重みが不正です: {item}")
+    return weights
+
+def get_user_plan_type(db: DBSession, user: User) -> str:
+    """ユーザーの有効なプラン（サブスクリプションがなければ管理者は enterprise、それ以外は free）"""
+    subscription = db.query(Subscription).filter(
+        Subscription.user_id == user.id,
+        Subscription.status == "active"
+    ).first()
+    if subscription:
+        return subscription.plan_type
+    return "enterprise" if user.is_admin else DEFAULT_PLAN
+
+class SchedulerFullError(Exception):
+    """待機中のリクエストが上限に達している"""
+
+class ClaudeRequestTicket:
+    """待機中・実行中のリクエスト"""
+
+    def __init__(self, user_id: str, plan_type: str, start_tag: float, finish_tag: float, seq: int):
+        self.user_id = user_id
+        self.plan_type = plan_type
+        self.start_tag = start_tag
+        self.finish_tag = finish_tag
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.admitted = False
+        self.changed = asyncio.Event()  # 実行の開始、または待ち順の変化
+
+    @property
+    def sort_key(self):
+        return (self.finish_tag, self.seq)
+
+# 待ち順の通知（順番は1から、待機中の総数）
+PositionCallback = Callable[[int, int], Awaitable[None]]
+
+class ClaudeScheduler:
+    """Claudeリクエストの受付制御"""
+
+    def __init__(
+        self,
+        max_concurrent: int = CLAUDE_MAX_CONCURRENT,
+        max_per_user: int = CLAUDE_MAX_CONCURRENT_PER_USER,
+        queue_limit: int = CLAUDE_QUEUE_LIMIT,
+        plan_weights: Optional[Dict[str, float]] = None
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.queue_limit = queue_limit
+        self.plan_weights = plan_weights if plan_weights is not None else parse_plan_weights(CLAUDE_PLAN_WEIGHTS)
+        self._waiting: List[ClaudeRequestTicket] = []  # sort_key の昇順
+        self._running: Dict[str, int] = {}
+        self._in_flight = 0
+        self._virtual_time = 0.0
+        self._last_finish: Dict[str, float] = {}
+        self._seq = 0
+        # 統計
+        self._admitted = 0
+        self._rejected = 0
+        self._cancelled = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._wait_samples: deque = deque(maxlen=WAIT_SAMPLES)
+
+    def _weight(self, plan_type: str) -> float:
+        return self.plan_weights.get(plan_type, self.plan_weights.get(DEFAULT_PLAN, 1.0))
+
+    @asynccontextmanager
+    async def admit(
+        self,
+        user_id: str,
+        plan_type: Optional[str] = None,
+        on_position: Optional[PositionCallback] = None
+    ) -> AsyncIterator[ClaudeRequestTicket]:
+        """実行枠を確保している間だけブロックを実行する
+
+        空きがなければ待機し、待ち順が変わるたびに on_position を呼ぶ。
+        待機中に中止された場合は待ち行列から外す。
+        """
+        ticket = self._enqueue(user_id, plan_type or DEFAULT_PLAN)
+        try:
+            await self._wait(ticket, on_position)
+            yield ticket
+        finally:
+            self._release(ticket)
+
+    def _enqueue(self, user_id: str, plan_type: str) -> ClaudeRequestTicket:
+        if len(self._waiting) >= self.queue_limit:
+            self._rejected += 1
+            raise SchedulerFullError("Claudeへのリクエストが混雑しています。しばらく待ってから再試行してください。")
+        start_tag = max(self._virtual_time, self._last_finish.get(user_id, 0.0))
+        finish_tag = start_tag + 1.0 / self._weight(plan_type)
+        self._last_finish[user_id] = finish_tag
+        self._seq += 1
+        ticket = ClaudeRequestTicket(user_id, plan_type, start_tag, finish_tag, self._seq)
+
+        index = len(self._waiting)
+        while index > 0 and self._waiting[index - 1].sort_key > ticket.sort_key:
+            index -= 1
+        self._waiting.insert(index, ticket)
+        self._dispatch()
+        return ticket
+
+    async def _wait(self, ticket: ClaudeRequestTicket, on_position: Optional[PositionCallback]):
+        reported = None
+        while not ticket.admitted:
+            ticket.changed.clear()
+            position = self._position(ticket)
+            if on_position and position != reported:
+                reported = position
+                try:
+                    await on_position(position, len(self._waiting))
+                except Exception as e:
+                    logger.debug(f"待ち順の通知に失敗しました: {e}")
+                if ticket.admitted:
+                    break
+            await ticket.changed.wait()
+
+        waited = time.monotonic() - ticket.enqueued_at
+        self._wait_total += waited
+        self._wait_max = max(self._wait_max, waited)
+        self._wait_samples.append(waited)
+
+    def _position(self, ticket: ClaudeRequestTicket) -> int:
+        """待ち順（実行できるリクエストの中での順番。1から）"""
+        position = 1
+        for other in self._waiting:
+            if other is ticket:
+                break
+            if self._running.get(other.user_id, 0) < self.max_per_user or other.user_id == ticket.user_id:
+                position += 1
+        return position
+
+    def _dispatch(self):
+        """空いている枠に待機中のリクエストを割り当てる"""
+        started = False
+        index = 0
+        while index < len(self._waiting) and self._in_flight < self.max_concurrent:
+            ticket = self._waiting[index]
+            if self._running.get(ticket.user_id, 0) >= self.max_per_user:
+                index += 1
+                continue
+            del self._waiting[index]
+            self._in_flight += 1
+            self._running[ticket.user_id] = self._running.get(ticket.user_id, 0) + 1
+            self._virtual_time = max(self._virtual_time, ticket.start_tag)
+            self._admitted += 1
+            ticket.admitted = True
+            ticket.changed.set()
+            started = True
+        if started:
+            for ticket in self._waiting:
+                ticket.changed.set()
+
+    def _release(self, ticket: ClaudeRequestTicket):
+        if ticket.admitted:
+            self._in_flight -= 1
+            remaining = self._running.get(ticket.user_id, 1) - 1
+            if remaining > 0:
+                self._running[ticket.user_id] = remaining
+            else:
+                self._running.pop(ticket.user_id, None)
+        else:
+            self._cancelled += 1
+            self._waiting.remove(ticket)
+            for other in self._waiting:
+                other.changed.set()
+
+        # 待機も実行もしていないユーザーのタグは仮想時刻に追いつけば不要
+        if ticket.user_id not in self._running and \
+                self._last_finish.get(ticket.user_id, 0.0) <= self._virtual_time and \
+                not any(other.user_id == ticket.user_id for other in self._waiting):
+            self._last_finish.pop(ticket.user_id, None)
+        self._dispatch()
+
+    def get_stats(self) -> Dict:
+        """実行数・待機数・待ち時間の統計"""
+        samples = sorted(self._wait_samples)
+
+        def percentile(ratio: float) -> float:
+            if not samples:
+                return 0.0
+            return round(samples[min(len(samples) - 1, int(len(samples) * ratio))], 3)
+
+        waiting_by_plan: Dict[str, int] = {}
+        for ticket in self._waiting:
+            waiting_by_plan[ticket.plan_type] = waiting_by_plan.get(ticket.plan_type, 0) + 1
+        return {
+            "in_flight": self._in_flight,
+            "waiting": len(self._waiting),
+            "waiting_by_plan": waiting_by_plan,
+            "max_concurrent": self.max_concurrent,
+            "max_concurrent_per_user": self.max_per_user,
+            "admitted_total": self._admitted,
+            "rejected_total": self._rejected,
+            "cancelled_total": self._cancelled,
+            "wait_seconds": {
+                "average": round(self._wait_total / self._admitted, 3) if self._admitted else 0.0,
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "max": round(self._wait_max, 3)
+            }
+        }
+
+# グローバルインスタンス
+claude_scheduler = ClaudeScheduler()
@@ -0,0 +1,307 @@
+"""
+セッションイベントバス
+ファイル変更・ビルド出力・カーソル移動などのセッション単位のイベントを配信する
+"""
+
+import asyncio
+import json
+import logging
+import os
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Set, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# セッションごとに保持する直近イベント数（再接続時のリプレイ用）
+EVENT_BUFFER_SIZE = int(os.getenv("EVENT_BUFFER_SIZE", "500"))
+# リプレイバッファを保持するセッション数の上限（超過分は古い順に破棄）
+EVENT_BUFFER_SESSIONS = int(os.getenv("EVENT_BUFFER_SESSIONS", "1000"))
+
+class SessionEventType:
+    """セッションイベントタイプの定数"""
+    FILE_CHANGE = "file_change"
+    FILE_UPDATED = "file_updated"
+    FILE_CREATED = "file_created"
+    FILE_DELETED = "file_deleted"
+    FILE_UPLOADED = "file_uploaded"
+    PROJECT_CREATED = "project_created"
+    BUILD_STARTED = "build_started"
+    BUILD_OUTPUT = "build_output"
+    BUILD_COMPLETED = "build_completed"
+    BUILD_ERROR = "build_error"
+    DEPLOY_STARTED = "deploy_started"
+    DEPLOY_OUTPUT = "deploy_output"
+    DEPLOY_COMPLETED = "deploy_completed"
+    DEPLOY_ERROR = "deploy_error"
+    USER_JOINED = "user_joined"
+    USER_LEFT = "user_left"
+    USER_ACTIVITY = "user_activity"
+    CURSOR_UPDATE = "cursor_update"
+    BROWSER_NOTIFICATION = "browser_notification"
+
+class CoalesceRule:
+    """バースト性のあるイベントを時間窓でまとめるルール
+
+    key を指定した場合は窓内で同じキーの最新イベントのみを残す。
+    merge を指定した場合は窓内のイベントを1件に結合する。
+    max_batch 件たまった時点で窓の終了を待たずに配信する。
+    """
+
+    def __init__(
+        self,
+        window: float,
+        key: Optional[Callable[[dict], Hashable]] = None,
+        merge: Optional[Callable[[List[dict]], dict]] = None,
+        max_batch: int = 200
+    ):
+        self.window = window
+        self.key = key
+        self.merge = merge
+        self.max_batch = max_batch
+
+def _merge_output_lines(events: List[dict]) -> dict:
+    """ビルド・デプロイ出力の行を1イベントに結合"""
+    merged = dict(events[-1])
+    merged["output"] = "\n".join(str(event.get("output", "")) for event in events)
+    merged["lines"] = len(events)
+    return merged
+
+# 既定の結合ルール
+DEFAULT_COALESCE_RULES: Dict[str, CoalesceRule] = {
+    SessionEventType.BUILD_OUTPUT: CoalesceRule(0.05, merge=_merge_output_lines),
+    SessionEventType.DEPLOY_OUTPUT: CoalesceRule(0.05, merge=_merge_output_lines),
+    SessionEventType.FILE_CHANGE: CoalesceRule(
+        0.1, key=lambda event: (event.get("event_type"), event.get("file_path"))
+    ),
+    SessionEventType.CURSOR_UPDATE: CoalesceRule(
+        0.05, key=lambda event: (event.get("user") or {}).get("id")
+    ),
+}
+
+class _PendingBatch:
+    """結合待ちのイベント"""
+
+    def __init__(self, event_type: str, rule: CoalesceRule):
+        self.event_type = event_type
+        self.rule = rule
+        self.events: List[dict] = []
+        self.latest: "OrderedDict[Hashable, dict]" = OrderedDict()
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def add(self, event: dict):
+        if self.rule.key:
+            key = self.rule.key(event)
+            self.latest.pop(key, None)
+            self.latest[key] = event
+        else:
+            self.events.append(event)
+
+    def __len__(self) -> int:
+        return len(self.latest) if self.rule.key else len(self.events)
+
+    def collect(self) -> List[dict]:
+        if self.rule.key:
+            return list(self.latest.values())
+        if self.rule.merge:
+            return [self.rule.merge(self.events)]
+        return list(self.events)
+
+class SessionEventBus:
+    """セッション単位のトピックバス
+
+    publish されたイベントには連番（seq）と session_id が付与され、
+    セッションごとの有界リングバッファに記録されたうえで sink と購読者へ
+    配信される。再接続したクライアントは replay() で取りこぼしたイベントを
+    取得できる。
+
+    forward を指定すると、結合済みのイベントは emit() の代わりに forward に
+    渡される（バックプレーン経由で各ワーカーの emit() を呼ぶために使用）。
+    連番は発行元で一度だけ付与してイベントに含めるため、どのワーカーでも
+    同じイベントは同じ連番で記録され、再接続先のワーカーでもリプレイできる。
+    """
+
+    def __init__(
+        self,
+        sink: Optional[Callable[[str, dict], Any]] = None,
+        forward: Optional[Callable[[str, dict], Any]] = None,
+        buffer_size: int = EVENT_BUFFER_SIZE,
+        max_sessions: int = EVENT_BUFFER_SESSIONS,
+        coalesce_rules: Optional[Dict[str, CoalesceRule]] = None
+    ):
+        self.sink = sink
+        self.forward = forward
+        self.buffer_size = buffer_size
+        self.max_sessions = max_sessions
+        self.coalesce_rules = DEFAULT_COALESCE_RULES if coalesce_rules is None else coalesce_rules
+        self._buffers: "OrderedDict[str, Deque[dict]]" = OrderedDict()
+        self._next_seq: Dict[str, int] = {}
+        self._pending: Dict[str, Dict[str, _PendingBatch]] = {}
+        self._subscribers: Dict[str, Dict[int, Tuple[Callable[[str, dict], Any], Optional[Set[str]]]]] = {}
+        self._next_token = 0
+
+    def subscribe(
+        self,
+        session_id: str,
+        callback: Callable[[str, dict], Any],
+        event_types: Optional[List[str]] = None
+    ) -> int:
+        """セッションのイベントを購読し、購読解除用のトークンを返す
+
+        event_types が None の場合はすべてのイベントを受け取る。
+        """
+        self._next_token += 1
+        types = set(event_types) if event_types is not None else None
+        self._subscribers.setdefault(session_id, {})[self._next_token] = (callback, types)
+        return self._next_token
+
+    def unsubscribe(self, session_id: str, token: int):
+        """購読を解除"""
+        subscribers = self._subscribers.get(session_id)
+        if subscribers is None:
+            return
+        subscribers.pop(token, None)
+        if not subscribers:
+            del self._subscribers[session_id]
+
+    def publish(self, session_id: str, event: Union[str, dict]):
+        """イベントを発行
+
+        結合ルールのあるイベントは時間窓の終了時にまとめて配信される。
+        配信順序を保つため、異なるタイプのイベントが来た時点で
+        同じセッションの結合待ちイベントは先に配信される。
+        """
+        if isinstance(event, str):
+            event = json.loads(event)
+        event_type = event.get("type")
+
+        pending = self._pending.get(session_id, {})
+        for pending_type in [t for t in pending if t != event_type]:
+            self.flush(session_id, pending_type)
+
+        rule = self.coalesce_rules.get(event_type)
+        if rule is None:
+            self._release(session_id, event)
+            return
+
+        batch = self._pending.setdefault(session_id, {}).get(event_type)
+        if batch is None:
+            batch = _PendingBatch(event_type, rule)
+            self._pending[session_id][event_type] = batch
+            batch.timer = asyncio.get_running_loop().call_later(
+                rule.window, self.flush, session_id, event_type
+            )
+        batch.add(event)
+
+        if len(batch) >= rule.max_batch:
+            self.flush(session_id, event_type)
+
+    def flush(self, session_id: str, event_type: Optional[str] = None):
+        """結合待ちのイベントを配信（event_type 省略時はセッションの全タイプ）"""
+        pending = self._pending.get(session_id)
+        if not pending:
+            return
+
+        for pending_type in [event_type] if event_type else list(pending):
+            batch = pending.pop(pending_type, None)
+            if batch is None:
+                continue
+            if batch.timer:
+                batch.timer.cancel()
+            for event in batch.collect():
+                self._release(session_id, event)
+
+        if not pending:
+            del self._pending[session_id]
+
+    def _release(self, session_id: str, event: dict):
+        """結合済みのイベントに連番を付与して配信経路に渡す"""
+        event = dict(event)
+        event["seq"] = self.get_last_seq(session_id) + 1
+        self._next_seq[session_id] = event["seq"]
+        if self.forward:
+            self.forward(session_id, event)
+        else:
+            self.emit(session_id, event)
+
+    def emit(self, session_id: str, event: dict):
+        """リングバッファに記録し、sink と購読者へ配信
+
+        発行元で付与された連番（seq）があればそれを使い、自ワーカーの連番も
+        そこまで進める（他ワーカーが発行したイベントの後に続けて採番するため）。
+        連番がなければここで付与する。
+        """
+        seq = event.get("seq")
+        if seq is None:
+            seq = self.get_last_seq(session_id) + 1
+        self._next_seq[session_id] = max(self.get_last_seq(session_id), seq)
+
+        envelope = dict(event)
+        envelope["seq"] = seq
+        envelope["session_id"] = session_id
+        envelope.setdefault("timestamp", datetime.now().isoformat())
+
+        buffer = self._buffers.get(session_id)
+        if buffer is None:
+            buffer = deque(maxlen=self.buffer_size)
+            self._buffers[session_id] = buffer
+            self._evict_old_sessions()
+        else:
+            self._buffers.move_to_end(session_id)
+        buffer.append(envelope)
+
+        if self.sink:
+            self.sink(session_id, envelope)
+        for callback, types in list(self._subscribers.get(session_id, {}).values()):
+            if types is not None and envelope.get("type") not in types:
+                continue
+            try:
+                callback(session_id, envelope)
+            except Exception as e:
+                logger.error(f"イベント配信エラー: {e}")
+
+    def _evict_old_sessions(self):
+        """保持セッション数の上限を超えたリングバッファを古い順に破棄"""
+        while len(self._buffers) > self.max_sessions:
+            session_id, _ = self._buffers.popitem(last=False)
+            self._next_seq.pop(session_id, None)
+
+    def replay(self, session_id: str, last_seq: int) -> Tuple[List[dict], bool]:
+        """last_seq より後のイベントを取得
+
+        戻り値は (イベント一覧, 欠落なしか)。要求範囲がリングバッファから
+        既に押し出されている場合は欠落ありとなり、クライアントは全体を
+        再取得する必要がある。
+        """
+        buffer = self._buffers.get(session_id)
+        if last_seq > self.get_last_seq(session_id):
+            # 連番がリセットされている（バッファ破棄後など）
+            return list(buffer or []), False
+        if not buffer:
+            return [], last_seq >= self.get_last_seq(session_id)
+
+        events = [event for event in buffer if event["seq"] > last_seq]
+        complete = buffer[0]["seq"] <= last_seq + 1
+        return events, complete
+
+    def get_last_seq(self, session_id: str) -> int:
+        """セッションの最新の連番を取得"""
+        return self._next_seq.get(session_id, 0)
+
+    def drop_session(self, session_id: str):
+        """セッションのバッファ・結合待ちイベント・購読をすべて破棄"""
+        for batch in self._pending.pop(session_id, {}).values():
+            if batch.timer:
+                batch.timer.cancel()
+        self._buffers.pop(session_id, None)
+        self._next_seq.pop(session_id, None)
+        self._subscribers.pop(session_id, None)
+
+    def get_stats(self) -> dict:
+        """バスの統計を取得"""
+        return {
+            "sessions": len(self._buffers),
+            "buffered_events": sum(len(buffer) for buffer in self._buffers.values()),
+            "pending_batches": sum(len(pending) for pending in self._pending.values()),
+            "subscriptions": sum(len(subscribers) for subscribers in self._subscribers.values())
+        }
@@ -10,6 +10,13 @@ import uvicorn
 
 from .routers import auth, sessions, users, terminal, claude, websocket, files, projects, notifications, collaboration, subscriptions
 from .init_db import init_database
+from .websocket_manager import manager as websocket_manager
+from .chat_history import chat_history
+from .claude_integration import claude_capabilities
+from .process_limits import check_cgroup_support
+from .terminal_managers import (
+    TERMINAL_BROKER_SOCKET, shell_pool, shutdown_active_terminals, start_terminal_reaper, stop_terminal_reaper
+)
 import logging
 
 # ログ設定
@@ -57,6 +64,30 @@ app.include_router(projects.router)
 app.include_router(notifications.router)
 app.include_router(collaboration.router)
 
+@app.on_event("startup")
+async def startup():
+    """起動時処理"""
+    await websocket_manager.start()
+    chat_history.start()
+    # SDK/CLIの確認は起動を待たせずにバックグラウンドで行う
+    claude_capabilities.start()
+    start_terminal_reaper()
+    if not TERMINAL_BROKER_SOCKET:
+        # ブローカー使用時はシェルを動かすブローカー側で確認する
+        check_cgroup_support()
+    if not TERMINAL_BROKER_SOCKET and not os.getenv("TESTING"):
+        # ブローカー使用時はブローカー側でプールを持つ（テスト時はシェルを起動しない）
+        await shell_pool.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    """終了時処理"""
+    stop_terminal_reaper()
+    await shell_pool.stop()
+    await shutdown_active_terminals()
+    await chat_history.stop()
+    await websocket_manager.stop()
+
 # 静的ファイル配信（将来のフロントエンドビルド用）
 # app.mount("/static", StaticFiles(directory="static"), name="static")
 
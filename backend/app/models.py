@@ -3,7 +3,7 @@
 Claude Code Client の全テーブル定義
 """
 
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text, ForeignKey, BigInteger
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text, ForeignKey, BigInteger, Index
 from sqlalchemy.dialects.postgresql import JSONB, INET
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
@@ -425,6 +425,22 @@ class EventLog(Base):
     severity = Column(String(10), default="info")  # info, warning, error, success
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+class ClaudeMessage(Base):
+    """Claudeセッションのメッセージ履歴モデル"""
+    __tablename__ = "claude_messages"
+    
+    id = Column(Integer, primary_key=True, index=True)  # ページングのカーソルに使用
+    # Claudeセッションはセッション管理の外でも作成されるため外部キーにしない
+    # （ターミナルのClaudeセッションは "<セッションID>_claude" のIDで書き込まれる）
+    session_id = Column(String(64), nullable=False)
+    sender = Column(String(20), nullable=False)  # user, claude, system, error
+    content = Column(Text, nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+    
+    __table_args__ = (
+        Index("ix_claude_messages_session_id_id", "session_id", "id"),
+    )
+
 class Subscription(Base):
     """サブスクリプションモデル"""
     __tablename__ = "subscriptions"
@@ -0,0 +1,184 @@
+"""
+プロセスのリソース制限と使用量
+ターミナルのシェルに Session.resource_limits を適用し、使用量を集計する
+"""
+
+import logging
+import os
+import resource
+from pathlib import Path
+from typing import Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# cgroup v2 の委譲されたディレクトリ（設定されていて書き込み可能ならcgroupで制限する）
+TERMINAL_CGROUP_ROOT = os.getenv("TERMINAL_CGROUP_ROOT", "")
+
+# cgroupが使えない場合にCPU制限から求めるCPU時間の上限の基準秒数
+# （cpu_limit コア分をこの秒数使い続けたプロセスは SIGXCPU で止まる）
+TERMINAL_CPU_TIME_WINDOW = int(os.getenv("TERMINAL_CPU_TIME_WINDOW", "3600"))
+
+# cgroupのCPU制限の周期（マイクロ秒）
+CPU_PERIOD_US = 100000
+# RLIMIT_CPU のソフト上限からハード上限（SIGKILL）までの猶予秒数
+CPU_RLIMIT_GRACE_SECONDS = 5
+
+class LimitMode:
+    """制限の適用方法の定数"""
+    CGROUP = "cgroup"  # cgroup v2（CPU・メモリ・プロセス数）
+    RLIMIT = "rlimit"  # RLIMIT_CPU（プロセスごとのCPU時間のみ）
+    NONE = "none"
+
+def _cgroup_dir(name: str) -> Optional[Path]:
+    """ターミナル用のcgroupディレクトリを返す（利用できなければ None）"""
+    if not TERMINAL_CGROUP_ROOT:
+        return None
+    root = Path(TERMINAL_CGROUP_ROOT)
+    if not (root / "cgroup.procs").exists() or not os.access(root, os.W_OK):
+        return None
+    return root / name
+
+def check_cgroup_support() -> bool:
+    """cgroupで制限できるかを確認し、できなければ起動時に警告する"""
+    if _cgroup_dir("probe") is not None:
+        return True
+    logger.warning(
+        "TERMINAL_CGROUP_ROOT が利用できないため、セッションのリソース制限のうち"
+        "メモリ・プロセス数は適用されません（CPUは RLIMIT_CPU によるCPU時間の上限のみ）"
+    )
+    return False
+
+def _apply_cpu_rlimit(pid: int, cpu_limit):
+    """RLIMIT_CPU でプロセスごとのCPU時間に上限を設ける（子プロセスは引き継ぐ）"""
+    seconds = max(1, int(float(cpu_limit) * TERMINAL_CPU_TIME_WINDOW))
+    hard = seconds + CPU_RLIMIT_GRACE_SECONDS
+    _, current_hard = resource.prlimit(pid, resource.RLIMIT_CPU)
+    if current_hard != resource.RLIM_INFINITY:
+        # 権限がなければハード上限は上げられない
+        seconds = min(seconds, current_hard)
+        hard = min(hard, current_hard)
+    resource.prlimit(pid, resource.RLIMIT_CPU, (seconds, hard))
+
+def apply_resource_limits(pid: int, limits: Optional[Dict], name: str) -> str:
+    """起動済みのプロセスにリソース制限を適用し、適用方法を返す
+
+    limits は Session.resource_limits の形式
+    （cpu_limit: コア数、memory_limit_mb、process_limit）。
+    子プロセスは制限を引き継ぐ。cgroup v2 が使えない場合は cpu_limit のみ
+    RLIMIT_CPU によるCPU時間の上限で代用して RLIMIT を返す（RLIMIT_AS は
+    Node.jsの仮想メモリ予約で起動できなくなり、RLIMIT_NPROC はUIDごとで
+    rootには効かないため、メモリ・プロセス数は制限しない）。
+    """
+    if not limits:
+        return LimitMode.NONE
+
+    cpu_limit = limits.get("cpu_limit")
+    memory_mb = limits.get("memory_limit_mb")
+    process_limit = limits.get("process_limit")
+
+    cgroup = _cgroup_dir(name)
+    if cgroup is None:
+        unenforced = [key for key in ("memory_limit_mb", "process_limit") if limits.get(key)]
+        if unenforced:
+            logger.warning(f"cgroup v2 が利用できないため {', '.join(unenforced)} を適用しません: {name}")
+        if not cpu_limit:
+            return LimitMode.NONE
+        try:
+            _apply_cpu_rlimit(pid, cpu_limit)
+            return LimitMode.RLIMIT
+        except (OSError, ValueError) as e:
+            logger.warning(f"RLIMIT_CPU の設定に失敗しました: pid={pid}, {e}")
+            return LimitMode.NONE
+    try:
+        cgroup.mkdir(exist_ok=True)
+        if cpu_limit:
+            (cgroup / "cpu.max").write_text(f"{int(float(cpu_limit) * CPU_PERIOD_US)} {CPU_PERIOD_US}")
+        if memory_mb:
+            (cgroup / "memory.max").write_text(str(int(memory_mb) * 1024 * 1024))
+        if process_limit:
+            (cgroup / "pids.max").write_text(str(int(process_limit)))
+        (cgroup / "cgroup.procs").write_text(str(pid))
+        return LimitMode.CGROUP
+    except (OSError, ValueError) as e:
+        logger.warning(f"cgroupによる制限に失敗しました: pid={pid}, {e}")
+        return LimitMode.NONE
+
+def remove_cgroup(name: str):
+    """ターミナル用のcgroupを削除（プロセスがすべて終了している必要がある）"""
+    cgroup = _cgroup_dir(name)
+    if cgroup is None or not cgroup.exists():
+        return
+    try:
+        cgroup.rmdir()
+    except OSError as e:
+        logger.warning(f"cgroupの削除に失敗しました: {cgroup}, {e}")
+
+def _cgroup_usage(cgroup: Path) -> Dict:
+    cpu_usec = 0
+    for line in (cgroup / "cpu.stat").read_text().splitlines():
+        key, _, value = line.partition(" ")
+        if key == "usage_usec":
+            cpu_usec = int(value)
+    return {
+        "cpu_seconds": round(cpu_usec / 1_000_000, 2),
+        "memory_mb": round(int((cgroup / "memory.current").read_text()) / (1024 * 1024), 1),
+        "processes": int((cgroup / "pids.current").read_text())
+    }
+
+def _iter_proc_stats():
+    """/proc/<pid>/stat の comm 以降のフィールドを列挙"""
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry.name}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # comm にスペースや括弧が含まれる場合があるため最後の ")" 以降を使う
+        yield stat[stat.rfind(")") + 2:].split()
+
+def _process_group_usage(pgid: int) -> Dict:
+    """/proc からプロセスグループの使用量を集計"""
+    ticks = os.sysconf("SC_CLK_TCK")
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    cpu_ticks = 0
+    rss_pages = 0
+    processes = 0
+    for fields in _iter_proc_stats():
+        if int(fields[2]) != pgid:
+            continue
+        processes += 1
+        cpu_ticks += int(fields[11]) + int(fields[12])
+        rss_pages += int(fields[21])
+    return {
+        "cpu_seconds": round(cpu_ticks / ticks, 2),
+        "memory_mb": round(rss_pages * page_size / (1024 * 1024), 1),
+        "processes": processes
+    }
+
+def session_process_groups(sid: int) -> Set[int]:
+    """セッションに属するプロセスグループの一覧
+    
+    対話シェルのジョブ制御で別グループになったジョブも含む。
+    /proc が読めない環境ではセッションリーダーのグループのみを返す。
+    """
+    groups = {sid}
+    try:
+        for fields in _iter_proc_stats():
+            if int(fields[3]) == sid:
+                groups.add(int(fields[2]))
+    except (OSError, ValueError, IndexError) as e:
+        logger.debug(f"プロセスグループの列挙に失敗しました: sid={sid}, {e}")
+    return groups
+
+def get_resource_usage(pid: int, name: str) -> Dict:
+    """シェルとその子プロセスのリソース使用量を取得"""
+    cgroup = _cgroup_dir(name)
+    try:
+        if cgroup is not None and cgroup.exists():
+            return _cgroup_usage(cgroup)
+        return _process_group_usage(os.getpgid(pid))
+    except (OSError, ValueError, IndexError) as e:
+        logger.debug(f"リソース使用量の取得に失敗しました: pid={pid}, {e}")
+        return {"cpu_seconds": 0.0, "memory_mb": 0.0, "processes": 0}
@@ -0,0 +1,487 @@
+"""
+PTYブローカー
+ターミナルのシェルをバックエンドのワーカーとは別のプロセスで動かす
+
+    TERMINAL_BROKER_SOCKET=/run/claude-terminals.sock python -m app.pty_broker
+
+ブローカーが動いていれば、バックエンドの再起動（--reload を含む）でシェルが
+終了せず、複数のワーカーから同じターミナルに接続できる。スクロールバックも
+ブローカー側に保持される。各ワーカーは同じ TERMINAL_BROKER_SOCKET を設定すると
+RemoteTerminalManager を通してブローカー上のターミナルを使う。
+
+通信はUnixソケット上のフレーム（種類1バイト + 長さ4バイト + 本文）で行う。
+1つの接続は1つのターミナルに対応し、最初に open を要求する。ブローカーは
+open の応答でスクロールバックを返し、以降の出力を OUTPUT で送る。
+クライアントは入力を INPUT で送る。出力を受け取れない間は pause を要求し、
+ブローカーは resume まで出力の送信を止める（応答は送り続ける）。
+接続を閉じてもターミナルは終了しない（terminate を要求すると終了する）。
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import struct
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from .process_limits import check_cgroup_support
+from .terminal_managers import (
+    BaseTerminalManager, MAX_WINDOW_SIZE, TERMINAL_BROKER_SOCKET, TERMINAL_KILL_TIMEOUT, TERMINAL_SIGNALS,
+    create_terminal_manager, get_active_terminal, remove_active_terminal, remove_active_terminals,
+    set_active_terminal, shell_pool, start_terminal_reaper, stop_terminal_reaper, active_terminals
+)
+
+logger = logging.getLogger(__name__)
+
+# フレームのヘッダー（種類、本文の長さ）
+FRAME_HEADER = struct.Struct("!BI")
+# フレーム本文の最大バイト数
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# ブローカーへの要求の応答を待つ最大秒数（open はシェルの起動を含む）
+BROKER_REQUEST_TIMEOUT = 30.0
+
+class BrokerFrame:
+    """フレームの種類"""
+    REQUEST = 1   # JSON {"id": n, "op": "...", ...}（id が null なら応答不要）
+    RESPONSE = 2  # JSON {"id": n, "ok": true, "result": ...} / {"id": n, "ok": false, "error": "..."}
+    OUTPUT = 3    # ターミナル出力（UTF-8）
+    INPUT = 4     # ターミナル入力
+    CLOSED = 5    # JSON {"overflowed": bool} シェルが終了したか、出力に追いつけなかった
+
+async def read_frame(reader: asyncio.StreamReader) -> Tuple[int, bytes]:
+    """フレームを1つ読み取る（切断時は asyncio.IncompleteReadError）"""
+    kind, length = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"フレームが大きすぎます: {length}")
+    return kind, await reader.readexactly(length)
+
+def write_frame(writer: asyncio.StreamWriter, kind: int, payload: bytes = b""):
+    """フレームを書き込む（送信待ちは呼び出し元が drain する）"""
+    writer.write(FRAME_HEADER.pack(kind, len(payload)) + payload)
+
+def write_json(writer: asyncio.StreamWriter, kind: int, message: dict):
+    write_frame(writer, kind, json.dumps(message, ensure_ascii=False).encode("utf-8"))
+
+class PTYBroker:
+    """ターミナルを所有し、ワーカーからの接続を受け付けるブローカー"""
+
+    def __init__(self, path: str = TERMINAL_BROKER_SOCKET, pool=shell_pool):
+        self.path = path
+        self.pool = pool
+        self.server: Optional[asyncio.AbstractServer] = None
+        self._open_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    async def start(self):
+        """ソケットで待ち受けを開始"""
+        if os.path.exists(self.path):
+            if _socket_in_use(self.path):
+                raise RuntimeError(f"PTYブローカーは既に起動しています: {self.path}")
+            os.unlink(self.path)  # 前回のブローカーが残したソケット
+        self.server = await asyncio.start_unix_server(self._handle_connection, path=self.path)
+        os.chmod(self.path, 0o600)
+        start_terminal_reaper()
+        check_cgroup_support()
+        await self.pool.start()
+        logger.info(f"PTY broker listening on {self.path}")
+
+    async def stop(self):
+        """待ち受けを止め、すべてのターミナルを終了"""
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        stop_terminal_reaper()
+        await self.pool.stop()
+        await remove_active_terminals(list(active_terminals))
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    async def open_terminal(self, request: dict) -> Tuple[BaseTerminalManager, bool]:
+        """ターミナルに接続（なければ作成）し、作成したかどうかと合わせて返す"""
+        session_id = request["session_id"]
+        async with self._open_locks[session_id]:
+            terminal = get_active_terminal(session_id)
+            if terminal and not terminal.closed:
+                return terminal, False
+            if terminal:
+                # シェルが終了済みなら作り直す
+                await remove_active_terminal(session_id)
+            terminal = create_terminal_manager(
+                session_id=session_id,
+                terminal_type=request.get("terminal_type", "basic"),
+                working_directory=request.get("working_directory") or "/tmp",
+                system_prompt=request.get("system_prompt"),
+                resource_limits=request.get("resource_limits"),
+                environment=request.get("environment")
+            )
+            await terminal.start_terminal()
+            set_active_terminal(session_id, terminal)
+            logger.info(f"Broker terminal created: {session_id}")
+            return terminal, True
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        terminal = None
+        subscription = None
+        pump_task = None
+        # pause の間はクリアされ、出力の送信が止まる
+        sending = asyncio.Event()
+        sending.set()
+        try:
+            kind, payload = await read_frame(reader)
+            request = json.loads(payload)
+            if kind != BrokerFrame.REQUEST or request.get("op") != "open":
+                write_json(writer, BrokerFrame.RESPONSE, {"id": request.get("id"), "ok": False, "error": "最初に open を要求してください"})
+                return
+            try:
+                terminal, created = await self.open_terminal(request)
+            except Exception as e:
+                logger.error(f"Broker terminal open error: {e}")
+                write_json(writer, BrokerFrame.RESPONSE, {"id": request.get("id"), "ok": False, "error": str(e)})
+                return
+
+            subscription = terminal.subscribe()
+            write_json(writer, BrokerFrame.RESPONSE, {
+                "id": request.get("id"), "ok": True,
+                "result": {
+                    "created": created,
+                    "terminal_type": terminal.terminal_type,
+                    "scrollback": subscription.scrollback
+                }
+            })
+            await writer.drain()
+            pump_task = asyncio.create_task(self._pump_output(subscription, writer, sending))
+
+            while True:
+                kind, payload = await read_frame(reader)
+                if kind == BrokerFrame.INPUT:
+                    # 書き込み待ちが多い間はこの接続からの読み取りが止まる
+                    await terminal.write_input(payload)
+                elif kind == BrokerFrame.REQUEST:
+                    await self._handle_request(terminal, json.loads(payload), writer, sending)
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass  # ワーカーが切断した（ターミナルは残す）
+        except Exception as e:
+            logger.error(f"Broker connection error: {e}")
+        finally:
+            if pump_task:
+                pump_task.cancel()
+            if terminal and subscription:
+                terminal.unsubscribe(subscription)
+            writer.close()
+
+    async def _pump_output(self, subscription, writer: asyncio.StreamWriter, sending: asyncio.Event):
+        """購読した出力をワーカーに送る
+
+        ワーカーが pause している間は購読から取り出さないので、詰まれば
+        ターミナル側でPTYの読み取りが止まる。
+        """
+        try:
+            while True:
+                await sending.wait()
+                output = await subscription.get()
+                if output is None:
+                    # 接続は閉じない（terminate などの応答を返せるように）
+                    write_json(writer, BrokerFrame.CLOSED, {"overflowed": subscription.overflowed})
+                    await writer.drain()
+                    return
+                write_frame(writer, BrokerFrame.OUTPUT, output.encode("utf-8"))
+                await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def _handle_request(
+        self, terminal: BaseTerminalManager, request: dict, writer: asyncio.StreamWriter, sending: asyncio.Event
+    ):
+        """open 以降の要求を処理"""
+        op = request.get("op")
+        result = None
+        error = None
+        try:
+            if op == "pause":
+                sending.clear()
+            elif op == "resume":
+                sending.set()
+            elif op == "resize":
+                terminal.resize(int(request["rows"]), int(request["cols"]))
+            elif op == "signal":
+                terminal.send_signal(str(request["signal"]))
+            elif op == "usage":
+                result = terminal.get_usage()
+            elif op == "terminate":
+                timeout = float(request.get("timeout_seconds", TERMINAL_KILL_TIMEOUT))
+                if not await remove_active_terminal(terminal.session_id):
+                    await terminal.cleanup(timeout)
+            else:
+                error = f"不明な要求です: {op}"
+        except (KeyError, TypeError, ValueError) as e:
+            error = f"要求が不正です: {e}"
+
+        if error:
+            logger.warning(f"Broker request error ({terminal.session_id}): {error}")
+        if request.get("id") is None:
+            return
+        if error:
+            write_json(writer, BrokerFrame.RESPONSE, {"id": request["id"], "ok": False, "error": error})
+        else:
+            write_json(writer, BrokerFrame.RESPONSE, {"id": request["id"], "ok": True, "result": result})
+        await writer.drain()
+
+def _socket_in_use(path: str) -> bool:
+    """ソケットで待ち受けているプロセスがあるか"""
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        probe.close()
+
+class BrokerError(Exception):
+    """ブローカーが要求を処理できなかった"""
+
+class RemoteTerminalManager(BaseTerminalManager):
+    """PTYブローカー上のターミナルに接続するターミナルマネージャー
+
+    出力はブローカーから受け取ってこのプロセスの購読者に配り、入力・
+    ウィンドウサイズ変更・シグナルはブローカーに送る。全購読者が詰まって
+    いる間はブローカーに出力の送信を止めさせる（要求への応答は受け取り続ける）。
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        terminal_type: str = "basic",
+        working_directory: str = "/tmp",
+        socket_path: str = TERMINAL_BROKER_SOCKET,
+        system_prompt: Optional[str] = None,
+        resource_limits: Optional[Dict] = None,
+        environment: Optional[Dict[str, str]] = None
+    ):
+        super().__init__(session_id, working_directory, resource_limits, environment)
+        self.terminal_type = terminal_type
+        self.socket_path = socket_path
+        self.system_prompt = system_prompt
+        self.created: Optional[bool] = None
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._receiver_task: Optional[asyncio.Task] = None
+        self._requests: Dict[int, asyncio.Future] = {}
+        self._next_request_id = 0
+        self._connected = False
+        # 送信の停止が伝わる前に届いた出力（再開時に配る）
+        self._held: List[str] = []
+        self._usage: Dict = {}
+
+    def _create_recorder(self):
+        """記録はシェルを動かすブローカー側で行う"""
+        return None
+
+    async def start_terminal(self):
+        """ブローカーに接続し、ターミナルを開く（既にあれば接続のみ）"""
+        self._reader, self._writer = await asyncio.open_unix_connection(self.socket_path)
+        self._connected = True
+        self._receiver_task = asyncio.create_task(self._receive())
+        result = await self._request(
+            "open",
+            session_id=self.session_id,
+            terminal_type=self.terminal_type,
+            working_directory=self.working_directory,
+            system_prompt=self.system_prompt,
+            resource_limits=self.resource_limits,
+            environment=self.environment
+        )
+        self.created = result["created"]
+        if result["scrollback"]:
+            # ブローカーに保持されていた出力（ワーカーの再起動前のものを含む）
+            self.scrollback.append(result["scrollback"])
+        self.is_initialized = True
+        logger.info(f"Broker terminal {'created' if self.created else 'attached'}: {self.session_id}")
+
+    async def _receive(self):
+        """ブローカーからのフレームを処理するタスク"""
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                kind, payload = await read_frame(self._reader)
+                if kind == BrokerFrame.RESPONSE:
+                    self._on_response(json.loads(payload))
+                elif kind == BrokerFrame.OUTPUT:
+                    output = payload.decode("utf-8", errors="replace")
+                    if self._paused:
+                        self._held.append(output)
+                        continue
+                    # ブローカー側でまとめ済みなのでそのまま1フレームとして配る
+                    self._pending.append(output)
+                    self._flush(loop)
+                elif kind == BrokerFrame.CLOSED:
+                    # シェルが終了した。要求への応答は引き続き受け取る
+                    if json.loads(payload).get("overflowed"):
+                        logger.warning(f"Broker stream overflowed: {self.session_id}")
+                    self._pending.extend(self._held)
+                    self._held = []
+                    self._flush(loop)
+                    self._close_subscribers()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            if self._connected:
+                logger.warning(f"Broker connection lost: {self.session_id}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Broker receive error: {e}")
+        finally:
+            self._connected = False
+            self._close_subscribers()
+            for future in self._requests.values():
+                if not future.done():
+                    future.set_exception(BrokerError("ブローカーとの接続が切れました"))
+            self._requests.clear()
+
+    def _on_response(self, response: dict):
+        future = self._requests.pop(response.get("id"), None)
+        if future is None or future.done():
+            return
+        if response.get("ok"):
+            future.set_result(response.get("result"))
+        else:
+            future.set_exception(BrokerError(response.get("error", "不明なエラー")))
+
+    async def _request(self, op: str, timeout: float = BROKER_REQUEST_TIMEOUT, **params):
+        """要求を送り、応答を待つ"""
+        if not self._connected:
+            raise BrokerError("ブローカーに接続していません")
+        self._next_request_id += 1
+        request_id = self._next_request_id
+        future = asyncio.get_running_loop().create_future()
+        self._requests[request_id] = future
+        write_json(self._writer, BrokerFrame.REQUEST, {"id": request_id, "op": op, **params})
+        try:
+            await self._writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._requests.pop(request_id, None)
+
+    def _notify(self, op: str, **params):
+        """応答を待たない要求を送る"""
+        if not self._connected:
+            return
+        write_json(self._writer, BrokerFrame.REQUEST, {"id": None, "op": op, **params})
+
+    def _pause_reader(self):
+        """全購読者が詰まっている間、ブローカーに出力の送信を止めさせる"""
+        if not self._paused:
+            self._paused = True
+            self._notify("pause")
+
+    def _resume_reader(self):
+        """出力の送信を再開させ、止まるまでに届いていた出力を配る"""
+        if not self._paused:
+            return
+        self._paused = False
+        self._notify("resume")
+        if self._held:
+            self._pending.extend(self._held)
+            self._held = []
+            self._flush()
+
+    async def write_input(self, data):
+        """入力をブローカーに送る（ソケットの送信待ちが多い間は呼び出し元が待たされる）"""
+        self.touch()
+        payload = data.encode() if isinstance(data, str) else bytes(data)
+        if not payload or not self._connected or self._closed:
+            return
+        write_frame(self._writer, BrokerFrame.INPUT, payload)
+        try:
+            await self._writer.drain()
+        except ConnectionError as e:
+            logger.error(f"Broker write error: {e}")
+
+    def get_pending_input(self) -> int:
+        if self._writer is None or self._writer.transport.is_closing():
+            return 0
+        return self._writer.transport.get_write_buffer_size()
+
+    def resize(self, rows: int, cols: int):
+        if not (0 < rows <= MAX_WINDOW_SIZE and 0 < cols <= MAX_WINDOW_SIZE):
+            raise ValueError(f"無効なウィンドウサイズです: {rows}x{cols}")
+        self.touch()
+        self._notify("resize", rows=rows, cols=cols)
+
+    def send_signal(self, name: str):
+        key = name if name.startswith("SIG") else f"SIG{name}"
+        if key not in TERMINAL_SIGNALS:
+            raise ValueError(f"送信できないシグナルです: {name}")
+        self.touch()
+        self._notify("signal", signal=key)
+
+    def get_usage(self) -> Dict:
+        """最後にブローカーから取得した使用量"""
+        return self._usage or {
+            "cpu_seconds": 0.0, "memory_mb": 0.0, "processes": 0,
+            "limits": self.resource_limits, "enforcement": None
+        }
+
+    async def fetch_usage(self) -> Dict:
+        try:
+            self._usage = await self._request("usage", timeout=5.0)
+        except (BrokerError, asyncio.TimeoutError) as e:
+            logger.warning(f"Broker usage error: {e}")
+        return self.get_usage()
+
+    async def _disconnect(self):
+        self._connected = False
+        if self._receiver_task:
+            self._receiver_task.cancel()
+            self._receiver_task = None
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+        self._close_subscribers()
+
+    async def cleanup(self, timeout: float = TERMINAL_KILL_TIMEOUT):
+        """ブローカー上のターミナルを終了して切断"""
+        self.scrollback.clear()
+        self._close_subscribers()
+        self._held = []
+        self._paused = False
+        try:
+            await self._request("terminate", timeout=BROKER_REQUEST_TIMEOUT, timeout_seconds=timeout)
+        except (BrokerError, asyncio.TimeoutError, ConnectionError) as e:
+            logger.warning(f"Broker terminate error: {e}")
+        await self._disconnect()
+
+    async def shutdown(self):
+        """切断のみ行う（ターミナルはブローカー上で動き続ける）"""
+        self.scrollback.clear()
+        await self._disconnect()
+
+async def serve(path: str):
+    """シグナルを受けるまでブローカーを動かす"""
+    broker = PTYBroker(path)
+    await broker.start()
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopped.set)
+    await stopped.wait()
+    logger.info("PTY broker stopping")
+    await broker.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="ターミナルのシェルを所有するPTYブローカー")
+    parser.add_argument("--socket", default=TERMINAL_BROKER_SOCKET, help="待ち受けるUnixソケット（既定: TERMINAL_BROKER_SOCKET）")
+    args = parser.parse_args()
+    if not args.socket:
+        parser.error("--socket または TERMINAL_BROKER_SOCKET を指定してください")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve(args.socket))
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,7 @@ Claude Code統合のAPIルーター
 """
 
 from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
@@ -12,7 +12,8 @@ from ..database import get_db
 from ..auth import get_current_active_user
 from ..models import User, Session as SessionModel
 from ..schemas import APIResponse
-from ..claude_integration import ClaudeIntegration
+from ..claude_integration import ClaudeIntegration, claude_capabilities
+from ..claude_scheduler import claude_scheduler, get_user_plan_type
 
 # Claude統合インスタンス
 claude_integration = ClaudeIntegration()
@@ -153,10 +154,15 @@ async def send_message_to_claude(
                 detail="Claude セッションが見つかりません。先にセッションを開始してください。"
             )
         
+        user_id = str(current_user.id)
+        plan_type = get_user_plan_type(db, current_user)
+        
         if request.stream:
             # ストリーミング応答
             async def stream_response():
-                async for chunk in claude_integration.send_message_stream(request.message, session_id):
+                async for chunk in claude_integration.send_message_stream(
+                    request.message, session_id, user_id, plan_type
+                ):
                     yield f"data: {chunk}\n\n"
                 yield "data: [DONE]\n\n"
             
@@ -167,7 +173,7 @@ async def send_message_to_claude(
             )
         else:
             # 通常の応答
-            response = await claude_integration.send_message(request.message, session_id)
+            response = await claude_integration.send_message(request.message, session_id, user_id, plan_type)
             
             return {
                 "message": "メッセージを送信しました",
@@ -187,10 +193,13 @@ async def send_message_to_claude(
 @router.get("/sessions/{session_id}/messages")
 async def get_claude_messages(
     session_id: str,
+    limit: int = Query(50, ge=1, le=200),
+    before: Optional[int] = Query(None, description="このIDより古いメッセージを取得（next_cursor を指定）"),
+    after: Optional[int] = Query(None, description="このIDより新しいメッセージを取得"),
     current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
-    """Claude セッションのメッセージ履歴を取得"""
+    """Claude セッションのメッセージ履歴を取得（新しいものからページ単位）"""
     # セッションの存在確認
     session = db.query(SessionModel).filter(
         SessionModel.session_id == session_id,
@@ -205,13 +214,12 @@ async def get_claude_messages(
     
     try:
         # Claude セッションのメッセージ履歴を取得
-        messages = await claude_integration.get_session_history(session_id)
-        if not messages:
-            return {"messages": [], "total": 0}
+        page = await claude_integration.get_session_history_page(session_id, before, after, limit)
+        if not page:
+            return {"messages": [], "total": 0, "has_more": False, "next_cursor": None, "session_id": session_id}
         
         return {
-            "messages": messages,
-            "total": len(messages),
+            **page,
             "session_id": session_id
         }
     
@@ -283,4 +291,33 @@ async def cleanup_claude_sessions(
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"セッションクリーンアップエラー: {str(e)}"
-        )
\ No newline at end of file
+        )
+
+@router.get("/scheduler")
+async def get_claude_scheduler_stats(
+    current_user: User = Depends(get_current_active_user)
+):
+    """Claudeリクエストのスケジューラーの状態（実行数・待機数・待ち時間）を取得"""
+    return claude_scheduler.get_stats()
+
+@router.get("/capabilities")
+async def get_claude_capabilities(
+    current_user: User = Depends(get_current_active_user)
+):
+    """Claude Code SDK/CLIの利用可否と使用中のモードを取得"""
+    capabilities = await claude_capabilities.get()
+    return capabilities.to_dict()
+
+@router.post("/capabilities/refresh")
+async def refresh_claude_capabilities(
+    current_user: User = Depends(get_current_active_user)
+):
+    """Claude Code SDK/CLIの利用可否を確認し直す（管理者のみ）"""
+    if not current_user.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="管理者権限が必要です"
+        )
+    
+    capabilities = await claude_capabilities.refresh()
+    return capabilities.to_dict()
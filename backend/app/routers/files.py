@@ -25,22 +25,27 @@ router = APIRouter(prefix="/api/files", tags=["files"])
 
 # ファイル変更監視ハンドラー
 class FileChangeHandler(FileSystemEventHandler):
-    def __init__(self, session_id: str):
+    def __init__(self, session_id: str, loop: asyncio.AbstractEventLoop):
         self.session_id = session_id
+        # watchdogのコールバックは監視スレッドで呼ばれるため、イベントループに処理を渡す
+        self.loop = loop
         super().__init__()
     
+    def _dispatch_to_loop(self, *args):
+        asyncio.run_coroutine_threadsafe(self._notify_file_change(*args), self.loop)
+    
     def on_modified(self, event):
         if not event.is_directory:
-            asyncio.create_task(self._notify_file_change("modified", event.src_path))
+            self._dispatch_to_loop("modified", event.src_path)
     
     def on_created(self, event):
-        asyncio.create_task(self._notify_file_change("created", event.src_path))
+        self._dispatch_to_loop("created", event.src_path)
     
     def on_deleted(self, event):
-        asyncio.create_task(self._notify_file_change("deleted", event.src_path))
+        self._dispatch_to_loop("deleted", event.src_path)
     
     def on_moved(self, event):
-        asyncio.create_task(self._notify_file_change("moved", event.dest_path, event.src_path))
+        self._dispatch_to_loop("moved", event.dest_path, event.src_path)
     
     async def _notify_file_change(self, event_type: str, file_path: str, old_path: str = None):
         """ファイル変更をWebSocket経由で通知"""
@@ -473,7 +478,7 @@ async def start_file_watching(
     
     # 新しい監視を開始
     try:
-        event_handler = FileChangeHandler(session_id)
+        event_handler = FileChangeHandler(session_id, asyncio.get_running_loop())
         observer = Observer()
         observer.schedule(event_handler, session.working_directory, recursive=True)
         observer.start()
@@ -8,13 +8,16 @@ from datetime import datetime
 from typing import List
 from pathlib import Path
 from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy import or_
 from sqlalchemy.orm import Session
 
 from ..database import get_db
 from ..auth import get_current_active_user
-from ..models import User, Session as SessionModel
+from ..models import User, Session as SessionModel, ClaudeMessage
 from ..schemas import Session as SessionSchema, SessionCreate, SessionUpdate, SessionList, APIResponse, MessageRequest, MessageResponse, MessageHistory
 from ..claude_integration import claude_manager
+from ..chat_history import chat_history
+from ..websocket_manager import manager
 
 router = APIRouter(prefix="/sessions", tags=["セッション管理"])
 
@@ -182,6 +185,18 @@ async def delete_session(
         # Claude セッションの削除に失敗してもDBから削除は続行
         pass
     
+    # セッションイベントのリプレイバッファを破棄
+    manager.event_bus.drop_session(session.session_id)
+    manager.stream_bus.drop_session(session.session_id)
+    
+    # メッセージ履歴も削除（書き込み待ちの分を先に書き込んでから消す）
+    # ターミナルのClaudeセッションの履歴は "<セッションID>_<ターミナルタイプ>" で保存されている
+    await chat_history.flush()
+    db.query(ClaudeMessage).filter(or_(
+        ClaudeMessage.session_id == session.session_id,
+        ClaudeMessage.session_id.startswith(f"{session.session_id}_", autoescape=True)
+    )).delete(synchronize_session=False)
+    
     db.delete(session)
     db.commit()
     
@@ -5,8 +5,9 @@ Terminal WebSocket 接続のAPIルーター
 
 import asyncio
 import logging
-from typing import Dict
+from typing import Dict, Optional
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, status, Query
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 
 from ..database import get_db
@@ -18,8 +19,14 @@ from ..terminal_managers import (
     get_active_terminal, 
     set_active_terminal, 
     remove_active_terminal,
+    remove_active_terminals,
     ClaudeTerminalManager
 )
+from ..terminal_recording import get_recording_info, replay_recording
+from ..websocket_protocol import (
+    TerminalControl, TerminalProtocol, encode_terminal_control, negotiate_terminal_protocol,
+    parse_terminal_control
+)
 
 router = APIRouter(prefix="/terminal", tags=["Terminal"])
 logger = logging.getLogger(__name__)
@@ -53,10 +60,21 @@ async def websocket_terminal(
     websocket: WebSocket,
     session_id: str,
     terminal_type: str = Query(default="basic", description="Terminal type: basic or claude"),
+    readonly: bool = Query(default=False, description="Attach as a read-only viewer"),
     db: Session = Depends(get_db)
 ):
-    """Terminal WebSocket接続"""
-    await websocket.accept()
+    """Terminal WebSocket接続
+
+    Sec-WebSocket-Protocol で "terminal.binary.v1" を提示すると、
+    ターミナル出力をUTF-8のバイナリフレームで受け取る（提示なしはテキストフレーム）。
+    同じターミナルに複数の接続が同時に購読でき、readonly=true の接続からの
+    入力は無視される。
+    
+    入力はテキストフレーム・バイナリフレームのどちらでも送れる。"\\x00" で
+    始まるテキストフレームは制御メッセージ（resize・signal）として扱う。
+    """
+    protocol = negotiate_terminal_protocol(websocket)
+    await websocket.accept(subprotocol=protocol)
     
     try:
         logger.info(f"Terminal WebSocket接続試行: session_id={session_id}, terminal_type={terminal_type}")
@@ -91,18 +109,25 @@ async def websocket_terminal(
         terminal_session_id = f"{session_id}_{terminal_type}"
         
         # 既存のターミナルセッションがあるかチェック
-        if has_active_terminal(terminal_session_id):
+        terminal = get_active_terminal(terminal_session_id)
+        if terminal and terminal.closed:
+            # シェルが終了済み、またはブローカーとの接続が切れているので作り直す
+            logger.info(f"Terminal session closed, recreating: {terminal_session_id}")
+            await remove_active_terminal(terminal_session_id)
+            terminal = None
+        if terminal:
             # 既存セッションを使用
-            terminal = get_active_terminal(terminal_session_id)
             await websocket.send_text(f"Terminal reconnected to existing {terminal_type} session: {session.name}\n")
             logger.info(f"Terminal session restored: {terminal_session_id}")
+            reconnected = True
         else:
             # 新しいターミナルマネージャーを作成
             working_dir = session.working_directory or "/tmp"
             terminal = get_terminal_manager(
                 session_id=terminal_session_id,
                 terminal_type=terminal_type,
-                working_directory=working_dir
+                working_directory=working_dir,
+                resource_limits=session.resource_limits
             )
             
             # ターミナルを開始
@@ -112,15 +137,33 @@ async def websocket_terminal(
             # 初期メッセージを送信
             terminal_name = "Claude統合" if terminal_type == "claude" else "基本"
             await websocket.send_text(f"{terminal_name}ターミナルに接続しました: {session.name}\n")
+            reconnected = False
+        
+        async def send_output(output: str):
+            if protocol == TerminalProtocol.BINARY:
+                await websocket.send_bytes(output.encode('utf-8'))
+            else:
+                await websocket.send_text(output)
+        
+        # 切断中の出力を含むスクロールバックを再送してから以降の出力を受け取る
+        subscription = terminal.subscribe(readonly=readonly)
+        if subscription.scrollback:
+            await send_output(subscription.scrollback)
+        if reconnected:
+            logger.info(f"Terminal scrollback replayed: {terminal_session_id}, {len(subscription.scrollback)} chars")
         
         # 出力読み取りタスクを開始
         async def read_terminal_output():
             while True:
                 try:
-                    output = await terminal.read_output()
-                    if output:
-                        await websocket.send_text(output)
-                    await asyncio.sleep(0.01)  # 10ms間隔
+                    # 出力が届くまで待機（PTYの読み取りはターミナルごとに単一のリーダーが行う）
+                    output = await subscription.get()
+                    if output is None:
+                        if subscription.overflowed:
+                            # 出力に追いつけなかった。再接続するとスクロールバックから再開できる
+                            await websocket.close(code=1013, reason="出力に追いつけませんでした")
+                        break  # シェルが終了した
+                    await send_output(output)
                 except WebSocketDisconnect:
                     break
                 except Exception as e:
@@ -133,8 +176,26 @@ async def websocket_terminal(
         try:
             # 入力を処理
             while True:
-                data = await websocket.receive_text()
-                await terminal.write_input(data)
+                frame = await websocket.receive()
+                if frame["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(frame.get("code", 1000))
+                if frame.get("bytes") is not None:
+                    data = frame["bytes"]
+                else:
+                    data = frame.get("text") or ""
+                    try:
+                        control = parse_terminal_control(data)
+                    except ValueError as e:
+                        await websocket.send_text(encode_terminal_control({"type": TerminalControl.ERROR, "message": str(e)}))
+                        continue
+                    if control is not None:
+                        error = handle_terminal_control(terminal, control, subscription.readonly)
+                        if error:
+                            await websocket.send_text(encode_terminal_control({"type": TerminalControl.ERROR, "message": error}))
+                        continue
+                if not subscription.readonly:
+                    # 書き込み待ちが多い間はこの接続の受信だけが待たされる
+                    await terminal.write_input(data)
         
         except WebSocketDisconnect:
             print(f"Terminal WebSocket disconnected: {session_id}")
@@ -142,6 +203,7 @@ async def websocket_terminal(
         finally:
             # クリーンアップ（ただし、ターミナルプロセスは保持）
             output_task.cancel()
+            terminal.unsubscribe(subscription)
             # WebSocket切断時もターミナルプロセスは継続実行
             logger.info(f"Terminal WebSocket disconnected but session preserved: {session_id}")
     
@@ -150,6 +212,21 @@ async def websocket_terminal(
         await websocket.send_text(f"ERROR: {str(e)}")
         await websocket.close()
 
+def handle_terminal_control(terminal, control: dict, readonly: bool) -> Optional[str]:
+    """制御メッセージを処理し、エラーがあればメッセージを返す"""
+    if readonly:
+        return "閲覧専用の接続では操作できません"
+    try:
+        if control["type"] == TerminalControl.RESIZE:
+            terminal.resize(int(control["rows"]), int(control["cols"]))
+        elif control["type"] == TerminalControl.SIGNAL:
+            terminal.send_signal(str(control["signal"]))
+        else:
+            return f"不明な制御メッセージです: {control['type']}"
+    except (KeyError, TypeError, ValueError) as e:
+        return f"制御メッセージが不正です: {e}"
+    return None
+
 @router.get("/{session_id}/status")
 async def get_terminal_status(
     session_id: str,
@@ -179,9 +256,79 @@ async def get_terminal_status(
         "terminal_type": terminal_type,
         "connected": is_connected,
         "status": "active" if is_connected else "inactive",
-        "manager_type": terminal.__class__.__name__ if terminal else None
+        "manager_type": terminal.__class__.__name__ if terminal else None,
+        "subscribers": len(terminal.subscribers) if terminal else 0,
+        "pending_input_bytes": terminal.get_pending_input() if terminal else 0,
+        "idle_ttl": terminal.get_idle_ttl() if terminal else None,
+        "usage": await terminal.fetch_usage() if terminal else None
     }
 
+def _get_owned_session(session_id: str, current_user: User, db: Session) -> SessionModel:
+    session = db.query(SessionModel).filter(
+        SessionModel.session_id == session_id,
+        SessionModel.user_id == current_user.id
+    ).first()
+    if not session:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="セッションが見つかりません"
+        )
+    return session
+
+async def _flush_recording(terminal_session_id: str):
+    """動作中のターミナルの未書き出しのイベントを記録に反映"""
+    terminal = get_active_terminal(terminal_session_id)
+    if terminal and terminal.recorder:
+        await terminal.recorder.flush()
+
+@router.get("/{session_id}/recording")
+async def get_terminal_recording(
+    session_id: str,
+    terminal_type: str = Query(default="basic", description="Terminal type: basic or claude"),
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    """ターミナルの記録の概要（記録されている経過時間の範囲など）を取得"""
+    _get_owned_session(session_id, current_user, db)
+    terminal_session_id = f"{session_id}_{terminal_type}"
+    await _flush_recording(terminal_session_id)
+    
+    info = await get_recording_info(terminal_session_id)
+    if info is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="記録が見つかりません"
+        )
+    return {"terminal_session_id": terminal_session_id, **info}
+
+@router.get("/{session_id}/recording/replay")
+async def replay_terminal_recording(
+    session_id: str,
+    terminal_type: str = Query(default="basic", description="Terminal type: basic or claude"),
+    start: float = Query(default=0.0, ge=0, description="再生を始める経過時間（秒）"),
+    duration: Optional[float] = Query(default=None, gt=0, description="再生する長さ（秒、省略時は最後まで）"),
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    """ターミナルの記録を asciicast v2 形式でストリーミング
+    
+    経過時間 start から duration 秒分のイベントを返す（時刻は start を0とする）。
+    """
+    _get_owned_session(session_id, current_user, db)
+    terminal_session_id = f"{session_id}_{terminal_type}"
+    await _flush_recording(terminal_session_id)
+    
+    if await get_recording_info(terminal_session_id) is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="記録が見つかりません"
+        )
+    end = start + duration if duration is not None else None
+    return StreamingResponse(
+        replay_recording(terminal_session_id, start, end),
+        media_type="application/x-asciicast"
+    )
+
 @router.delete("/{session_id}")
 async def terminate_terminal_session(
     session_id: str,
@@ -204,17 +351,14 @@ async def terminate_terminal_session(
     terminated_sessions = []
     
     if terminal_type == "all":
-        # 全てのターミナルタイプを終了
-        for t_type in ["basic", "claude"]:
-            terminal_session_id = f"{session_id}_{t_type}"
-            if has_active_terminal(terminal_session_id):
-                remove_active_terminal(terminal_session_id)
-                terminated_sessions.append(terminal_session_id)
+        # 全てのターミナルタイプを並行して終了
+        terminated_sessions = await remove_active_terminals(
+            [f"{session_id}_{t_type}" for t_type in ["basic", "claude"]]
+        )
     else:
         # 指定されたタイプのみ終了
         terminal_session_id = f"{session_id}_{terminal_type}"
-        if has_active_terminal(terminal_session_id):
-            remove_active_terminal(terminal_session_id)
+        if await remove_active_terminal(terminal_session_id):
             terminated_sessions.append(terminal_session_id)
     
     if terminated_sessions:
@@ -5,14 +5,18 @@ WebSocketルーター
 
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, status
 from fastapi.security import HTTPBearer
-from typing import Optional
-import json
+from typing import Awaitable, Callable, Dict, List, Optional
+import asyncio
 import logging
+import os
+import uuid
 from datetime import datetime
 
 from ..websocket_manager import manager, MessageType, WebSocketMessage
+from ..websocket_protocol import negotiate_codec, receive_message
 from ..auth import get_current_user_ws
 from ..claude_integration import ClaudeIntegration
+from ..claude_scheduler import claude_scheduler, get_user_plan_type
 from ..database import get_db
 from ..models import User, Session
 from sqlalchemy.orm import Session as DBSession
@@ -22,6 +26,75 @@ security = HTTPBearer()
 
 router = APIRouter()
 
+# ストリーミング応答のチャンクをまとめて送信する間隔（秒）。0でチャンクごとに送信
+STREAM_FLUSH_INTERVAL = float(os.getenv("STREAM_FLUSH_INTERVAL", "0.03"))
+# このバイト数（UTF-8）に達したら間隔を待たずに送信
+STREAM_FLUSH_SIZE = int(os.getenv("STREAM_FLUSH_SIZE", "4096"))
+
+class StreamBatcher:
+    """
+ストリーミングチャンクを時間・サイズでまとめて送信するバッファ
+
+最初のチャンクは即座に送信し、以降は flush_interval ごと、または
+flush_size バイト（UTF-8）に達した時点でまとめて送信する。応答全文はリストに
+蓄積し、text で一度だけ連結する。
+    """
+    
+    def __init__(
+        self,
+        send: Callable[[str], Awaitable[None]],
+        flush_interval: float = STREAM_FLUSH_INTERVAL,
+        flush_size: int = STREAM_FLUSH_SIZE
+    ):
+        self.send = send
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.parts: List[str] = []
+        self.pending: List[str] = []
+        self.pending_size = 0
+        self.flush_count = 0
+        self._timer: Optional[asyncio.Task] = None
+        
+    async def add(self, chunk: str):
+        """チャンクを追加し、必要であれば送信"""
+        if not chunk:
+            return
+        self.parts.append(chunk)
+        self.pending.append(chunk)
+        self.pending_size += len(chunk.encode("utf-8"))
+        
+        if self.flush_count == 0 or self.flush_interval <= 0 or self.pending_size >= self.flush_size:
+            await self.flush()
+        elif not self._timer:
+            self._timer = asyncio.create_task(self._flush_later())
+            
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self._timer = None
+        await self.flush()
+        
+    async def flush(self):
+        """保留中のチャンクを送信"""
+        if self._timer and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+        self._timer = None
+        if not self.pending:
+            return
+        chunk = "".join(self.pending)
+        self.pending = []
+        self.pending_size = 0
+        self.flush_count += 1
+        await self.send(chunk)
+        
+    async def close(self):
+        """未送信分を送信してタイマーを停止"""
+        await self.flush()
+        
+    @property
+    def text(self) -> str:
+        """これまでに受け取った応答全文"""
+        return "".join(self.parts)
+
 class ClaudeWebSocketHandler:
     """
 Claude CodeとのWebSocket通信を処理するクラス
@@ -29,9 +102,65 @@ Claude CodeとのWebSocket通信を処理するクラス
     
     def __init__(self):
         self.claude_integration = ClaudeIntegration()
+        # セッションごとの実行中・待機中のチャットタスク（タスク→送信したユーザー）
+        self.chat_tasks: Dict[str, Dict[asyncio.Task, Optional[str]]] = {}
+        # 同一セッションのチャットを受信順に1件ずつ処理するためのロック
+        self.chat_locks: Dict[str, asyncio.Lock] = {}
+        
+    def dispatch_chat_message(self, message: WebSocketMessage, db: DBSession) -> asyncio.Task:
+        """チャットメッセージの処理をタスクとして開始
+        
+        受信ループを止めないよう、応答の生成はセッションごとに追跡される
+        タスクで行う。同一セッションのチャットは受信順に1件ずつ処理する。
+        db はリクエスト（接続）のセッションのため、必要な読み取りはタスクを
+        作る前にここで済ませ、タスクからは使わない。
+        """
+        session_id = message.session_id
+        lock = self.chat_locks.setdefault(session_id, asyncio.Lock())
+        plan_type = self._get_plan_type(db, message.user_id)
         
-    async def handle_chat_message(self, message: WebSocketMessage, db: DBSession):
-        """チャットメッセージを処理"""
+        async def run():
+            async with lock:
+                await self.handle_chat_message(message, plan_type)
+        
+        task = asyncio.create_task(run())
+        self.chat_tasks.setdefault(session_id, {})[task] = message.user_id
+        task.add_done_callback(lambda done: self._forget_chat_task(session_id, done))
+        return task
+        
+    def _forget_chat_task(self, session_id: str, task: asyncio.Task):
+        """完了したチャットタスクを追跡から外す"""
+        tasks = self.chat_tasks.get(session_id)
+        if tasks is None:
+            return
+        tasks.pop(task, None)
+        if not tasks:
+            del self.chat_tasks[session_id]
+            self.chat_locks.pop(session_id, None)
+        
+    def cancel_chat(self, session_id: str, user_id: Optional[str]) -> int:
+        """ユーザーがセッションで送信した実行中・待機中のチャットを中止し、中止したタスク数を返す
+        
+        同じセッションの他のユーザーのチャットは中止しない。
+        タスクのキャンセルは Claude Code SDK/CLI の呼び出しまで伝播し、
+        CLIのサブプロセスも終了される。
+        """
+        tasks = [
+            task for task, owner in self.chat_tasks.get(session_id, {}).items()
+            if owner == user_id and not task.done()
+        ]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            logger.info(f"チャット応答を中止しました: session_id={session_id}, user_id={user_id}, tasks={len(tasks)}")
+        return len(tasks)
+        
+    def get_chat_task_count(self) -> int:
+        """実行中・待機中のチャットタスク数を取得"""
+        return sum(len(tasks) for tasks in self.chat_tasks.values())
+        
+    async def handle_chat_message(self, message: WebSocketMessage, plan_type: Optional[str] = None):
+        """チャットメッセージを処理（plan_type はスケジューラーの重み付けに使うプラン）"""
         try:
             user_message = message.data.get("message", "")
             stream = message.data.get("stream", True)  # デフォルトでストリーミング
@@ -51,13 +180,15 @@ Claude CodeとのWebSocket通信を処理するクラス
                 user_id=message.user_id,
                 session_id=message.session_id
             )
-            await manager.broadcast_to_session(user_msg.to_dict(), message.session_id)
+            await manager.broadcast_chat(user_msg.to_dict(), message.session_id)
             
             # Claude Code統合でストリーミング応答を処理
             if stream:
-                await self._handle_claude_streaming(user_message, message.session_id)
+                await self._handle_claude_streaming(user_message, message.session_id, message.user_id, plan_type)
             else:
-                claude_response = await self._get_claude_response(user_message, message.session_id)
+                claude_response = await self._get_claude_response(
+                    user_message, message.session_id, message.user_id, plan_type
+                )
                 # Claudeのレスポンスをセッション内にブロードキャスト
                 claude_msg = WebSocketMessage(
                     MessageType.CHAT,
@@ -69,7 +200,7 @@ Claude CodeとのWebSocket通信を処理するクラス
                     },
                     session_id=message.session_id
                 )
-                await manager.broadcast_to_session(claude_msg.to_dict(), message.session_id)
+                await manager.broadcast_chat(claude_msg.to_dict(), message.session_id)
             
         except Exception as e:
             logger.error(f"チャットメッセージ処理エラー: {e}")
@@ -78,7 +209,7 @@ Claude CodeとのWebSocket通信を処理するクラス
                 {"error": f"メッセージの処理中にエラーが発生しました: {str(e)}"},
                 session_id=message.session_id
             )
-            await manager.broadcast_to_session(error_msg.to_dict(), message.session_id)
+            await manager.broadcast_chat(error_msg.to_dict(), message.session_id)
             
     async def handle_terminal_message(self, message: WebSocketMessage, db: DBSession):
         """ターミナルメッセージを処理"""
@@ -112,41 +243,84 @@ Claude CodeとのWebSocket通信を処理するクラス
             )
             await manager.broadcast_to_session(error_msg.to_dict(), message.session_id)
             
-    async def _get_claude_response(self, message: str, session_id: str) -> str:
+    def _get_plan_type(self, db: DBSession, user_id: Optional[str]) -> Optional[str]:
+        """スケジューラーの重み付けに使うユーザーのプラン"""
+        if db is None or not user_id:
+            return None
+        try:
+            user = db.query(User).filter(User.id == int(user_id)).first()
+            return get_user_plan_type(db, user) if user else None
+        except Exception as e:
+            logger.warning(f"プランの取得に失敗しました: user_id={user_id}, {e}")
+            return None
+    
+    async def _get_claude_response(
+        self, message: str, session_id: str, user_id: Optional[str] = None, plan_type: Optional[str] = None
+    ) -> str:
         """Claude Codeからレスポンスを取得"""
         try:
-            response = await self.claude_integration.send_message(message, session_id)
+            response = await self.claude_integration.send_message(message, session_id, user_id, plan_type)
             return response
         except Exception as e:
             logger.error(f"Claude応答取得エラー: {e}")
             return f"エラー: Claude Code統合でエラーが発生しました - {str(e)}"
     
-    async def _handle_claude_streaming(self, message: str, session_id: str):
-        """Claude Codeからのストリーミング応答を処理"""
+    async def _handle_claude_streaming(
+        self, message: str, session_id: str, user_id: Optional[str] = None, plan_type: Optional[str] = None
+    ):
+        """Claude Codeからのストリーミング応答を処理
+        
+        応答ごとに stream_id を振り、チャンクは連番付きでセッションの
+        チャットストリームに記録される。再接続したクライアントは last_seq
+        以降のチャンクを再送されたうえで続きを受信する。
+        実行待ちの間は待ち順を status メッセージで通知する。
+        """
+        stream_id = uuid.uuid4().hex
+        
+        async def report_position(position: int, queue_length: int):
+            queued_msg = WebSocketMessage(
+                MessageType.STATUS,
+                {
+                    "queued": True,
+                    "stream_id": stream_id,
+                    "queue_position": position,
+                    "queue_length": queue_length,
+                    "timestamp": datetime.now().isoformat()
+                },
+                session_id=session_id
+            )
+            await manager.broadcast_to_session(queued_msg.to_dict(), session_id)
+        
+        async def broadcast_chunk(chunk: str):
+            # まとめたチャンクをWebSocketでブロードキャスト
+            stream_msg = WebSocketMessage(
+                MessageType.CHAT,
+                {
+                    "message_chunk": chunk,
+                    "stream_id": stream_id,
+                    "sender": "claude",
+                    "model": "claude-code",
+                    "streaming": True,
+                    "timestamp": datetime.now().isoformat()
+                },
+                session_id=session_id
+            )
+            await manager.broadcast_chat(stream_msg.to_dict(), session_id)
+            
+        batcher = StreamBatcher(broadcast_chunk)
         try:
-            chunk_buffer = ""
-            async for chunk in self.claude_integration.send_message_stream(message, session_id):
-                chunk_buffer += chunk
-                
-                # チャンクをWebSocketでブロードキャスト
-                stream_msg = WebSocketMessage(
-                    MessageType.CHAT,
-                    {
-                        "message_chunk": chunk,
-                        "sender": "claude",
-                        "model": "claude-code",
-                        "streaming": True,
-                        "timestamp": datetime.now().isoformat()
-                    },
-                    session_id=session_id
-                )
-                await manager.broadcast_to_session(stream_msg.to_dict(), session_id)
+            async for chunk in self.claude_integration.send_message_stream(
+                message, session_id, user_id, plan_type, on_position=report_position
+            ):
+                await batcher.add(chunk)
+            await batcher.close()
             
             # ストリーミング完了メッセージ
             complete_msg = WebSocketMessage(
                 MessageType.CHAT,
                 {
-                    "message": chunk_buffer,
+                    "message": batcher.text,
+                    "stream_id": stream_id,
                     "sender": "claude",
                     "model": "claude-code",
                     "streaming": False,
@@ -155,16 +329,40 @@ Claude CodeとのWebSocket通信を処理するクラス
                 },
                 session_id=session_id
             )
-            await manager.broadcast_to_session(complete_msg.to_dict(), session_id)
+            await manager.broadcast_chat(complete_msg.to_dict(), session_id)
             
+        except asyncio.CancelledError:
+            # 中止された場合はそれまでの応答で完了させる
+            await batcher.close()
+            cancelled_msg = WebSocketMessage(
+                MessageType.CHAT,
+                {
+                    "message": batcher.text,
+                    "stream_id": stream_id,
+                    "sender": "claude",
+                    "model": "claude-code",
+                    "streaming": False,
+                    "complete": True,
+                    "cancelled": True,
+                    "timestamp": datetime.now().isoformat()
+                },
+                session_id=session_id
+            )
+            await manager.broadcast_chat(cancelled_msg.to_dict(), session_id)
+            raise
         except Exception as e:
             logger.error(f"Claude ストリーミング処理エラー: {e}")
+            # 受信済みのチャンクを送ってからエラーを通知
+            try:
+                await batcher.close()
+            except Exception:
+                pass
             error_msg = WebSocketMessage(
                 MessageType.ERROR,
                 {"error": f"Claude ストリーミング処理でエラーが発生しました: {str(e)}"},
                 session_id=session_id
             )
-            await manager.broadcast_to_session(error_msg.to_dict(), session_id)
+            await manager.broadcast_chat(error_msg.to_dict(), session_id)
         
     async def _execute_command(self, command: str) -> str:
         """
@@ -181,10 +379,21 @@ async def websocket_endpoint(
     websocket: WebSocket,
     session_id: str,
     token: Optional[str] = None,
+    last_event_seq: Optional[int] = None,
+    last_seq: Optional[int] = None,
     db: DBSession = Depends(get_db)
 ):
     """
 WebSocketエンドポイント
+
+last_event_seq を指定して再接続すると、それ以降のセッションイベントが再送される。
+last_seq を指定すると、それ以降のチャットストリーム（応答チャンクを含む）が
+再送され、応答中であればそのまま続きを受信する。
+Sec-WebSocket-Protocol で "msgpack.v1" / "json.compact.v1" を提示すると
+短縮形式のフレームを使用する（提示なしは従来のJSON）。
+チャットの応答中も受信は続き、{"type": "cancel"} で応答を中止できる。
+サーバーは無通信の接続に {"type": "ping"} を送るため、クライアントは
+{"type": "pong"} を返すこと。応答のない接続は切断される。
     """
     connection_id = None
     user_id = None
@@ -213,11 +422,12 @@ WebSocketエンドポイント
             return  # acceptせずに終了
             
         # すべての検証が通った場合のみWebSocket接続を受け入れ
-        await websocket.accept()
-        logger.info(f"WebSocket接続を受け入れました: session_id={session_id}, user_id={user_id}")
+        codec = negotiate_codec(websocket)
+        await websocket.accept(subprotocol=codec.subprotocol)
+        logger.info(f"WebSocket接続を受け入れました: session_id={session_id}, user_id={user_id}, protocol={codec.name}")
             
         # WebSocket接続を確立
-        connection_id = await manager.connect(websocket, user_id, session_id)
+        connection_id = await manager.connect(websocket, user_id, session_id, codec=codec)
         logger.info(f"WebSocket接続成功: connection_id={connection_id}, user_id={user_id}, session_id={session_id}")
         
         # 接続成功メッセージを送信
@@ -226,6 +436,10 @@ WebSocketエンドポイント
             {
                 "message": f"セッション {session.name} に接続しました",
                 "connection_id": connection_id,
+                "protocol": codec.name,
+                "heartbeat_interval": manager.heartbeat_interval,
+                "last_event_seq": manager.event_bus.get_last_seq(session_id),
+                "last_seq": manager.stream_bus.get_last_seq(session_id),
                 "session_info": {
                     "id": session.id,
                     "name": session.name,
@@ -237,29 +451,73 @@ WebSocketエンドポイント
         )
         await manager.send_personal_message(welcome_msg.to_dict(), connection_id)
         
+        # 切断中に発生したセッションイベントを再送
+        if last_event_seq is not None:
+            complete = await manager.replay_events(connection_id, last_event_seq)
+            if not complete:
+                replay_msg = WebSocketMessage(
+                    MessageType.SYSTEM,
+                    {
+                        "message": "一部のイベントを再送できませんでした。最新の状態を再取得してください",
+                        "replay_incomplete": True
+                    },
+                    user_id=user_id,
+                    session_id=session_id
+                )
+                await manager.send_personal_message(replay_msg.to_dict(), connection_id)
+        
+        # 切断中に配信されたチャットストリームを再送
+        if last_seq is not None:
+            complete = await manager.replay_stream(connection_id, last_seq)
+            if not complete:
+                replay_msg = WebSocketMessage(
+                    MessageType.SYSTEM,
+                    {
+                        "message": "一部のチャット応答を再送できませんでした。履歴を再取得してください",
+                        "stream_replay_incomplete": True
+                    },
+                    user_id=user_id,
+                    session_id=session_id
+                )
+                await manager.send_personal_message(replay_msg.to_dict(), connection_id)
+        
         # メッセージループ
         while True:
             try:
-                data = await websocket.receive_text()
-                message_data = json.loads(data)
+                message_data = await receive_message(websocket, codec)
                 message = WebSocketMessage.from_dict(message_data)
                 message.user_id = user_id
                 message.session_id = session_id
                 
+                # 受信を記録（ping/pongは生存確認のみで操作には数えない）
+                manager.touch(connection_id, activity=message.type not in (MessageType.PING, MessageType.PONG))
+                
                 # メッセージタイプに応じて処理
-                if message.type == MessageType.CHAT:
-                    await websocket_handler.handle_chat_message(message, db)
+                if message.type == MessageType.PONG:
+                    pass
+                elif message.type == MessageType.PING:
+                    pong_msg = WebSocketMessage(
+                        MessageType.PONG,
+                        {"timestamp": datetime.now().isoformat()},
+                        session_id=session_id
+                    )
+                    await manager.send_personal_message(pong_msg.to_dict(), connection_id)
+                elif message.type == MessageType.CHAT:
+                    websocket_handler.dispatch_chat_message(message, db)
+                elif message.type == MessageType.CANCEL:
+                    websocket_handler.cancel_chat(session_id, user_id)
                 elif message.type == MessageType.TERMINAL:
                     await websocket_handler.handle_terminal_message(message, db)
                 else:
                     logger.warning(f"未対応のメッセージタイプ: {message.type}")
                     
-            except json.JSONDecodeError:
+            except ValueError:
                 error_msg = WebSocketMessage(
                     MessageType.ERROR,
-                    {"error": "無効なJSONフォーマットです"},
+                    {"error": "無効なメッセージフォーマットです"},
                     session_id=session_id
                 )
+                manager.touch(connection_id, activity=False)
                 await manager.send_personal_message(error_msg.to_dict(), connection_id)
                 
     except WebSocketDisconnect:
@@ -284,5 +542,12 @@ WebSocketサービスの状態を取得
     return {
         "active_connections": manager.get_connection_count(),
         "active_sessions": manager.get_active_sessions(),
+        "queues": manager.get_queue_stats(),
+        "events": manager.event_bus.get_stats(),
+        "streams": manager.stream_bus.get_stats(),
+        "heartbeat": manager.get_heartbeat_stats(),
+        "chat_tasks": websocket_handler.get_chat_task_count(),
+        "claude_scheduler": claude_scheduler.get_stats(),
+        "worker_id": manager.backplane.worker_id,
         "status": "running"
     }
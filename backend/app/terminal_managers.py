@@ -4,118 +4,905 @@
 """
 
 import asyncio
+import codecs
+import fcntl
 import json
 import logging
 import os
 import pty
-import select
+import shlex
+import signal
+import struct
 import subprocess
+import termios
+import time
 from abc import ABC, abstractmethod
+from collections import deque
 from pathlib import Path
-from typing import Dict, List, Optional, AsyncGenerator
+from typing import ClassVar, Deque, Dict, Iterable, List, Optional, Set, Tuple, AsyncGenerator, Union
 from datetime import datetime
 
 from .claude_integration import ClaudeCodeSession
+from .terminal_recording import TERMINAL_RECORDING, TerminalRecorder
+from .process_limits import (
+    LimitMode, apply_resource_limits, get_resource_usage, remove_cgroup, session_process_groups
+)
 
 logger = logging.getLogger(__name__)
 
+# PTYから一度に読み取るバイト数の下限と上限（出力量に応じて倍増・半減する）
+TERMINAL_READ_SIZE_MIN = int(os.getenv("TERMINAL_READ_SIZE_MIN", "1024"))
+TERMINAL_READ_SIZE_MAX = int(os.getenv("TERMINAL_READ_SIZE_MAX", "65536"))
+# 1フレームにまとめる出力の目安の最大バイト数
+TERMINAL_FRAME_SIZE = int(os.getenv("TERMINAL_FRAME_SIZE", "65536"))
+# 連続する出力をまとめる最大待ち時間（秒）。直前の送信から間が空いていれば即座に送る
+TERMINAL_FRAME_INTERVAL = float(os.getenv("TERMINAL_FRAME_INTERVAL", "0.005"))
+# ターミナルごとに保持するスクロールバックの最大バイト数
+TERMINAL_SCROLLBACK_BYTES = int(os.getenv("TERMINAL_SCROLLBACK_BYTES", str(256 * 1024)))
+# 全ターミナルのスクロールバックの合計の最大バイト数
+TERMINAL_SCROLLBACK_TOTAL_BYTES = int(os.getenv("TERMINAL_SCROLLBACK_TOTAL_BYTES", str(64 * 1024 * 1024)))
+# 購読者ごとに保持する未送信フレーム数の上限
+TERMINAL_SUBSCRIBER_QUEUE = int(os.getenv("TERMINAL_SUBSCRIBER_QUEUE", "64"))
+# 接続も入力もないターミナルを終了するまでの秒数（ターミナルタイプ別、0で無効）
+TERMINAL_IDLE_TTL = {
+    "basic": float(os.getenv("TERMINAL_IDLE_TTL_BASIC", "1800")),
+    "claude": float(os.getenv("TERMINAL_IDLE_TTL_CLAUDE", "3600")),
+}
+# アイドルなターミナルを確認する間隔（秒）
+TERMINAL_REAPER_INTERVAL = float(os.getenv("TERMINAL_REAPER_INTERVAL", "60"))
+# 事前に起動しておくシェルの数（ターミナルタイプ別、既定の0ではプールを使わない）
+TERMINAL_POOL_SIZE = {
+    "basic": int(os.getenv("TERMINAL_POOL_SIZE_BASIC", "0")),
+    "claude": int(os.getenv("TERMINAL_POOL_SIZE_CLAUDE", "0")),
+}
+# プールのシェルの作業ディレクトリ（取得時に各セッションの作業ディレクトリへ移動する）
+TERMINAL_POOL_DIRECTORY = os.getenv("TERMINAL_POOL_DIRECTORY", "/tmp")
+# プールのシェルの初期化を待つ最大秒数
+TERMINAL_POOL_SPAWN_TIMEOUT = float(os.getenv("TERMINAL_POOL_SPAWN_TIMEOUT", "5"))
+# ターミナル終了時、SIGTERMからSIGKILLに切り替えるまでの秒数
+TERMINAL_KILL_TIMEOUT = float(os.getenv("TERMINAL_KILL_TIMEOUT", "3"))
+# ターミナルごとに書き込み待ちにできる入力の最大バイト数（超えると送信元を待たせる）
+TERMINAL_INPUT_BUFFER_BYTES = int(os.getenv("TERMINAL_INPUT_BUFFER_BYTES", str(1024 * 1024)))
+# 起動時のウィンドウサイズ（クライアントから resize が届くまで使用）
+DEFAULT_WINDOW_SIZE = (24, 80)
+# ウィンドウサイズの上限（行・列）
+MAX_WINDOW_SIZE = 1000
+# クライアントから送れるシグナル（フォアグラウンドのプロセスグループに送る）
+TERMINAL_SIGNALS = {
+    "SIGINT": signal.SIGINT,
+    "SIGQUIT": signal.SIGQUIT,
+    "SIGTSTP": signal.SIGTSTP,
+    "SIGCONT": signal.SIGCONT,
+    "SIGTERM": signal.SIGTERM,
+    "SIGKILL": signal.SIGKILL,
+}
+# PTYブローカーのUnixソケット（設定するとシェルはブローカーで動かし、各ワーカーはそのクライアントになる）
+TERMINAL_BROKER_SOCKET = os.getenv("TERMINAL_BROKER_SOCKET", "")
+# プロセスの終了を確認する間隔（秒）
+TERMINATE_POLL_INTERVAL = 0.02
+# SIGKILL後にシェルの回収を待つ最大秒数
+REAP_TIMEOUT = 1.0
+
+class ScrollbackBuffer:
+    """バイト数上限付きのスクロールバック（リングバッファ）
+    
+    ターミナルごとの上限 max_bytes に加え、全インスタンスの合計が
+    TERMINAL_SCROLLBACK_TOTAL_BYTES を超えた場合は、合計が収まるまで
+    その時点で最も大きいバッファから古い出力を捨てる。
+    """
+    
+    _instances: ClassVar[Set["ScrollbackBuffer"]] = set()
+    total_bytes: ClassVar[int] = 0
+    
+    def __init__(self, max_bytes: int = TERMINAL_SCROLLBACK_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._chunks: Deque[Tuple[str, int]] = deque()
+        ScrollbackBuffer._instances.add(self)
+    
+    def append(self, text: str):
+        """出力を追加し、上限を超えた分を古い順に捨てる"""
+        size = len(text.encode("utf-8"))
+        self._chunks.append((text, size))
+        self._resize(size)
+        self._trim(self.max_bytes)
+        
+        # 最も大きいバッファだけでは足りない場合は、次に大きいものからも捨てる
+        while ScrollbackBuffer.total_bytes > TERMINAL_SCROLLBACK_TOTAL_BYTES:
+            excess = ScrollbackBuffer.total_bytes - TERMINAL_SCROLLBACK_TOTAL_BYTES
+            largest = max(ScrollbackBuffer._instances, key=lambda buffer: buffer.size)
+            if largest.size == 0:
+                break
+            largest._trim(max(largest.size - excess, 0))
+    
+    def _resize(self, delta: int):
+        self.size += delta
+        ScrollbackBuffer.total_bytes += delta
+    
+    def _trim(self, limit: int):
+        """合計が limit バイト以下になるまで古い出力を捨てる"""
+        while self.size > limit and self._chunks:
+            text, size = self._chunks[0]
+            excess = self.size - limit
+            if size <= excess:
+                self._chunks.popleft()
+                self._resize(-size)
+                continue
+            # 先頭のチャンクの一部だけを捨てる（途中で切れた文字は除く）
+            rest = text.encode("utf-8")[excess:].decode("utf-8", errors="ignore")
+            rest_size = len(rest.encode("utf-8"))
+            self._chunks[0] = (rest, rest_size)
+            self._resize(rest_size - size)
+    
+    def snapshot(self) -> str:
+        """保持している出力を連結して返す"""
+        return "".join(text for text, _ in self._chunks)
+    
+    def clear(self):
+        """出力を破棄し、合計から除外"""
+        self._chunks.clear()
+        self._resize(-self.size)
+        ScrollbackBuffer._instances.discard(self)
+
+class TerminalSubscription:
+    """ターミナル出力の購読
+    
+    購読者ごとに有界のフレームキューを持つ。get() はシェル終了時、購読解除時、
+    またはキューがあふれて購読が打ち切られた場合（overflowed）に None を返す。
+    """
+    
+    def __init__(self, terminal: "BaseTerminalManager", scrollback: str, maxsize: int, readonly: bool = False):
+        self.terminal = terminal
+        self.scrollback = scrollback
+        self.maxsize = maxsize
+        self.readonly = readonly
+        self.queue: Deque[str] = deque()
+        self.closed = False
+        self.overflowed = False
+        self._ready = asyncio.Event()
+    
+    def full(self) -> bool:
+        return len(self.queue) >= self.maxsize
+    
+    def put(self, frame: str) -> bool:
+        """フレームを追加。キューがあふれた場合は False を返す"""
+        if self.closed:
+            return True
+        if self.full():
+            return False
+        self.queue.append(frame)
+        self._ready.set()
+        return True
+    
+    def close(self, overflowed: bool = False):
+        self.closed = True
+        self.overflowed = self.overflowed or overflowed
+        self._ready.set()
+    
+    async def get(self) -> Optional[str]:
+        """次のフレームを待機して取得"""
+        while not self.queue:
+            if self.closed:
+                return None
+            self._ready.clear()
+            await self._ready.wait()
+        frame = self.queue.popleft()
+        self.terminal._on_subscriber_drained(self)
+        return frame
+
+def set_window_size(fd: int, rows: int, cols: int):
+    """端末のウィンドウサイズを設定（フォアグラウンドのプロセスには SIGWINCH が届く）"""
+    fcntl.ioctl(fd, termios.TIOCSWINSZ, struct.pack("HHHH", rows, cols, 0, 0))
+
+def spawn_shell(working_directory: str, environment: Optional[Dict[str, str]] = None) -> Tuple[int, subprocess.Popen]:
+    """PTY上でbashを起動し、マスター端とプロセスを返す
+    
+    シェルは新しいセッション（プロセスグループ）で起動する。
+    親プロセス側のスレーブ端は起動後に閉じる。
+    """
+    env = os.environ.copy()
+    if environment:
+        env.update(environment)
+    master_fd, slave_fd = pty.openpty()
+    try:
+        set_window_size(slave_fd, *DEFAULT_WINDOW_SIZE)
+        process = subprocess.Popen(
+            ['/bin/bash'],
+            stdin=slave_fd,
+            stdout=slave_fd,
+            stderr=slave_fd,
+            cwd=working_directory,
+            env=env,
+            preexec_fn=os.setsid
+        )
+    except Exception:
+        os.close(master_fd)
+        raise
+    finally:
+        os.close(slave_fd)
+    return master_fd, process
+
+def _signal_groups(groups: Set[int], sig: int):
+    for pgid in groups:
+        try:
+            os.killpg(pgid, sig)
+        except ProcessLookupError:
+            pass
+
+def _groups_alive(groups: Set[int]) -> bool:
+    """プロセスグループのいずれかにまだプロセスが残っているか"""
+    for pgid in groups:
+        try:
+            os.killpg(pgid, 0)
+            return True
+        except ProcessLookupError:
+            continue
+        except PermissionError:
+            return True
+    return False
+
+async def terminate_process_group(process: subprocess.Popen, timeout: float = TERMINAL_KILL_TIMEOUT) -> Optional[int]:
+    """シェルのプロセスグループ全体を終了し、シェルを回収する
+    
+    シェルは setsid で起動しているため、セッション内のすべてのグループ
+    （ジョブ制御で分かれたジョブを含む）に、端末を閉じたときと同じ SIGHUP と
+    SIGTERM を送る。timeout 秒以内に終了しなければ SIGKILL を送る。
+    待機はイベントループを止めずに行い、シェルの終了コードを返す
+    （回収できなければ None）。
+    """
+    sid = process.pid  # setsid で起動しているため pid == sid == pgid
+    loop = asyncio.get_running_loop()
+    
+    groups = session_process_groups(sid)
+    _signal_groups(groups, signal.SIGHUP)
+    _signal_groups(groups, signal.SIGTERM)
+    deadline = loop.time() + timeout
+    while True:
+        process.poll()  # シェルがゾンビのままだとグループが残って見えるため先に回収
+        if not _groups_alive(groups):
+            break
+        if loop.time() >= deadline:
+            logger.warning(f"Terminal processes of {sid} did not exit in {timeout}s, sending SIGKILL")
+            _signal_groups(groups | session_process_groups(sid), signal.SIGKILL)
+            break
+        await asyncio.sleep(TERMINATE_POLL_INTERVAL)
+    
+    deadline = loop.time() + REAP_TIMEOUT
+    while process.poll() is None and loop.time() < deadline:
+        await asyncio.sleep(TERMINATE_POLL_INTERVAL)
+    return process.returncode
+
+def retarget_command(working_directory: str, prompt: str, environment: Optional[Dict[str, str]] = None) -> str:
+    """プールのシェルをセッション用に切り替えるコマンド
+    
+    エコーを止めた状態で入力されるため画面には表示されず、最後に
+    エコーを戻して画面を消去する。先頭の空白は HISTCONTROL=ignorespace で
+    履歴に残さないため。
+    """
+    exports = "".join(
+        f"export {key}={shlex.quote(value)}; "
+        for key, value in (environment or {}).items() if key.isidentifier()
+    )
+    return (
+        f" cd {shlex.quote(working_directory)}; {exports}"
+        f"export PS1={shlex.quote(prompt)}; stty echo; clear\n"
+    )
+
+class PrewarmedShell:
+    """プールで待機中の、起動・初期化済みのシェル"""
+    
+    # 初期化完了を知らせる文字列（エコーされたコマンドとは一致しないよう引用符で分割して出力する）
+    READY_MARKER = b"__TERMINAL_POOL_READY__"
+    READY_COMMAND = b" stty -echo; echo __TERMINAL_POOL_''READY__\n"
+    
+    def __init__(self, master_fd: int, process: subprocess.Popen):
+        self.master_fd = master_fd
+        self.process = process
+        self.created_at = time.monotonic()
+    
+    @classmethod
+    async def spawn(cls, working_directory: str = TERMINAL_POOL_DIRECTORY,
+                    timeout: float = TERMINAL_POOL_SPAWN_TIMEOUT) -> "PrewarmedShell":
+        """シェルを起動し、起動処理（rcファイルの読み込み）が終わるまで待つ"""
+        master_fd, process = spawn_shell(working_directory)
+        shell = cls(master_fd, process)
+        try:
+            os.set_blocking(master_fd, False)
+            os.write(master_fd, cls.READY_COMMAND)
+            await shell._wait_ready(timeout)
+        except BaseException:
+            await shell.close()
+            raise
+        return shell
+    
+    async def _wait_ready(self, timeout: float):
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        output = bytearray()
+        
+        def on_readable():
+            try:
+                data = os.read(self.master_fd, 4096)
+            except BlockingIOError:
+                return
+            except OSError:
+                data = b""
+            if ready.done():
+                return
+            if not data:
+                ready.set_exception(RuntimeError("プールのシェルが初期化中に終了しました"))
+                return
+            output.extend(data)
+            if self.READY_MARKER in output:
+                ready.set_result(None)
+        
+        loop.add_reader(self.master_fd, on_readable)
+        try:
+            await asyncio.wait_for(ready, timeout)
+        finally:
+            loop.remove_reader(self.master_fd)
+    
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+    
+    def discard_output(self):
+        """待機中にたまった出力（プロンプトなど）を捨てる"""
+        while True:
+            try:
+                if not os.read(self.master_fd, 4096):
+                    return
+            except OSError:
+                return
+    
+    async def close(self):
+        """シェルを終了して端末を閉じる（待機中のシェルなので猶予なしで終了する）"""
+        await terminate_process_group(self.process, timeout=0)
+        self.close_fd()
+    
+    def close_fd(self):
+        try:
+            os.close(self.master_fd)
+        except OSError:
+            pass
+
+class ShellPool:
+    """事前に起動したシェルのプール（ターミナルタイプ別）
+    
+    claim() で取り出すと、バックグラウンドで補充する。
+    start() が呼ばれるまでは何も起動せず、claim() は None を返す。
+    """
+    
+    def __init__(self, sizes: Optional[Dict[str, int]] = None):
+        self.sizes = dict(TERMINAL_POOL_SIZE if sizes is None else sizes)
+        self.shells: Dict[str, Deque[PrewarmedShell]] = {terminal_type: deque() for terminal_type in self.sizes}
+        self._refill_tasks: Dict[str, asyncio.Task] = {}
+        self._started = False
+    
+    async def start(self):
+        """プールの充填を開始（アプリケーション起動時に呼び出す）"""
+        self._started = True
+        for terminal_type, size in self.sizes.items():
+            if size > 0:
+                self._schedule_refill(terminal_type)
+    
+    async def stop(self):
+        """補充を止め、待機中のシェルを終了"""
+        self._started = False
+        for task in self._refill_tasks.values():
+            task.cancel()
+        self._refill_tasks = {}
+        closing = []
+        for shells in self.shells.values():
+            while shells:
+                closing.append(shells.popleft().close())
+        await asyncio.gather(*closing)
+    
+    def claim(self, terminal_type: str) -> Optional[PrewarmedShell]:
+        """待機中のシェルを取り出す（なければ None）"""
+        if not self._started or terminal_type not in self.shells:
+            return None
+        shells = self.shells[terminal_type]
+        shell = None
+        while shells and shell is None:
+            candidate = shells.popleft()
+            if candidate.is_alive():
+                shell = candidate
+            else:
+                candidate.close_fd()  # 終了・回収済み
+        self._schedule_refill(terminal_type)
+        return shell
+    
+    async def fill(self, terminal_type: str):
+        """補充が終わるまで待つ"""
+        self._schedule_refill(terminal_type)
+        task = self._refill_tasks.get(terminal_type)
+        if task:
+            await asyncio.shield(task)
+    
+    def _schedule_refill(self, terminal_type: str):
+        task = self._refill_tasks.get(terminal_type)
+        if self._started and (task is None or task.done()):
+            self._refill_tasks[terminal_type] = asyncio.create_task(self._refill(terminal_type))
+    
+    async def _refill(self, terminal_type: str):
+        shells = self.shells[terminal_type]
+        while self._started and len(shells) < self.sizes[terminal_type]:
+            try:
+                shell = await PrewarmedShell.spawn()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Terminal pool spawn error ({terminal_type}): {e}")
+                return
+            if not self._started:
+                await shell.close()
+                return
+            shells.append(shell)
+    
+    def get_stats(self) -> Dict[str, int]:
+        """タイプ別の待機中のシェル数"""
+        return {terminal_type: len(shells) for terminal_type, shells in self.shells.items()}
+
+shell_pool = ShellPool()
+
 class BaseTerminalManager(ABC):
-    """ターミナルマネージャーの基底クラス"""
+    """ターミナルマネージャーの基底クラス
     
-    def __init__(self, session_id: str, working_directory: str = "/tmp"):
+    PTYの出力はイベントループに登録した単一のリーダー（add_reader）が
+    読み取り、購読者それぞれのキューへ配る。読み取り可能になるまで
+    CPUを消費しない。
+    
+    読み取りサイズは出力量に応じて TERMINAL_READ_SIZE_MIN から
+    TERMINAL_READ_SIZE_MAX の間で調整し、UTF-8はインクリメンタルに
+    デコードして読み取り境界をまたぐマルチバイト文字を壊さない。
+    連続する出力は TERMINAL_FRAME_SIZE / TERMINAL_FRAME_INTERVAL を上限に
+    1フレームへまとめる。
+    
+    読み取りはクライアントの接続有無にかかわらず続き、出力はスクロールバックに
+    記録される。subscribe() した購読者はスクロールバックを受け取ったうえで
+    以降の出力を受信する。全購読者のキューが埋まった場合は読み取りを一時停止し
+    （PTY側で書き込みが待たされる）、一部の購読者だけが遅れてキューが
+    あふれた場合はその購読を打ち切る。
+    """
+    
+    # シェルのプロンプト（PS1）
+    prompt = "\\u@\\h:\\w$ "
+    
+    def __init__(
+        self,
+        session_id: str,
+        working_directory: str = "/tmp",
+        resource_limits: Optional[Dict] = None,
+        environment: Optional[Dict[str, str]] = None
+    ):
         self.session_id = session_id
         self.working_directory = working_directory
+        self.resource_limits = resource_limits
+        self.environment = environment or {}
+        self.limit_mode = LimitMode.NONE
         self.master_fd = None
         self.slave_fd = None
         self.process = None
         self.is_initialized = False
         self.created_at = datetime.now()
+        self.last_activity = time.monotonic()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._paused = False
+        self._closed = False
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._read_size = TERMINAL_READ_SIZE_MIN
+        self._pending: List[str] = []
+        self._pending_size = 0
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._last_flush = 0.0
+        self.scrollback = ScrollbackBuffer()
+        self.subscribers: List[TerminalSubscription] = []
+        self.recorder: Optional[TerminalRecorder] = self._create_recorder()
+        self._input: Deque[bytes] = deque()
+        self._input_size = 0
+        self._input_space = asyncio.Event()
+        self._input_space.set()
+        self._writer_loop: Optional[asyncio.AbstractEventLoop] = None
         
     @abstractmethod
     async def start_terminal(self):
         """ターミナルプロセスを開始"""
         pass
     
-    async def read_output(self):
-        """ターミナル出力を読み取り"""
-        try:
-            if not self.master_fd:
-                return None
-                
-            # ノンブロッキング読み取り
-            ready, _, _ = select.select([self.master_fd], [], [], 0.1)
-            if ready:
-                data = os.read(self.master_fd, 1024)
-                return data.decode('utf-8', errors='ignore')
-        except Exception as e:
-            logger.error(f"Terminal read error: {e}")
-        return None
+    def _create_recorder(self) -> Optional[TerminalRecorder]:
+        """TERMINAL_RECORDING が有効なら入出力を記録する"""
+        if not TERMINAL_RECORDING:
+            return None
+        rows, cols = DEFAULT_WINDOW_SIZE
+        return TerminalRecorder(self.session_id, width=cols, height=rows)
     
-    async def write_input(self, data: str):
-        """ターミナルに入力を送信"""
-        try:
-            if self.master_fd:
-                os.write(self.master_fd, data.encode())
-        except Exception as e:
-            logger.error(f"Terminal write error: {e}")
+    async def _start_shell(self):
+        """シェルを起動
+        
+        プールに待機中のシェルがあれば引き継ぎ、作業ディレクトリ・環境変数・
+        プロンプトを切り替える。なければ新しく起動して初期化する。
+        """
+        # 作業ディレクトリが存在しない場合は作成
+        os.makedirs(self.working_directory, exist_ok=True)
+        
+        shell = shell_pool.claim(self.terminal_type)
+        if shell:
+            shell.discard_output()
+            self.master_fd, self.process = shell.master_fd, shell.process
+            self._apply_resource_limits()
+            self._start_reader()
+            os.write(self.master_fd, retarget_command(
+                self.working_directory, self.prompt, self.environment
+            ).encode())
+            self.is_initialized = True
+            logger.info(f"Pooled shell adopted for session {self.session_id}")
+            return
+        
+        self.master_fd, self.process = spawn_shell(self.working_directory, self.environment)
+        self._apply_resource_limits()
+        self._start_reader()
+        
+        # 初期化は新規セッションの場合のみ実行
+        if not self.is_initialized:
+            initial_commands = [
+                f"cd {self.working_directory}",
+                f"export PS1='{self.prompt}'"
+            ]
+            
+            for cmd in initial_commands:
+                os.write(self.master_fd, f"{cmd}\n".encode())
+                await asyncio.sleep(0.1)
+            
+            self.is_initialized = True
     
-    def cleanup(self):
-        """リソースをクリーンアップ"""
-        try:
-            if self.process:
-                self.process.terminate()
-                self.process.wait(timeout=5)
-        except:
-            pass
+    def _apply_resource_limits(self):
+        """起動したシェルにセッションのリソース制限を適用"""
+        if self.process and self.resource_limits:
+            self.limit_mode = apply_resource_limits(self.process.pid, self.resource_limits, self.session_id)
+            logger.info(f"Terminal resource limits applied ({self.limit_mode}): {self.session_id}")
+    
+    def get_usage(self) -> Dict:
+        """シェルとその子プロセスのリソース使用量を取得"""
+        usage = {"cpu_seconds": 0.0, "memory_mb": 0.0, "processes": 0}
+        if self.process and self.process.poll() is None:
+            usage = get_resource_usage(self.process.pid, self.session_id)
+        usage["limits"] = self.resource_limits
+        usage["enforcement"] = self.limit_mode
+        return usage
+    
+    async def fetch_usage(self) -> Dict:
+        """リソース使用量を取得（ブローカー経由のターミナルでは問い合わせる）"""
+        return self.get_usage()
+    
+    @property
+    def closed(self) -> bool:
+        """シェルが終了した（またはクリーンアップ済み）か"""
+        return self._closed
+    
+    def touch(self):
+        """利用があったことを記録（アイドル判定用）"""
+        self.last_activity = time.monotonic()
+    
+    def get_idle_ttl(self) -> float:
+        return TERMINAL_IDLE_TTL.get(getattr(self, "terminal_type", "basic"), 0)
+    
+    def is_idle(self, now: Optional[float] = None) -> bool:
+        """購読者がおらず、アイドルTTLを超えて利用がないか"""
+        ttl = self.get_idle_ttl()
+        if ttl <= 0 or self.subscribers:
+            return False
+        now = time.monotonic() if now is None else now
+        return now - self.last_activity > ttl
+    
+    def _start_reader(self):
+        """PTYの読み取りをイベントループに登録
+        
+        子プロセス起動後に呼び出す。親プロセス側のスレーブ端は閉じておき、
+        シェルの終了をEOF（EIO）として検出できるようにする。
+        """
+        if self.slave_fd is not None:
+            os.close(self.slave_fd)
+            self.slave_fd = None
+        os.set_blocking(self.master_fd, False)
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(self.master_fd, self._on_readable)
+    
+    def _stop_reader(self):
+        """PTYの読み取りを停止"""
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._loop and self.master_fd is not None and not self._paused:
+            try:
+                self._loop.remove_reader(self.master_fd)
+            except Exception:
+                pass
+        self._loop = None
+        self._paused = False
+    
+    def _pause_reader(self):
+        """全購読者が詰まっている間、PTYの読み取りを一時停止"""
+        if self._loop and not self._paused:
+            self._loop.remove_reader(self.master_fd)
+            self._paused = True
+    
+    def _resume_reader(self):
+        """PTYの読み取りを再開"""
+        if self._loop and self._paused:
+            self._paused = False
+            self._loop.add_reader(self.master_fd, self._on_readable)
+    
+    def _on_readable(self):
+        """PTYが読み取り可能になったときに呼ばれる
+        
+        1フレーム分に達するか読み切るまで読み取りを続ける。
+        """
+        eof = False
+        while self._pending_size < TERMINAL_FRAME_SIZE:
+            try:
+                data = os.read(self.master_fd, self._read_size)
+            except BlockingIOError:
+                break
+            except OSError:
+                data = b""  # シェル終了時はEIO
+            
+            if not data:
+                eof = True
+                break
+            self._adapt_read_size(len(data))
+            self._pending_size += len(data)
+            text = self._decoder.decode(data)
+            if text:
+                self._pending.append(text)
+        
+        if eof:
+            # シェルが終了した
+            tail = self._decoder.decode(b"", final=True)
+            if tail:
+                self._pending.append(tail)
+            loop = self._loop
+            self._stop_reader()
+            self._flush(loop)
+            self._close_subscribers()
+            self._discard_input()
+            return
+        self._schedule_flush()
+    
+    def _adapt_read_size(self, size: int):
+        """読み取った量に応じて次回の読み取りサイズを調整"""
+        if size >= self._read_size:
+            self._read_size = min(self._read_size * 2, TERMINAL_READ_SIZE_MAX)
+        elif size < self._read_size // 4:
+            self._read_size = max(self._read_size // 2, TERMINAL_READ_SIZE_MIN)
+    
+    def _schedule_flush(self):
+        """まとめた出力の送信時期を決める"""
+        if not self._pending:
+            return
+        if self._pending_size >= TERMINAL_FRAME_SIZE:
+            # 1フレーム分たまった（待機中のタイマーを待つと読み取りが空回りする）
+            if self._flush_handle:
+                self._flush_handle.cancel()
+            self._flush(self._loop)
+            return
+        if self._flush_handle:
+            return
+        elapsed = self._loop.time() - self._last_flush
+        if elapsed >= TERMINAL_FRAME_INTERVAL:
+            # しばらく出力がなかった（キー入力のエコーなど）
+            self._flush(self._loop)
+        else:
+            self._flush_handle = self._loop.call_later(
+                TERMINAL_FRAME_INTERVAL - elapsed, self._flush, self._loop
+            )
+    
+    def _flush(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        """まとめた出力を1フレームとしてスクロールバックと購読者に配る"""
+        self._flush_handle = None
+        if loop:
+            self._last_flush = loop.time()
+        self._pending_size = 0
+        if not self._pending:
+            return
+        frame = "".join(self._pending)
+        self._pending = []
+        self.scrollback.append(frame)
+        if self.recorder:
+            self.recorder.record_output(frame)
         
+        for subscription in list(self.subscribers):
+            if not subscription.put(frame):
+                # この購読者だけが追いつけていない
+                logger.warning(f"Terminal subscriber overflowed: {self.session_id}")
+                self.unsubscribe(subscription, overflowed=True)
+        
+        if self.subscribers and all(subscription.full() for subscription in self.subscribers):
+            self._pause_reader()
+    
+    def _on_subscriber_drained(self, subscription: TerminalSubscription):
+        """購読者がフレームを受け取ったときに呼ばれる"""
+        if self._paused and len(subscription.queue) <= subscription.maxsize // 2:
+            self._resume_reader()
+    
+    def subscribe(self, readonly: bool = False, maxsize: int = TERMINAL_SUBSCRIBER_QUEUE) -> TerminalSubscription:
+        """出力を購読
+        
+        返される購読の scrollback にはこれまでの出力が入っており、
+        以降の出力は get() で受け取る。readonly は閲覧のみの購読者であることを示す。
+        """
+        self.touch()
+        subscription = TerminalSubscription(self, self.scrollback.snapshot(), maxsize, readonly)
+        if self._closed:
+            subscription.close()
+        else:
+            self.subscribers.append(subscription)
+        return subscription
+    
+    def unsubscribe(self, subscription: TerminalSubscription, overflowed: bool = False):
+        """購読を解除"""
+        self.touch()
+        subscription.close(overflowed)
+        if subscription in self.subscribers:
+            self.subscribers.remove(subscription)
+        if self._paused and not self.subscribers:
+            self._resume_reader()
+    
+    def _close_subscribers(self):
+        """シェル終了を全購読者に伝える"""
+        self._closed = True
+        for subscription in self.subscribers:
+            subscription.close()
+        self.subscribers = []
+    
+    async def write_input(self, data: Union[str, bytes]):
+        """ターミナルに入力を送信
+        
+        入力は書き込み待ちのキューに積み、PTYが受け付けた分だけ書き込む
+        （残りは書き込み可能になったときに add_writer で続きを書く）。
+        待ちが TERMINAL_INPUT_BUFFER_BYTES を超えている間は、この呼び出し元
+        だけが待たされる。
+        """
+        self.touch()
+        payload = data.encode() if isinstance(data, str) else bytes(data)
+        if not payload:
+            return
+        while self._input_size >= TERMINAL_INPUT_BUFFER_BYTES and not self._closed:
+            self._input_space.clear()
+            await self._input_space.wait()
+        if self.master_fd is None or self._closed:
+            return
+        if self.recorder:
+            self.recorder.record_input(payload.decode("utf-8", errors="replace"))
+        self._input.append(payload)
+        self._input_size += len(payload)
+        if self._writer_loop is None:
+            self._write_pending_input()
+    
+    def _write_pending_input(self):
+        """書き込み待ちの入力をPTYが受け付けるだけ書き込む"""
+        while self._input:
+            chunk = self._input[0]
+            try:
+                written = os.write(self.master_fd, chunk)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                logger.error(f"Terminal write error: {e}")
+                self._discard_input()
+                return
+            self._input_size -= written
+            if written < len(chunk):
+                self._input[0] = chunk[written:]
+                break
+            self._input.popleft()
+        
+        if self._input and self._writer_loop is None:
+            self._writer_loop = asyncio.get_running_loop()
+            self._writer_loop.add_writer(self.master_fd, self._write_pending_input)
+        elif not self._input:
+            self._stop_writer()
+        if self._input_size < TERMINAL_INPUT_BUFFER_BYTES:
+            self._input_space.set()
+    
+    def _stop_writer(self):
+        if self._writer_loop is not None:
+            try:
+                self._writer_loop.remove_writer(self.master_fd)
+            except Exception:
+                pass
+            self._writer_loop = None
+    
+    def _discard_input(self):
+        """書き込み待ちの入力を捨て、待っている呼び出し元を起こす"""
+        self._stop_writer()
+        self._input.clear()
+        self._input_size = 0
+        self._input_space.set()
+    
+    def get_pending_input(self) -> int:
+        """書き込み待ちの入力のバイト数"""
+        return self._input_size
+    
+    def resize(self, rows: int, cols: int):
+        """ウィンドウサイズを変更"""
+        if not (0 < rows <= MAX_WINDOW_SIZE and 0 < cols <= MAX_WINDOW_SIZE):
+            raise ValueError(f"無効なウィンドウサイズです: {rows}x{cols}")
+        if self.master_fd is None:
+            return
+        self.touch()
+        set_window_size(self.master_fd, rows, cols)
+        if self.recorder:
+            self.recorder.record_resize(rows, cols)
+    
+    def send_signal(self, name: str):
+        """フォアグラウンドのプロセスグループにシグナルを送る"""
+        sig = TERMINAL_SIGNALS.get(name if name.startswith("SIG") else f"SIG{name}")
+        if sig is None:
+            raise ValueError(f"送信できないシグナルです: {name}")
+        if self.master_fd is None:
+            return
+        self.touch()
         try:
-            if self.master_fd:
-                os.close(self.master_fd)
-            if self.slave_fd:
-                os.close(self.slave_fd)
-        except:
-            pass
+            os.killpg(os.tcgetpgrp(self.master_fd), sig)
+        except OSError as e:
+            logger.warning(f"Terminal signal error ({name}): {e}")
+    
+    async def cleanup(self, timeout: float = TERMINAL_KILL_TIMEOUT):
+        """リソースをクリーンアップ
+        
+        シェルのプロセスグループ全体を終了させ（timeout 秒後に SIGKILL）、
+        イベントループを止めずに回収してから端末を閉じる。
+        """
+        self._stop_reader()
+        self.scrollback.clear()
+        self._close_subscribers()
+        self._discard_input()
+        
+        if self.process:
+            try:
+                await terminate_process_group(self.process, timeout)
+            except Exception as e:
+                logger.error(f"Terminal terminate error: {e}")
+        
+        for fd in (self.master_fd, self.slave_fd):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self.master_fd = None
+        self.slave_fd = None
+        
+        if self.recorder:
+            await self.recorder.close()
+        
+        if self.limit_mode == LimitMode.CGROUP:
+            remove_cgroup(self.session_id)
+
+    async def shutdown(self):
+        """アプリケーション終了時の後始末（ローカルのシェルは終了する）"""
+        await self.cleanup()
 
 class BasicTerminalManager(BaseTerminalManager):
     """基本ターミナルマネージャー（無料版）"""
     
-    def __init__(self, session_id: str, working_directory: str = "/tmp"):
-        super().__init__(session_id, working_directory)
+    prompt = "[Basic] \\u@\\h:\\w$ "
+    
+    def __init__(
+        self,
+        session_id: str,
+        working_directory: str = "/tmp",
+        resource_limits: Optional[Dict] = None,
+        environment: Optional[Dict[str, str]] = None
+    ):
+        super().__init__(session_id, working_directory, resource_limits, environment)
         self.terminal_type = "basic"
         
     async def start_terminal(self):
         """基本ターミナルプロセスを開始"""
         try:
-            # 作業ディレクトリが存在しない場合は作成
-            os.makedirs(self.working_directory, exist_ok=True)
-            
-            # pseudoterminal を作成
-            self.master_fd, self.slave_fd = pty.openpty()
-            
-            # シェルプロセスを開始
-            self.process = subprocess.Popen(
-                ['/bin/bash'],
-                stdin=self.slave_fd,
-                stdout=self.slave_fd,
-                stderr=self.slave_fd,
-                cwd=self.working_directory,
-                env=os.environ.copy(),
-                preexec_fn=os.setsid
-            )
-            
-            # 初期化は新規セッションの場合のみ実行
-            if not self.is_initialized:
-                initial_commands = [
-                    f"cd {self.working_directory}",
-                    "export PS1='[Basic] \\u@\\h:\\w$ '"
-                ]
-                
-                for cmd in initial_commands:
-                    os.write(self.master_fd, f"{cmd}\n".encode())
-                    await asyncio.sleep(0.1)
-                
-                self.is_initialized = True
-                logger.info(f"Basic terminal initialized for session {self.session_id}")
+            await self._start_shell()
+            logger.info(f"Basic terminal initialized for session {self.session_id}")
                 
         except Exception as e:
             logger.error(f"Basic terminal start error: {e}")
@@ -124,8 +911,17 @@ class BasicTerminalManager(BaseTerminalManager):
 class ClaudeTerminalManager(BaseTerminalManager):
     """Claudeターミナルマネージャー（有料版）"""
     
-    def __init__(self, session_id: str, working_directory: str = "/tmp", system_prompt: Optional[str] = None):
-        super().__init__(session_id, working_directory)
+    prompt = "[Claude] \\u@\\h:\\w$ "
+    
+    def __init__(
+        self,
+        session_id: str,
+        working_directory: str = "/tmp",
+        system_prompt: Optional[str] = None,
+        resource_limits: Optional[Dict] = None,
+        environment: Optional[Dict[str, str]] = None
+    ):
+        super().__init__(session_id, working_directory, resource_limits, environment)
         self.terminal_type = "claude"
         self.claude_session = None
         self.system_prompt = system_prompt or "あなたは専門的なソフトウェア開発アシスタントです。ターミナル環境で作業しているユーザーをサポートしてください。常に日本語で応答してください。"
@@ -147,35 +943,7 @@ class ClaudeTerminalManager(BaseTerminalManager):
     
     async def _initialize_basic_terminal(self):
         """基本ターミナル機能を初期化"""
-        # 作業ディレクトリが存在しない場合は作成
-        os.makedirs(self.working_directory, exist_ok=True)
-        
-        # pseudoterminal を作成
-        self.master_fd, self.slave_fd = pty.openpty()
-        
-        # シェルプロセスを開始
-        self.process = subprocess.Popen(
-            ['/bin/bash'],
-            stdin=self.slave_fd,
-            stdout=self.slave_fd,
-            stderr=self.slave_fd,
-            cwd=self.working_directory,
-            env=os.environ.copy(),
-            preexec_fn=os.setsid
-        )
-        
-        # 初期化は新規セッションの場合のみ実行
-        if not self.is_initialized:
-            initial_commands = [
-                f"cd {self.working_directory}",
-                "export PS1='[Claude] \\u@\\h:\\w$ '"
-            ]
-            
-            for cmd in initial_commands:
-                os.write(self.master_fd, f"{cmd}\n".encode())
-                await asyncio.sleep(0.1)
-            
-            self.is_initialized = True
+        await self._start_shell()
     
     async def _initialize_claude_session(self):
         """Claude統合セッションを初期化"""
@@ -190,30 +958,46 @@ class ClaudeTerminalManager(BaseTerminalManager):
             logger.warning(f"Claude session initialization failed: {e}")
             # Claude統合が失敗してもターミナルは使用可能
     
-    def cleanup(self):
+    async def cleanup(self, timeout: float = TERMINAL_KILL_TIMEOUT):
         """リソースをクリーンアップ"""
         if self.claude_session:
             # Claude セッションのクリーンアップ
             # TODO: claude_session.cleanup() が実装されている場合は呼び出し
             pass
         
-        super().cleanup()
+        await super().cleanup(timeout)
 
 # アクティブなターミナルセッションを管理
 active_terminals: Dict[str, BaseTerminalManager] = {}
 
 def get_terminal_manager(session_id: str, terminal_type: str, working_directory: str = "/tmp", **kwargs) -> BaseTerminalManager:
-    """ターミナルマネージャーを取得・作成"""
+    """ターミナルマネージャーを取得・作成
+    
+    TERMINAL_BROKER_SOCKET が設定されている場合は、PTYブローカー上の
+    ターミナルに接続するクライアントを返す。
+    """
+    if TERMINAL_BROKER_SOCKET:
+        # pty_broker はこのモジュールを読み込むため、ここで読み込む
+        from .pty_broker import RemoteTerminalManager
+        return RemoteTerminalManager(session_id, terminal_type, working_directory, **kwargs)
+    return create_terminal_manager(session_id, terminal_type, working_directory, **kwargs)
+
+def create_terminal_manager(session_id: str, terminal_type: str, working_directory: str = "/tmp", **kwargs) -> BaseTerminalManager:
+    """このプロセスでシェルを動かすターミナルマネージャーを作成"""
     if terminal_type == "claude":
         return ClaudeTerminalManager(
             session_id=session_id,
             working_directory=working_directory,
-            system_prompt=kwargs.get('system_prompt')
+            system_prompt=kwargs.get('system_prompt'),
+            resource_limits=kwargs.get('resource_limits'),
+            environment=kwargs.get('environment')
         )
     else:
         return BasicTerminalManager(
             session_id=session_id,
-            working_directory=working_directory
+            working_directory=working_directory,
+            resource_limits=kwargs.get('resource_limits'),
+            environment=kwargs.get('environment')
         )
 
 def has_active_terminal(session_id: str) -> bool:
@@ -228,9 +1012,70 @@ def set_active_terminal(session_id: str, terminal: BaseTerminalManager):
     """アクティブなターミナルセッションを設定"""
     active_terminals[session_id] = terminal
 
-def remove_active_terminal(session_id: str):
+async def remove_active_terminals(session_ids: Iterable[str], timeout: float = TERMINAL_KILL_TIMEOUT) -> List[str]:
+    """複数のアクティブなターミナルセッションをまとめて終了し、終了したIDを返す
+    
+    終了は並行して待つため、台数によらず最長でも timeout 秒程度で終わる。
+    """
+    terminals = [
+        (session_id, active_terminals.pop(session_id))
+        for session_id in session_ids if session_id in active_terminals
+    ]
+    results = await asyncio.gather(
+        *(terminal.cleanup(timeout) for _, terminal in terminals),
+        return_exceptions=True
+    )
+    for (session_id, _), result in zip(terminals, results):
+        if isinstance(result, Exception):
+            logger.error(f"Terminal cleanup error ({session_id}): {result}")
+    return [session_id for session_id, _ in terminals]
+
+async def remove_active_terminal(session_id: str) -> bool:
     """アクティブなターミナルセッションを削除"""
-    if session_id in active_terminals:
-        terminal = active_terminals[session_id]
-        terminal.cleanup()
-        del active_terminals[session_id]
\ No newline at end of file
+    return bool(await remove_active_terminals([session_id]))
+
+async def shutdown_active_terminals():
+    """すべてのアクティブなターミナルセッションを後始末（アプリケーション終了時に呼び出す）
+    
+    ローカルのシェルは終了し、ブローカー上のターミナルからは切断だけを行う。
+    """
+    terminals = list(active_terminals.values())
+    active_terminals.clear()
+    results = await asyncio.gather(*(terminal.shutdown() for terminal in terminals), return_exceptions=True)
+    for terminal, result in zip(terminals, results):
+        if isinstance(result, Exception):
+            logger.error(f"Terminal shutdown error ({terminal.session_id}): {result}")
+
+async def reap_idle_terminals(now: Optional[float] = None) -> int:
+    """アイドルTTLを超えたターミナルを終了し、終了した数を返す"""
+    idle = [
+        session_id for session_id, terminal in active_terminals.items()
+        if terminal.is_idle(now)
+    ]
+    for session_id in idle:
+        logger.info(f"Idle terminal reaped: {session_id}")
+    return len(await remove_active_terminals(idle))
+
+_reaper_task: Optional[asyncio.Task] = None
+
+async def _reaper():
+    """定期的にアイドルなターミナルを終了するタスク"""
+    while True:
+        await asyncio.sleep(TERMINAL_REAPER_INTERVAL)
+        try:
+            await reap_idle_terminals()
+        except Exception as e:
+            logger.error(f"Terminal reaper error: {e}")
+
+def start_terminal_reaper():
+    """アイドルターミナルの回収を開始（アプリケーション起動時に呼び出す）"""
+    global _reaper_task
+    if _reaper_task is None:
+        _reaper_task = asyncio.create_task(_reaper())
+
+def stop_terminal_reaper():
+    """アイドルターミナルの回収を停止"""
+    global _reaper_task
+    if _reaper_task is not None:
+        _reaper_task.cancel()
+        _reaper_task = None
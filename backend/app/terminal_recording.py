@@ -0,0 +1,275 @@
+"""
+ターミナルの記録と再生
+PTYの出力・入力を asciicast v2 形式のイベントとして記録し、時刻を指定して再生する
+
+記録はターミナルごとのディレクトリに保存する:
+
+- header.json: asciicast のヘッダー（timestamp が経過時間の基準）
+- chunk-000001.jsonl.gz ...: イベント行をgzip圧縮したチャンク（チャンク単位で展開できる）
+- index.jsonl: チャンクごとの経過時間の範囲とサイズ（再生時のシーク用）
+
+ライブの経路ではイベントをメモリに積むだけで、圧縮と書き込みはバックグラウンドの
+タスクがスレッドプール上で行う。ディスク使用量がセッションごとの上限を超えると
+古いチャンクから削除する。
+"""
+
+import asyncio
+import gzip
+import json
+import logging
+import os
+import re
+import time
+from pathlib import Path
+from typing import AsyncGenerator, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# ターミナルの記録を有効にするか
+TERMINAL_RECORDING = os.getenv("TERMINAL_RECORDING", "false").lower() == "true"
+# 記録の保存先
+TERMINAL_RECORDING_DIR = os.getenv("TERMINAL_RECORDING_DIR", "/tmp/claude-terminal-recordings")
+# ターミナルごとの記録の最大バイト数（圧縮後。超えると古いチャンクから削除する）
+TERMINAL_RECORDING_MAX_BYTES = int(os.getenv("TERMINAL_RECORDING_MAX_BYTES", str(64 * 1024 * 1024)))
+# チャンクを書き出す間隔（秒）
+TERMINAL_RECORDING_CHUNK_SECONDS = float(os.getenv("TERMINAL_RECORDING_CHUNK_SECONDS", "10"))
+# この量のイベントがたまったら間隔を待たずに書き出す（圧縮前のおおよその文字数）
+TERMINAL_RECORDING_CHUNK_SIZE = int(os.getenv("TERMINAL_RECORDING_CHUNK_SIZE", str(256 * 1024)))
+# 書き出しが追いつかない場合にメモリに保持する上限（超えた分は記録しない）
+TERMINAL_RECORDING_BUFFER_SIZE = TERMINAL_RECORDING_CHUNK_SIZE * 8
+
+HEADER_FILE = "header.json"
+INDEX_FILE = "index.jsonl"
+
+class RecordingEvent:
+    """asciicast v2 のイベントの種類"""
+    OUTPUT = "o"
+    INPUT = "i"
+    RESIZE = "r"  # データは "{列}x{行}"
+
+def recording_directory(session_id: str, root: Optional[str] = None) -> Path:
+    """ターミナルの記録を保存するディレクトリ"""
+    name = re.sub(r"[^A-Za-z0-9_.-]", "_", session_id)
+    return Path(root or TERMINAL_RECORDING_DIR) / name
+
+def load_recording(directory: Path) -> Tuple[Optional[Dict], List[Dict]]:
+    """ヘッダーとインデックスを読み込む（記録がなければ None と空リスト）"""
+    try:
+        header = json.loads((directory / HEADER_FILE).read_text())
+    except (OSError, json.JSONDecodeError):
+        return None, []
+    index = []
+    try:
+        with open(directory / INDEX_FILE) as f:
+            for line in f:
+                if line.strip():
+                    index.append(json.loads(line))
+    except FileNotFoundError:
+        pass
+    return header, index
+
+def _read_chunk(path: Path) -> List[list]:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+class TerminalRecorder:
+    """ターミナルのイベントを記録する
+
+    record_*() はイベントをメモリに積むだけで、I/Oは行わない。
+    同じディレクトリに記録が残っていれば、そのヘッダーの時刻を基準に
+    続きとして追記する（ターミナルを作り直しても1本の記録になる）。
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        width: int = 80,
+        height: int = 24,
+        root: Optional[str] = None,
+        max_bytes: int = TERMINAL_RECORDING_MAX_BYTES,
+        chunk_seconds: float = TERMINAL_RECORDING_CHUNK_SECONDS,
+        chunk_size: int = TERMINAL_RECORDING_CHUNK_SIZE
+    ):
+        self.session_id = session_id
+        self.directory = recording_directory(session_id, root)
+        self.width = width
+        self.height = height
+        self.max_bytes = max_bytes
+        self.chunk_seconds = chunk_seconds
+        self.chunk_size = chunk_size
+        self.dropped = 0
+        self._events: List[Tuple[float, str, str]] = []
+        self._buffer_size = 0
+        self._header: Optional[Dict] = None
+        self._index: Optional[List[Dict]] = None
+        self._wakeup = asyncio.Event()
+        self._write_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def record_output(self, text: str):
+        self._record(RecordingEvent.OUTPUT, text)
+
+    def record_input(self, text: str):
+        self._record(RecordingEvent.INPUT, text)
+
+    def record_resize(self, rows: int, cols: int):
+        self.width, self.height = cols, rows
+        self._record(RecordingEvent.RESIZE, f"{cols}x{rows}")
+
+    def _record(self, kind: str, data: str):
+        if self._closed:
+            return
+        if self._buffer_size + len(data) > TERMINAL_RECORDING_BUFFER_SIZE:
+            # 書き出しが追いついていない。ライブの経路を待たせないよう記録を諦める
+            self.dropped += 1
+            return
+        self._events.append((time.time(), kind, data))
+        self._buffer_size += len(data)
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._writer())
+        if self._buffer_size >= self.chunk_size:
+            self._wakeup.set()
+
+    async def _writer(self):
+        """一定間隔、または一定量たまるごとにチャンクを書き出すタスク
+
+        close() で起こされると、残りを書き出してから終了する。
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.chunk_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Terminal recording write error ({self.session_id}): {e}")
+            if self._closed:
+                return
+
+    async def flush(self):
+        """たまっているイベントを1チャンクとして書き出す"""
+        if not self._events:
+            return
+        events, self._events = self._events, []
+        self._buffer_size = 0
+        async with self._write_lock:
+            await asyncio.get_running_loop().run_in_executor(None, self._write_chunk, events)
+
+    def _write_chunk(self, events: List[Tuple[float, str, str]]):
+        """チャンクを圧縮して書き込み、上限を超えた分を削除する（スレッドプール上で実行）"""
+        if self._header is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._header, self._index = load_recording(self.directory)
+            if self._header is None:
+                self._header = {
+                    "version": 2,
+                    "width": self.width,
+                    "height": self.height,
+                    "timestamp": int(events[0][0]),
+                    "title": self.session_id
+                }
+                (self.directory / HEADER_FILE).write_text(json.dumps(self._header))
+
+        origin = self._header["timestamp"]
+        lines = "".join(
+            json.dumps([round(at - origin, 6), kind, data], ensure_ascii=False) + "\n"
+            for at, kind, data in events
+        )
+        compressed = gzip.compress(lines.encode("utf-8"))
+        number = self._index[-1]["number"] + 1 if self._index else 1
+        name = f"chunk-{number:06d}.jsonl.gz"
+        (self.directory / name).write_bytes(compressed)
+
+        entry = {
+            "number": number,
+            "file": name,
+            "start": round(events[0][0] - origin, 6),
+            "end": round(events[-1][0] - origin, 6),
+            "events": len(events),
+            "bytes": len(compressed)
+        }
+        self._index.append(entry)
+        with open(self.directory / INDEX_FILE, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+        self._enforce_limit()
+
+    def _enforce_limit(self):
+        """ディスク使用量の上限を超えた分を古いチャンクから削除"""
+        total = sum(entry["bytes"] for entry in self._index)
+        removed = False
+        while total > self.max_bytes and len(self._index) > 1:
+            oldest = self._index.pop(0)
+            total -= oldest["bytes"]
+            removed = True
+            try:
+                (self.directory / oldest["file"]).unlink()
+            except FileNotFoundError:
+                pass
+        if removed:
+            temporary = self.directory / f"{INDEX_FILE}.tmp"
+            temporary.write_text("".join(json.dumps(entry) + "\n" for entry in self._index))
+            os.replace(temporary, self.directory / INDEX_FILE)
+
+    async def close(self):
+        """残りのイベントを書き出して記録を終える
+
+        書き出しタスクは取り消さずに起こして終了を待つ（取り消すと、取り出し
+        済みで書き込み中のイベントが失われる）。
+        """
+        self._closed = True
+        task, self._task = self._task, None
+        if task:
+            self._wakeup.set()
+            await task
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Terminal recording write error ({self.session_id}): {e}")
+
+async def get_recording_info(session_id: str, root: Optional[str] = None) -> Optional[Dict]:
+    """記録の概要（なければ None）"""
+    directory = recording_directory(session_id, root)
+    header, index = await asyncio.get_running_loop().run_in_executor(None, load_recording, directory)
+    if header is None:
+        return None
+    return {
+        "header": header,
+        "start": index[0]["start"] if index else 0.0,
+        "end": index[-1]["end"] if index else 0.0,
+        "chunks": len(index),
+        "events": sum(entry["events"] for entry in index),
+        "bytes": sum(entry["bytes"] for entry in index)
+    }
+
+async def replay_recording(
+    session_id: str,
+    start: float = 0.0,
+    end: Optional[float] = None,
+    root: Optional[str] = None
+) -> AsyncGenerator[str, None]:
+    """経過時間 start〜end のイベントを asciicast v2 の行として返す
+
+    インデックスで範囲に重なるチャンクだけを展開する。イベントの時刻は
+    start を0とした値に置き換える。
+    """
+    loop = asyncio.get_running_loop()
+    directory = recording_directory(session_id, root)
+    header, index = await loop.run_in_executor(None, load_recording, directory)
+    if header is None:
+        return
+
+    yield json.dumps({**header, "timestamp": header["timestamp"] + int(start)}) + "\n"
+    for entry in index:
+        if entry["end"] < start or (end is not None and entry["start"] > end):
+            continue
+        try:
+            events = await loop.run_in_executor(None, _read_chunk, directory / entry["file"])
+        except FileNotFoundError:
+            continue  # 上限超過で削除された
+        for at, kind, data in events:
+            if at < start or (end is not None and at > end):
+                continue
+            yield json.dumps([round(at - start, 6), kind, data], ensure_ascii=False) + "\n"
@@ -0,0 +1,277 @@
+"""
+WebSocketバックプレーン
+複数ワーカー間でブロードキャストを中継する
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# バックプレーンの接続先（未設定ならプロセス内のみ。postgresql:// を指定するとLISTEN/NOTIFYを使用）
+WS_BACKPLANE_URL = os.getenv("WS_BACKPLANE_URL", "")
+# LISTEN/NOTIFYで使用するチャンネル名
+WS_BACKPLANE_CHANNEL = os.getenv("WS_BACKPLANE_CHANNEL", "ws_backplane")
+
+class Backplane(ABC):
+    """バックプレーンの基底クラス
+
+    publish されたメッセージは、発行元を含むすべてのワーカーのハンドラーに
+    一度ずつ届けられる。発行元ワーカーへはネットワークを経由せず即座に届け、
+    他ワーカーへの送信は呼び出し元を待たせずに行う。
+    """
+
+    def __init__(self):
+        self.worker_id = uuid.uuid4().hex
+        self._handler: Optional[Callable[[dict], None]] = None
+
+    def set_handler(self, handler: Callable[[dict], None]):
+        """受信メッセージを処理するハンドラーを設定"""
+        self._handler = handler
+
+    def _dispatch(self, message: dict):
+        """ハンドラーにメッセージを渡す"""
+        if not self._handler:
+            return
+        try:
+            self._handler(message)
+        except Exception as e:
+            logger.error(f"バックプレーンメッセージ処理エラー: {e}")
+
+    async def start(self):
+        """バックプレーンを開始"""
+
+    async def stop(self):
+        """バックプレーンを停止"""
+
+    @abstractmethod
+    def publish(self, message: dict):
+        """全ワーカーにメッセージを発行"""
+
+class InProcessBackplane(Backplane):
+    """プロセス内バックプレーン
+
+    同じ hub を共有するインスタンス同士でメッセージを中継する。
+    hub を指定しない場合は単一ワーカーとして動作する（テスト・開発用）。
+    """
+
+    def __init__(self, hub: Optional[List["InProcessBackplane"]] = None):
+        super().__init__()
+        self.hub = hub if hub is not None else []
+        self.hub.append(self)
+
+    async def stop(self):
+        if self in self.hub:
+            self.hub.remove(self)
+
+    def publish(self, message: dict):
+        for backplane in list(self.hub):
+            backplane._dispatch(message)
+
+class PostgresBackplane(Backplane):
+    """PostgreSQLのLISTEN/NOTIFYを使用するバックプレーン
+
+    NOTIFYのペイロード上限（8000バイト）を超えるメッセージは分割して送り、
+    受信側で組み立て直す。自ワーカーが発行した通知は受信時に無視する。
+    LISTEN用の接続が切れた場合は間隔を延ばしながら再接続する
+    （切断中に発行された通知は受け取れない）。
+    """
+
+    # 分割後の1通知あたりの本文の最大長（ヘッダー分の余裕を残す）
+    CHUNK_SIZE = 7000
+    # 組み立て途中のメッセージを保持する最大数
+    MAX_PARTIALS = 256
+    # 未送信の通知の最大数（超過分は破棄）
+    MAX_OUTBOX = 10000
+    # LISTEN用の接続の再接続間隔（秒、失敗するたびに倍にする）
+    RECONNECT_MIN_DELAY = 0.5
+    RECONNECT_MAX_DELAY = 30.0
+
+    def __init__(self, dsn: str, channel: str = WS_BACKPLANE_CHANNEL):
+        super().__init__()
+        if not re.fullmatch(r"[a-z_][a-z0-9_]*", channel):
+            raise ValueError(f"無効なチャンネル名です: {channel}")
+        self.dsn = dsn
+        self.channel = channel
+        self._listen_conn = None
+        self._publish_conn = None
+        self._outbox: Optional[asyncio.Queue] = None
+        self._publisher_task: Optional[asyncio.Task] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._partials: "OrderedDict[str, List[Optional[str]]]" = OrderedDict()
+
+    def _connect(self):
+        """自動コミットの接続を開く（スレッドプール上で実行）"""
+        import psycopg2
+        from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+        conn = psycopg2.connect(self.dsn)
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        return conn
+
+    def _open_listener(self):
+        """LISTEN用の接続を開く（スレッドプール上で実行）"""
+        conn = self._connect()
+        with conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {self.channel}")
+        return conn
+
+    async def start(self):
+        """LISTEN用と発行用の接続を開き、受信をイベントループに登録"""
+        loop = asyncio.get_running_loop()
+        self._listen_conn = await loop.run_in_executor(None, self._open_listener)
+        self._publish_conn = await loop.run_in_executor(None, self._connect)
+
+        loop.add_reader(self._listen_conn.fileno(), self._on_readable)
+        self._outbox = asyncio.Queue(maxsize=self.MAX_OUTBOX)
+        self._publisher_task = asyncio.create_task(self._publisher())
+        logger.info(f"PostgreSQLバックプレーンを開始しました: channel={self.channel}, worker={self.worker_id}")
+
+    async def stop(self):
+        """接続を閉じる"""
+        for task in (self._publisher_task, self._reconnect_task):
+            if task:
+                task.cancel()
+        self._publisher_task = None
+        self._reconnect_task = None
+        self._outbox = None
+        self._close_listener()
+        if self._publish_conn:
+            try:
+                self._publish_conn.close()
+            except Exception:
+                pass
+        self._publish_conn = None
+
+    def _close_listener(self):
+        """LISTEN用の接続の受信登録を外して閉じる"""
+        conn, self._listen_conn = self._listen_conn, None
+        if conn is None:
+            return
+        try:
+            asyncio.get_running_loop().remove_reader(conn.fileno())
+        except Exception:
+            pass
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _on_readable(self):
+        """通知を受信"""
+        try:
+            self._listen_conn.poll()
+        except Exception as e:
+            logger.error(f"バックプレーン受信エラー（再接続します）: {e}")
+            self._close_listener()
+            if self._reconnect_task is None:
+                self._reconnect_task = asyncio.create_task(self._reconnect())
+            return
+        while self._listen_conn.notifies:
+            notify = self._listen_conn.notifies.pop(0)
+            self._on_payload(notify.payload)
+
+    async def _reconnect(self):
+        """LISTEN用の接続を開き直すまで、間隔を延ばしながら再試行するタスク"""
+        loop = asyncio.get_running_loop()
+        delay = self.RECONNECT_MIN_DELAY
+        attempts = 0
+        try:
+            while True:
+                await asyncio.sleep(delay)
+                attempts += 1
+                try:
+                    conn = await loop.run_in_executor(None, self._open_listener)
+                except Exception as e:
+                    delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+                    logger.warning(f"バックプレーンの再接続に失敗しました（{attempts}回目、{delay:.1f}秒後に再試行）: {e}")
+                    continue
+                self._listen_conn = conn
+                loop.add_reader(conn.fileno(), self._on_readable)
+                logger.info(f"バックプレーンに再接続しました: channel={self.channel}, attempts={attempts}")
+                return
+        finally:
+            self._reconnect_task = None
+
+    def _split_payload(self, message: dict) -> List[str]:
+        """メッセージを通知ペイロードに分割
+
+        ensure_ascii=True でエンコードするため文字数とバイト数が一致する。
+        形式: {worker_id}|{message_id}|{index}|{total}|{本文}
+        """
+        body = json.dumps(message, ensure_ascii=True, separators=(",", ":"))
+        pieces = [body[i:i + self.CHUNK_SIZE] for i in range(0, len(body), self.CHUNK_SIZE)] or [""]
+        message_id = uuid.uuid4().hex[:12]
+        return [
+            f"{self.worker_id}|{message_id}|{index}|{len(pieces)}|{piece}"
+            for index, piece in enumerate(pieces)
+        ]
+
+    def _on_payload(self, payload: str):
+        """通知ペイロードを組み立てて他ワーカーからのメッセージを処理"""
+        try:
+            origin, message_id, index, total, piece = payload.split("|", 4)
+            index, total = int(index), int(total)
+        except ValueError:
+            logger.warning("不正なバックプレーン通知を無視しました")
+            return
+
+        if origin == self.worker_id:
+            return  # 自ワーカーにはpublish時に配信済み
+
+        if total == 1:
+            body = piece
+        else:
+            parts = self._partials.setdefault(message_id, [None] * total)
+            parts[index] = piece
+            if any(part is None for part in parts):
+                while len(self._partials) > self.MAX_PARTIALS:
+                    self._partials.popitem(last=False)
+                return
+            del self._partials[message_id]
+            body = "".join(parts)
+
+        try:
+            message = json.loads(body)
+        except json.JSONDecodeError:
+            logger.warning("バックプレーン通知のデコードに失敗しました")
+            return
+        self._dispatch(message)
+
+    def _notify(self, payloads: List[str]):
+        """NOTIFYを発行（スレッドプール上で実行）"""
+        with self._publish_conn.cursor() as cursor:
+            for payload in payloads:
+                cursor.execute("SELECT pg_notify(%s, %s)", (self.channel, payload))
+
+    async def _publisher(self):
+        """未送信の通知を発行順に送信するタスク"""
+        loop = asyncio.get_running_loop()
+        while True:
+            payloads = await self._outbox.get()
+            try:
+                await loop.run_in_executor(None, self._notify, payloads)
+            except Exception as e:
+                logger.error(f"バックプレーン発行エラー: {e}")
+
+    def publish(self, message: dict):
+        self._dispatch(message)
+        if self._outbox is None:
+            return
+        try:
+            self._outbox.put_nowait(self._split_payload(message))
+        except asyncio.QueueFull:
+            logger.error("バックプレーンの送信待ちがあふれたためメッセージを破棄しました")
+
+def create_backplane(url: str = WS_BACKPLANE_URL) -> Backplane:
+    """設定からバックプレーンを作成"""
+    if url.startswith("postgresql://") or url.startswith("postgres://"):
+        return PostgresBackplane(url)
+    return InProcessBackplane()
@@ -3,93 +3,595 @@ WebSocket接続マネージャー
 リアルタイム通信を管理するクラス
 """
 
-from typing import Dict, List, Optional
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set, Union
 from fastapi import WebSocket, WebSocketDisconnect
-import json
+from starlette.websockets import WebSocketState
 import logging
+import os
+import time
+import uuid
 from datetime import datetime
 import asyncio
 
+from .event_bus import SessionEventBus
+from .websocket_backplane import Backplane, create_backplane
+from .websocket_protocol import DEFAULT_CODEC, FrameCodec
+
 logger = logging.getLogger(__name__)
 
+# 1接続あたりの送信タイムアウト（秒）。超過した接続は切断される
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "5.0"))
+# 1接続あたりの送信キューの最大フレーム数
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "256"))
+# 送信キューがあふれた場合の方針（OverflowPolicy を参照）
+WS_OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", "coalesce")
+# サーバーからpingを送る間隔（秒）。この間クライアントから何も届かなければpingを送る。0で無効
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "20.0"))
+# クライアントから何も届かない状態がこの秒数続いた接続を応答なしとして切断
+WS_HEARTBEAT_TIMEOUT = float(os.getenv("WS_HEARTBEAT_TIMEOUT", "60.0"))
+# ping/pong以外のメッセージがこの秒数届かない接続をアイドルとして切断。0で無効
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "0"))
+# チャットストリームの再送用にセッションごとに保持するメッセージ数
+STREAM_BUFFER_SIZE = int(os.getenv("STREAM_BUFFER_SIZE", "1000"))
+# チャットストリームの再送バッファを保持するセッション数の上限
+STREAM_BUFFER_SESSIONS = int(os.getenv("STREAM_BUFFER_SESSIONS", "100"))
+
+class OverflowPolicy:
+    """送信キューあふれ時の方針の定数"""
+    DROP_OLDEST = "drop_oldest"  # 最も古いフレームを破棄
+    COALESCE = "coalesce"        # ストリーミングチャンクを結合し、結合できなければ最古を破棄
+    DISCONNECT = "disconnect"    # 接続を切断
+
+class OutboundFrame:
+    """送信キュー上のフレーム
+    
+    ブロードキャスト時は全宛先で同じオブジェクトを共有するため、
+    エンコードは方式（FrameCodec）ごとに最初に送信されるときの一度だけ行われる。
+    """
+    
+    __slots__ = ("message", "coalesce_key", "_encoded")
+    
+    def __init__(self, message: dict):
+        self.message = message
+        self.coalesce_key = self._coalesce_key(message)
+        self._encoded: Dict[str, Union[str, bytes]] = {}
+    
+    @staticmethod
+    def _coalesce_key(message: dict) -> Optional[str]:
+        """結合可能なストリーミングチャンクであればキーを返す"""
+        data = message.get("data")
+        if isinstance(data, dict) and data.get("streaming") and "message_chunk" in data:
+            return f"{message.get('type')}:{message.get('session_id')}"
+        return None
+    
+    def encode(self, codec: FrameCodec) -> Union[str, bytes]:
+        """方式ごとにキャッシュしたエンコード結果を返す"""
+        encoded = self._encoded.get(codec.name)
+        if encoded is None:
+            encoded = codec.encode(self.message)
+            self._encoded[codec.name] = encoded
+        return encoded
+    
+    @property
+    def text(self) -> str:
+        return self.encode(DEFAULT_CODEC)
+    
+    def merge(self, following: "OutboundFrame") -> "OutboundFrame":
+        """後続のストリーミングチャンクを結合した新しいフレームを返す"""
+        data = dict(self.message["data"])
+        data["message_chunk"] = data["message_chunk"] + following.message["data"]["message_chunk"]
+        if "timestamp" in following.message["data"]:
+            data["timestamp"] = following.message["data"]["timestamp"]
+        message = dict(following.message)
+        message["data"] = data
+        return OutboundFrame(message)
+
+class Connection:
+    """個々のWebSocket接続
+    
+    送信は有界の送信キューを経由し、接続ごとのライタータスクが順に
+    ソケットへ書き込む。生産者がソケットの速度を待つことはない。
+    """
+    
+    def __init__(
+        self,
+        connection_id: str,
+        websocket: WebSocket,
+        user_id: str,
+        session_id: str,
+        queue_size: int = WS_QUEUE_SIZE,
+        overflow_policy: str = WS_OVERFLOW_POLICY,
+        codec: FrameCodec = DEFAULT_CODEC
+    ):
+        self.connection_id = connection_id
+        self.websocket = websocket
+        self.user_id = user_id
+        self.session_id = session_id
+        self.codec = codec
+        self.connected_at = datetime.now()
+        
+        # 最後にクライアントから何らかのフレームを受信した時刻と、
+        # ping/pong以外のメッセージを受信した時刻（time.monotonic）
+        self.last_seen = time.monotonic()
+        self.last_activity = self.last_seen
+        
+        self.queue: Deque[OutboundFrame] = deque()
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.writer_task: Optional[asyncio.Task] = None
+        self.wakeup = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        
+        # 送信キューの統計
+        self.sent_count = 0
+        self.dropped_count = 0
+        self.coalesced_count = 0
+        self.max_depth = 0
+    
+    def enqueue(self, frame: OutboundFrame) -> bool:
+        """フレームをキューに追加。切断すべき場合は False を返す"""
+        if len(self.queue) >= self.queue_size:
+            if self.overflow_policy == OverflowPolicy.DISCONNECT:
+                return False
+            
+            if self.overflow_policy == OverflowPolicy.COALESCE:
+                tail = self.queue[-1] if self.queue else None
+                if tail and frame.coalesce_key and tail.coalesce_key == frame.coalesce_key:
+                    # 末尾のチャンクに結合すればキューは伸びない
+                    self.queue[-1] = tail.merge(frame)
+                    self.coalesced_count += 1
+                    return True
+                if not self._coalesce_pending():
+                    self._drop_oldest()
+            else:
+                self._drop_oldest()
+        
+        self.queue.append(frame)
+        self.max_depth = max(self.max_depth, len(self.queue))
+        self.idle.clear()
+        self.wakeup.set()
+        return True
+    
+    def _drop_oldest(self):
+        """最も古いフレームを破棄"""
+        if self.queue:
+            self.queue.popleft()
+            self.dropped_count += 1
+    
+    def _coalesce_pending(self) -> bool:
+        """キュー内で隣り合うストリーミングチャンクを1組結合する"""
+        for i in range(len(self.queue) - 1):
+            current, following = self.queue[i], self.queue[i + 1]
+            if current.coalesce_key and current.coalesce_key == following.coalesce_key:
+                self.queue[i] = current.merge(following)
+                del self.queue[i + 1]
+                self.coalesced_count += 1
+                return True
+        return False
+    
+    def get_stats(self) -> dict:
+        """送信キューの統計を取得"""
+        return {
+            "connection_id": self.connection_id,
+            "user_id": self.user_id,
+            "session_id": self.session_id,
+            "protocol": self.codec.name,
+            "idle_seconds": round(time.monotonic() - self.last_activity, 1),
+            "depth": len(self.queue),
+            "max_depth": self.max_depth,
+            "sent": self.sent_count,
+            "dropped": self.dropped_count,
+            "coalesced": self.coalesced_count
+        }
+
 class ConnectionManager:
-    """WebSocket接続を管理するクラス"""
+    """WebSocket接続を管理するクラス
+    
+    接続は connection_id をキーに保持し、ユーザー別・セッション別の索引から
+    接続オブジェクトを直接引けるようにしている。同一ユーザーが複数タブ・
+    複数セッションに同時接続できる。
+    
+    送信はメッセージを一度だけエンコードした共有フレームを各接続の送信キューへ
+    積むだけで完了する。実際の書き込みは接続ごとのライタータスクが行い、
+    send_timeout 内に送信できなかった接続は切断される。
+    
+    ハーフオープンの接続は送信が失敗するまで検出できないため、スイーパーが
+    heartbeat_interval ごとに無通信の接続へpingを送り、heartbeat_timeout を
+    超えて何も届かない接続と idle_timeout を超えて操作のない接続を切断する。
+    
+    セッション・ユーザー・全体へのブロードキャストとセッションイベントは
+    バックプレーンに一度だけ発行され、各ワーカーが自身の保持する接続へ配信する。
+    接続の索引と統計はワーカーごとのローカルな値である。
+    """
     
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-        self.user_sessions: Dict[str, str] = {}  # user_id -> session_id
-        self.session_connections: Dict[str, List[str]] = {}  # session_id -> [user_ids]
+    def __init__(
+        self,
+        send_timeout: float = WS_SEND_TIMEOUT,
+        queue_size: int = WS_QUEUE_SIZE,
+        overflow_policy: str = WS_OVERFLOW_POLICY,
+        backplane: Optional[Backplane] = None,
+        heartbeat_interval: float = WS_HEARTBEAT_INTERVAL,
+        heartbeat_timeout: float = WS_HEARTBEAT_TIMEOUT,
+        idle_timeout: float = WS_IDLE_TIMEOUT
+    ):
+        self.send_timeout = send_timeout
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.idle_timeout = idle_timeout
+        self.active_connections: Dict[str, Connection] = {}  # connection_id -> Connection
+        self.user_connections: Dict[str, Dict[str, Connection]] = {}  # user_id -> {connection_id: Connection}
+        self.session_connections: Dict[str, Dict[str, Connection]] = {}  # session_id -> {connection_id: Connection}
+        self.event_bus = SessionEventBus(sink=self._deliver_event, forward=self._forward_event)
+        # チャットメッセージ（Claude応答のチャンクを含む）の連番付きストリーム
+        self.stream_bus = SessionEventBus(
+            sink=self._deliver_event,
+            forward=self._forward_stream,
+            buffer_size=STREAM_BUFFER_SIZE,
+            max_sessions=STREAM_BUFFER_SESSIONS,
+            coalesce_rules={}
+        )
+        self.backplane = backplane or create_backplane()
+        self.backplane.set_handler(self._on_backplane_message)
+        self._close_tasks: Set[asyncio.Task] = set()
+        self._sweeper_task: Optional[asyncio.Task] = None
+        
+        # スイーパーの統計
+        self.pings_sent = 0
+        self.reaped_count = 0
+        self.reaped_by_reason: Dict[str, int] = {}
+        self.last_sweep_at: Optional[str] = None
+    
+    async def start(self):
+        """バックプレーンとスイーパーを開始（アプリケーション起動時に呼び出す）"""
+        await self.backplane.start()
+        if self.heartbeat_interval > 0 and not self._sweeper_task:
+            self._sweeper_task = asyncio.create_task(self._sweeper())
+    
+    async def stop(self):
+        """スイーパーとバックプレーンを停止（アプリケーション終了時に呼び出す）"""
+        if self._sweeper_task:
+            self._sweeper_task.cancel()
+            self._sweeper_task = None
+        await self.backplane.stop()
         
-    async def connect(self, websocket: WebSocket, user_id: str, session_id: str):
-        """WebSocket接続を管理に追加（acceptは呼び出し元で実行済み）"""
-        connection_id = f"{user_id}_{session_id}_{datetime.now().timestamp()}"
+    async def connect(
+        self,
+        websocket: WebSocket,
+        user_id: str,
+        session_id: str,
+        codec: FrameCodec = DEFAULT_CODEC
+    ):
+        """WebSocket接続を管理に追加（acceptは呼び出し元で実行済み）
         
-        self.active_connections[connection_id] = websocket
-        self.user_sessions[user_id] = session_id
+        codec はネゴシエーション済みの送信フレームのエンコード方式。
+        """
+        connection_id = f"{user_id}_{session_id}_{uuid.uuid4().hex}"
+        connection = Connection(
+            connection_id, websocket, user_id, session_id,
+            queue_size=self.queue_size,
+            overflow_policy=self.overflow_policy,
+            codec=codec
+        )
         
-        if session_id not in self.session_connections:
-            self.session_connections[session_id] = []
-        if user_id not in self.session_connections[session_id]:
-            self.session_connections[session_id].append(user_id)
+        self.active_connections[connection_id] = connection
+        self.user_connections.setdefault(user_id, {})[connection_id] = connection
+        self.session_connections.setdefault(session_id, {})[connection_id] = connection
+        connection.writer_task = asyncio.create_task(self._writer(connection))
             
         logger.info(f"WebSocket接続が確立されました: {connection_id}")
         return connection_id
         
-    def disconnect(self, connection_id: str, user_id: str, session_id: str):
-        """WebSocket接続を切断"""
-        if connection_id in self.active_connections:
-            del self.active_connections[connection_id]
-            
-        if user_id in self.user_sessions:
-            del self.user_sessions[user_id]
-            
-        if session_id in self.session_connections:
-            if user_id in self.session_connections[session_id]:
-                self.session_connections[session_id].remove(user_id)
-            if not self.session_connections[session_id]:
-                del self.session_connections[session_id]
+    def disconnect(self, connection_id: str, user_id: Optional[str] = None, session_id: Optional[str] = None):
+        """WebSocket接続を切断
+        
+        user_id / session_id は互換性のために受け付けるが、索引の更新には
+        接続オブジェクト自身が保持する値を使用する。
+        """
+        connection = self.active_connections.pop(connection_id, None)
+        if not connection:
+            return
+        
+        self._unindex(self.user_connections, connection.user_id, connection_id)
+        self._unindex(self.session_connections, connection.session_id, connection_id)
+        
+        # 未送信のフレームを破棄してライタータスクを停止
+        connection.queue.clear()
+        connection.idle.set()
+        if connection.writer_task and connection.writer_task is not asyncio.current_task():
+            connection.writer_task.cancel()
                 
         logger.info(f"WebSocket接続が切断されました: {connection_id}")
+    
+    @staticmethod
+    def _unindex(index: Dict[str, Dict[str, Connection]], key: str, connection_id: str):
+        """索引から接続を取り除き、空になったエントリを削除"""
+        connections = index.get(key)
+        if connections is None:
+            return
+        connections.pop(connection_id, None)
+        if not connections:
+            del index[key]
+    
+    async def _writer(self, connection: Connection):
+        """送信キューを順にソケットへ書き込むライタータスク"""
+        try:
+            while True:
+                if not connection.queue:
+                    connection.idle.set()
+                    connection.wakeup.clear()
+                    await connection.wakeup.wait()
+                    continue
+                
+                frame = connection.queue.popleft()
+                if not await self._send_frame(connection, frame.encode(connection.codec)):
+                    await self._evict(connection, "送信タイムアウト")
+                    return
+                connection.sent_count += 1
+        except asyncio.CancelledError:
+            pass
         
-    async def send_personal_message(self, message: dict, connection_id: str):
-        """特定の接続にメッセージを送信"""
-        if connection_id in self.active_connections:
-            websocket = self.active_connections[connection_id]
+    async def _send_frame(self, connection: Connection, frame: Union[str, bytes]) -> bool:
+        """エンコード済みフレームを送信し、成功したかを返す"""
+        try:
+            if isinstance(frame, bytes):
+                send = connection.websocket.send_bytes(frame)
+            else:
+                send = connection.websocket.send_text(frame)
+            await asyncio.wait_for(send, timeout=self.send_timeout)
+            return True
+        except asyncio.TimeoutError:
+            logger.warning(f"送信タイムアウト（{self.send_timeout}秒）: {connection.connection_id}")
+        except Exception as e:
+            logger.error(f"メッセージ送信エラー: {e}")
+        return False
+    
+    async def _evict(self, connection: Connection, reason: str, code: int = 1011):
+        """送信できなくなった接続を管理から外して閉じる"""
+        self.disconnect(connection.connection_id)
+        try:
+            await asyncio.wait_for(
+                connection.websocket.close(code=code, reason=reason),
+                timeout=self.send_timeout
+            )
+        except Exception:
+            pass  # すでに閉じられている場合は無視
+        
+    def _close_in_background(self, connection: Connection, reason: str, code: int = 1011):
+        """接続の切断をバックグラウンドで実行"""
+        task = asyncio.create_task(self._evict(connection, reason, code))
+        self._close_tasks.add(task)
+        task.add_done_callback(self._close_tasks.discard)
+    
+    def touch(self, connection_id: str, activity: bool = True):
+        """クライアントからの受信を記録（activity=False はping/pongなどの生存確認）"""
+        connection = self.active_connections.get(connection_id)
+        if not connection:
+            return
+        connection.last_seen = time.monotonic()
+        if activity:
+            connection.last_activity = connection.last_seen
+    
+    def sweep(self, now: Optional[float] = None) -> int:
+        """全接続の生存確認を一巡し、切断した接続数を返す
+        
+        - ソケットがすでに閉じている接続は即座に管理から外す
+        - heartbeat_timeout を超えて何も受信していない接続は応答なしとして切断
+        - idle_timeout を超えて操作のない接続はアイドルとして切断
+        - heartbeat_interval 以上何も受信していない接続にはpingを送る
+        """
+        now = time.monotonic() if now is None else now
+        reaped = 0
+        
+        for connection in list(self.active_connections.values()):
+            silent = now - connection.last_seen
+            if self._is_closed(connection):
+                self.disconnect(connection.connection_id)
+                reason = "closed"
+            elif self.heartbeat_timeout > 0 and silent > self.heartbeat_timeout:
+                self._close_in_background(connection, "応答がありません", code=1001)
+                reason = "unresponsive"
+            elif self.idle_timeout > 0 and now - connection.last_activity > self.idle_timeout:
+                self._close_in_background(connection, "アイドルタイムアウト", code=1000)
+                reason = "idle"
+            else:
+                if self.heartbeat_interval > 0 and silent >= self.heartbeat_interval:
+                    self._fanout([connection], self._ping_message(connection))
+                    self.pings_sent += 1
+                continue
+            
+            logger.info(f"WebSocket接続を回収しました（{reason}）: {connection.connection_id}")
+            self.reaped_by_reason[reason] = self.reaped_by_reason.get(reason, 0) + 1
+            reaped += 1
+        
+        self.reaped_count += reaped
+        self.last_sweep_at = datetime.now().isoformat()
+        return reaped
+    
+    @staticmethod
+    def _is_closed(connection: Connection) -> bool:
+        """ソケットがすでに閉じているか"""
+        return WebSocketState.DISCONNECTED in (
+            getattr(connection.websocket, "client_state", None),
+            getattr(connection.websocket, "application_state", None)
+        )
+    
+    @staticmethod
+    def _ping_message(connection: Connection) -> dict:
+        return WebSocketMessage(
+            MessageType.PING,
+            {"timestamp": datetime.now().isoformat()},
+            session_id=connection.session_id
+        ).to_dict()
+    
+    async def _sweeper(self):
+        """定期的に sweep を実行するタスク"""
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
             try:
-                await websocket.send_text(json.dumps(message, ensure_ascii=False))
+                reaped = self.sweep()
+                if reaped:
+                    logger.info(f"応答のないWebSocket接続を{reaped}件回収しました")
             except Exception as e:
-                logger.error(f"メッセージ送信エラー: {e}")
+                logger.error(f"WebSocketスイーパーエラー: {e}")
+    
+    def _fanout(self, connections: List[Connection], message: dict) -> int:
+        """共有フレームを各接続の送信キューに積み、受け付けた接続数を返す"""
+        if not connections:
+            return 0
+        
+        frame = OutboundFrame(message)
+        accepted = 0
+        for connection in connections:
+            if connection.enqueue(frame):
+                accepted += 1
+                continue
+            # 送信キューあふれ（切断方針）
+            logger.warning(f"送信キューがあふれたため接続を切断します: {connection.connection_id}")
+            self._close_in_background(connection, "送信キューあふれ")
+        return accepted
+        
+    async def send_personal_message(self, message: dict, connection_id: str):
+        """特定の接続にメッセージを送信"""
+        connection = self.active_connections.get(connection_id)
+        if connection:
+            self._fanout([connection], message)
                 
     async def send_to_user(self, message: dict, user_id: str):
-        """特定のユーザーにメッセージを送信"""
-        user_connections = [conn_id for conn_id in self.active_connections.keys() 
-                           if conn_id.startswith(f"{user_id}_")]
-        
-        for connection_id in user_connections:
-            await self.send_personal_message(message, connection_id)
+        """特定のユーザーの全接続にメッセージを送信"""
+        self.backplane.publish({"scope": "user", "target": user_id, "message": message})
             
     async def broadcast_to_session(self, message: dict, session_id: str):
-        """セッション内の全ユーザーにメッセージをブロードキャスト"""
-        if session_id in self.session_connections:
-            for user_id in self.session_connections[session_id]:
-                await self.send_to_user(message, user_id)
+        """セッション内の全接続にメッセージをブロードキャスト"""
+        self.backplane.publish({"scope": "session", "target": session_id, "message": message})
                 
     async def broadcast_to_all(self, message: dict):
         """全接続にメッセージをブロードキャスト"""
-        for connection_id in self.active_connections:
-            await self.send_personal_message(message, connection_id)
+        self.backplane.publish({"scope": "all", "message": message})
+    
+    def _on_backplane_message(self, envelope: dict):
+        """バックプレーンから届いたメッセージを自ワーカーの接続へ配信"""
+        scope = envelope.get("scope")
+        target = envelope.get("target")
+        message = envelope.get("message")
+        
+        if scope == "session":
+            self._fanout(list(self.session_connections.get(target, {}).values()), message)
+        elif scope == "user":
+            self._fanout(list(self.user_connections.get(target, {}).values()), message)
+        elif scope == "all":
+            self._fanout(list(self.active_connections.values()), message)
+        elif scope == "event":
+            self.event_bus.emit(target, message)
+        elif scope == "stream":
+            self.stream_bus.emit(target, message)
+        else:
+            logger.warning(f"未対応のバックプレーンメッセージ: {scope}")
+    
+    async def send_to_session(self, session_id: str, event: Union[str, dict]):
+        """セッションイベントを発行
+        
+        イベントは発行元ワーカーのイベントバスで結合されたのちバックプレーンへ
+        発行され、各ワーカーで連番付与・記録されたうえでセッション内の接続に配信される。
+        """
+        self.event_bus.publish(session_id, event)
+    
+    def _forward_event(self, session_id: str, event: dict):
+        """結合済みのイベントをバックプレーン経由で全ワーカーへ送る"""
+        self.backplane.publish({"scope": "event", "target": session_id, "message": event})
+    
+    async def broadcast_chat(self, message: dict, session_id: str):
+        """チャットメッセージを連番付きでセッション内にブロードキャスト
+        
+        メッセージはセッションのチャットストリームに記録され、再接続した
+        クライアントは replay_stream() で取りこぼした分を受け取れる。
+        """
+        self.stream_bus.publish(session_id, message)
+    
+    def _forward_stream(self, session_id: str, message: dict):
+        """チャットメッセージをバックプレーン経由で全ワーカーへ送る"""
+        self.backplane.publish({"scope": "stream", "target": session_id, "message": message})
+    
+    def _deliver_event(self, session_id: str, event: dict):
+        """イベントバスから配信されたイベントをセッション内の接続に送る"""
+        self._fanout(list(self.session_connections.get(session_id, {}).values()), event)
+    
+    async def replay_events(self, connection_id: str, last_seq: int) -> bool:
+        """last_seq 以降のセッションイベントを接続に再送し、欠落がなかったかを返す"""
+        return self._replay(self.event_bus, connection_id, last_seq)
+    
+    async def replay_stream(self, connection_id: str, last_seq: int) -> bool:
+        """last_seq 以降のチャットストリームを接続に再送し、欠落がなかったかを返す"""
+        return self._replay(self.stream_bus, connection_id, last_seq)
+    
+    def _replay(self, bus: SessionEventBus, connection_id: str, last_seq: int) -> bool:
+        """バスのリングバッファから接続へ再送"""
+        connection = self.active_connections.get(connection_id)
+        if not connection:
+            return False
+        
+        events, complete = bus.replay(connection.session_id, last_seq)
+        for event in events:
+            self._fanout([connection], event)
+        return complete
+    
+    async def drain(self):
+        """全接続の送信キューが空になるまで待機"""
+        await asyncio.gather(
+            *(connection.idle.wait() for connection in list(self.active_connections.values()))
+        )
+    
+    def get_connection(self, connection_id: str) -> Optional[Connection]:
+        """接続オブジェクトを取得"""
+        return self.active_connections.get(connection_id)
             
     def get_active_sessions(self) -> List[str]:
         """アクティブなセッション一覧を取得"""
         return list(self.session_connections.keys())
         
     def get_session_users(self, session_id: str) -> List[str]:
-        """セッション内のユーザー一覧を取得"""
-        return self.session_connections.get(session_id, [])
+        """セッション内のユーザー一覧を取得（重複なし、接続順）"""
+        connections = self.session_connections.get(session_id, {})
+        return list(dict.fromkeys(connection.user_id for connection in connections.values()))
+    
+    def get_user_sessions(self, user_id: str) -> Set[str]:
+        """ユーザーが接続しているセッション一覧を取得"""
+        return {connection.session_id for connection in self.user_connections.get(user_id, {}).values()}
         
     def get_connection_count(self) -> int:
         """アクティブな接続数を取得"""
         return len(self.active_connections)
+    
+    def get_queue_stats(self, detailed: bool = False) -> dict:
+        """送信キューの統計を取得（detailed=True で接続ごとの内訳を含める）"""
+        connections = [connection.get_stats() for connection in self.active_connections.values()]
+        stats = {
+            "total_depth": sum(item["depth"] for item in connections),
+            "max_depth": max((item["depth"] for item in connections), default=0),
+            "dropped": sum(item["dropped"] for item in connections),
+            "coalesced": sum(item["coalesced"] for item in connections),
+            "queue_size": self.queue_size,
+            "overflow_policy": self.overflow_policy
+        }
+        if detailed:
+            stats["connections"] = connections
+        return stats
+    
+    def get_heartbeat_stats(self) -> dict:
+        """ハートビートとスイーパーの統計を取得"""
+        return {
+            "interval": self.heartbeat_interval,
+            "timeout": self.heartbeat_timeout,
+            "idle_timeout": self.idle_timeout,
+            "running": self._sweeper_task is not None,
+            "pings_sent": self.pings_sent,
+            "reaped": self.reaped_count,
+            "reaped_by_reason": dict(self.reaped_by_reason),
+            "last_sweep_at": self.last_sweep_at
+        }
 
 # グローバルインスタンス
 manager = ConnectionManager()
@@ -101,6 +603,9 @@ class MessageType:
     SYSTEM = "system"
     STATUS = "status"
     ERROR = "error"
+    PING = "ping"
+    PONG = "pong"
+    CANCEL = "cancel"
     
 class WebSocketMessage:
     """WebSocketメッセージの構造"""
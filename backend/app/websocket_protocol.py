@@ -0,0 +1,195 @@
+"""
+WebSocketプロトコルネゴシエーション
+Sec-WebSocket-Protocol で送信フレームのエンコード方式を選択する
+
+- 指定なし / "json.v1": 従来どおりのJSONテキストフレーム
+- "json.compact.v1": 短縮キーのJSONテキストフレーム
+- "msgpack.v1": 短縮キーのMessagePackバイナリフレーム
+- "terminal.binary.v1": ターミナル出力をUTF-8のバイナリフレームで送信
+
+ターミナルの接続では、"\\x00" で始まるテキストフレームをJSONの制御メッセージ
+（resize・signal）として扱い、それ以外のフレームは入力として扱う。
+
+permessage-deflate はWebSocketの拡張としてuvicornが交渉する
+（--ws-per-message-deflate、既定で有効）。
+"""
+
+import json
+import logging
+from typing import Any, Dict, List, Optional, Union
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+# MessagePackの利用可能性をチェック
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+    logging.warning("msgpack not available, binary WebSocket protocol disabled")
+
+logger = logging.getLogger(__name__)
+
+# 短縮キーの対応表（メッセージのトップレベルと data 直下に適用）
+SHORT_KEYS: Dict[str, str] = {
+    "type": "t",
+    "data": "d",
+    "user_id": "u",
+    "session_id": "s",
+    "timestamp": "ts",
+    "message": "m",
+    "message_chunk": "c",
+    "stream_id": "r",
+    "sender": "f",
+    "model": "md",
+    "streaming": "st",
+    "complete": "cp",
+    "seq": "q",
+    "error": "e",
+}
+LONG_KEYS: Dict[str, str] = {short: long for long, short in SHORT_KEYS.items()}
+
+def _rename(value: Dict[str, Any], table: Dict[str, str]) -> Dict[str, Any]:
+    return {table.get(key, key): item for key, item in value.items()}
+
+def compact_message(message: dict) -> dict:
+    """メッセージを短縮形に変換
+
+    値が None のフィールドと、接続ごとに自明な session_id を省略し、
+    キーを短縮する。
+    """
+    compact = {
+        key: value for key, value in message.items()
+        if value is not None and key != "session_id"
+    }
+    data = compact.get("data")
+    if isinstance(data, dict):
+        compact["data"] = _rename({key: value for key, value in data.items() if value is not None}, SHORT_KEYS)
+    return _rename(compact, SHORT_KEYS)
+
+def expand_message(message: dict) -> dict:
+    """短縮形のメッセージを通常の形式に戻す"""
+    expanded = _rename(message, LONG_KEYS)
+    data = expanded.get("data")
+    if isinstance(data, dict):
+        expanded["data"] = _rename(data, LONG_KEYS)
+    return expanded
+
+class FrameCodec:
+    """送受信フレームのエンコード方式（従来のJSON）"""
+
+    name = "json"
+    subprotocol: Optional[str] = None
+    binary = False
+
+    def encode(self, message: dict) -> Union[str, bytes]:
+        return json.dumps(message, ensure_ascii=False)
+
+    def decode(self, data: Union[str, bytes]) -> dict:
+        return json.loads(data)
+
+class JsonCodec(FrameCodec):
+    """明示的に要求された従来のJSON"""
+
+    name = "json.v1"
+    subprotocol = "json.v1"
+
+class CompactJsonCodec(FrameCodec):
+    """短縮キーのJSON"""
+
+    name = "json.compact.v1"
+    subprotocol = "json.compact.v1"
+
+    def encode(self, message: dict) -> str:
+        return json.dumps(compact_message(message), ensure_ascii=False, separators=(",", ":"))
+
+    def decode(self, data: Union[str, bytes]) -> dict:
+        return expand_message(json.loads(data))
+
+class MsgpackCodec(FrameCodec):
+    """短縮キーのMessagePack"""
+
+    name = "msgpack.v1"
+    subprotocol = "msgpack.v1"
+    binary = True
+
+    def encode(self, message: dict) -> bytes:
+        return msgpack.packb(compact_message(message), use_bin_type=True)
+
+    def decode(self, data: Union[str, bytes]) -> dict:
+        if isinstance(data, str):
+            return expand_message(json.loads(data))
+        return expand_message(msgpack.unpackb(data, raw=False))
+
+DEFAULT_CODEC = FrameCodec()
+
+# サーバーの優先順（クライアントが複数提示した場合は上から選択）
+CHAT_CODECS: List[FrameCodec] = (
+    [MsgpackCodec()] if MSGPACK_AVAILABLE else []
+) + [CompactJsonCodec(), JsonCodec()]
+
+class TerminalProtocol:
+    """ターミナル出力の送信方式"""
+
+    TEXT = None
+    BINARY = "terminal.binary.v1"
+
+class TerminalControl:
+    """ターミナルの制御メッセージの種類"""
+    
+    PREFIX = "\x00"
+    RESIZE = "resize"  # {"type": "resize", "rows": 40, "cols": 120}
+    SIGNAL = "signal"  # {"type": "signal", "signal": "SIGINT"}
+    ERROR = "error"    # サーバーからの応答 {"type": "error", "message": "..."}
+
+def parse_terminal_control(text: str) -> Optional[dict]:
+    """制御メッセージならデコードして返す（入力なら None）
+    
+    制御メッセージとして不正な場合は ValueError を送出する。
+    """
+    if not text.startswith(TerminalControl.PREFIX):
+        return None
+    try:
+        message = json.loads(text[len(TerminalControl.PREFIX):])
+    except json.JSONDecodeError as e:
+        raise ValueError(f"制御メッセージのデコードに失敗しました: {e}")
+    if not isinstance(message, dict) or "type" not in message:
+        raise ValueError("制御メッセージに type がありません")
+    return message
+
+def encode_terminal_control(message: dict) -> str:
+    """サーバーからの制御メッセージをエンコード"""
+    return TerminalControl.PREFIX + json.dumps(message, ensure_ascii=False)
+
+def requested_subprotocols(websocket: WebSocket) -> List[str]:
+    """クライアントが提示したサブプロトコル一覧を取得"""
+    return list(websocket.scope.get("subprotocols") or [])
+
+def negotiate_codec(websocket: WebSocket, codecs: List[FrameCodec] = CHAT_CODECS) -> FrameCodec:
+    """クライアントの提示からエンコード方式を選択（該当なしは従来のJSON）"""
+    requested = requested_subprotocols(websocket)
+    for codec in codecs:
+        if codec.subprotocol in requested:
+            return codec
+    return DEFAULT_CODEC
+
+def negotiate_terminal_protocol(websocket: WebSocket) -> Optional[str]:
+    """ターミナル出力の送信方式を選択"""
+    if TerminalProtocol.BINARY in requested_subprotocols(websocket):
+        return TerminalProtocol.BINARY
+    return TerminalProtocol.TEXT
+
+async def receive_message(websocket: WebSocket, codec: FrameCodec) -> dict:
+    """フレームを受信してデコード
+
+    テキストフレームとバイナリフレームのどちらも受け付ける。
+    切断時は WebSocketDisconnect、デコード失敗時は ValueError を送出する。
+    """
+    frame = await websocket.receive()
+    if frame["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(frame.get("code", 1000), frame.get("reason"))
+    data = frame.get("bytes") if frame.get("bytes") is not None else frame.get("text")
+    try:
+        return codec.decode(data)
+    except Exception as e:
+        raise ValueError(f"フレームのデコードに失敗しました: {e}")
@@ -5,8 +5,9 @@ sessions ルーターのテスト
 import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy.orm import Session
-from app.models import Session as SessionModel
+from app.models import Session as SessionModel, ClaudeMessage
 import uuid
+from datetime import datetime
 
 
 @pytest.mark.api
@@ -205,6 +206,24 @@ class TestSessionsRouter:
         get_response = client.get(f"/api/sessions/{session_id}", headers=auth_headers)
         assert get_response.status_code == 404
     
+    def test_delete_session_purges_history(self, client: TestClient, auth_headers, db: Session):
+        """セッション削除でターミナルを含むメッセージ履歴も削除されることのテスト"""
+        session_ids = []
+        for name in ["History Session", "Other Session"]:
+            response = client.post("/api/sessions/", json={"name": name}, headers=auth_headers)
+            session_ids.append(response.json()["session_id"])
+        for session_id in session_ids:
+            # チャットの履歴とClaudeターミナルの履歴
+            for history_id in [session_id, f"{session_id}_claude"]:
+                db.add(ClaudeMessage(session_id=history_id, sender="user", content="hello", created_at=datetime.now()))
+        db.commit()
+        
+        response = client.delete(f"/api/sessions/{session_ids[0]}", headers=auth_headers)
+        
+        assert response.status_code == 200
+        remaining = [row.session_id for row in db.query(ClaudeMessage).order_by(ClaudeMessage.id)]
+        assert remaining == [session_ids[1], f"{session_ids[1]}_claude"]
+    
     def test_delete_session_not_found(self, client: TestClient, auth_headers):
         """存在しないセッション削除のテスト"""
         fake_session_id = str(uuid.uuid4())
@@ -281,6 +281,36 @@ class TestTerminalWebSocket:
             mock_terminal.start_terminal.assert_called_once()
 
 
+    def test_websocket_recreates_closed_terminal(self, client: TestClient, db, test_user):
+        """終了済みのターミナルには再接続せず作り直すことのテスト"""
+        from app.models import Session as SessionModel
+        from app.terminal_managers import active_terminals
+        
+        db.add(SessionModel(session_id="closed-session", name="Closed Terminal", user_id=test_user.id))
+        db.commit()
+        
+        # シェルが終了した（またはブローカーとの接続が切れた）ターミナル
+        stale = MagicMock(closed=True)
+        stale.cleanup = AsyncMock()
+        active_terminals["closed-session_basic"] = stale
+        
+        fresh = MagicMock(closed=False)
+        fresh.start_terminal = AsyncMock()
+        fresh.subscribe.return_value = MagicMock(scrollback="", readonly=False, get=AsyncMock(return_value=None))
+        
+        try:
+            with patch("app.routers.terminal.get_terminal_manager", return_value=fresh):
+                with client.websocket_connect("/api/terminal/ws/closed-session") as websocket:
+                    message = websocket.receive_text()
+            
+            assert "ターミナルに接続しました" in message
+            stale.cleanup.assert_awaited_once()
+            fresh.start_terminal.assert_awaited_once()
+            assert active_terminals["closed-session_basic"] is fresh
+        finally:
+            active_terminals.pop("closed-session_basic", None)
+
+
 @pytest.mark.unit
 class TestTerminalActiveConnections:
     """アクティブターミナル接続の管理テスト"""
@@ -0,0 +1,247 @@
+"""
+websocket ルーターのテスト
+"""
+
+import pytest
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from app.routers.websocket import ClaudeWebSocketHandler, StreamBatcher
+
+
+@pytest.mark.unit
+class TestStreamBatcher:
+    """StreamBatcherのテスト"""
+    
+    @pytest.mark.asyncio
+    async def test_first_chunk_is_sent_immediately(self):
+        """最初のチャンクが即座に送信されることのテスト"""
+        send = AsyncMock()
+        batcher = StreamBatcher(send, flush_interval=10, flush_size=4096)
+        
+        await batcher.add("Hello")
+        await batcher.add(", ")
+        await batcher.add("world")
+        
+        send.assert_called_once_with("Hello")
+        await batcher.close()
+        assert send.call_args.args[0] == ", world"
+        assert batcher.text == "Hello, world"
+        
+    @pytest.mark.asyncio
+    async def test_flush_by_interval(self):
+        """一定時間ごとにまとめて送信されることのテスト"""
+        send = AsyncMock()
+        batcher = StreamBatcher(send, flush_interval=0.02, flush_size=4096)
+        
+        for chunk in ["a", "b", "c", "d"]:
+            await batcher.add(chunk)
+        await asyncio.sleep(0.05)
+        
+        assert [call.args[0] for call in send.call_args_list] == ["a", "bcd"]
+        await batcher.close()
+        assert send.call_count == 2
+        
+    @pytest.mark.asyncio
+    async def test_flush_by_size(self):
+        """サイズ上限で間隔を待たずに送信されることのテスト"""
+        send = AsyncMock()
+        batcher = StreamBatcher(send, flush_interval=10, flush_size=4)
+        
+        for chunk in ["x", "ab", "cd", "e"]:
+            await batcher.add(chunk)
+        
+        assert [call.args[0] for call in send.call_args_list] == ["x", "abcd"]
+        await batcher.close()
+        assert send.call_args.args[0] == "e"
+
+    @pytest.mark.asyncio
+    async def test_flush_size_counts_bytes(self):
+        """サイズ上限が文字数ではなくUTF-8のバイト数で判定されることのテスト"""
+        send = AsyncMock()
+        batcher = StreamBatcher(send, flush_interval=10, flush_size=6)
+
+        for chunk in ["x", "あ", "い", "う"]:
+            await batcher.add(chunk)
+
+        # 2文字でも6バイトに達した時点で送信される
+        assert [call.args[0] for call in send.call_args_list] == ["x", "あい"]
+        await batcher.close()
+        assert send.call_args.args[0] == "う"
+
+    @pytest.mark.asyncio
+    async def test_zero_interval_sends_every_chunk(self):
+        """間隔0でチャンクごとに送信されることのテスト"""
+        send = AsyncMock()
+        batcher = StreamBatcher(send, flush_interval=0)
+        
+        for chunk in ["a", "", "b"]:
+            await batcher.add(chunk)
+        
+        assert [call.args[0] for call in send.call_args_list] == ["a", "b"]
+
+
+@pytest.mark.unit
+class TestClaudeStreaming:
+    """ストリーミング応答のテスト"""
+    
+    @pytest.mark.asyncio
+    async def test_streaming_batches_chunks(self):
+        """チャンクがまとめて配信され、完了メッセージに全文が入ることのテスト"""
+        async def stream(message, session_id, *args, **kwargs):
+            for i in range(100):
+                yield f"{i},"
+        
+        handler = ClaudeWebSocketHandler()
+        handler.claude_integration.send_message_stream = stream
+        
+        with patch("app.routers.websocket.manager") as mock_manager:
+            mock_manager.broadcast_chat = AsyncMock()
+            await handler._handle_claude_streaming("hello", "session1")
+        
+        messages = [call.args[0] for call in mock_manager.broadcast_chat.call_args_list]
+        chunks = [m["data"]["message_chunk"] for m in messages if m["data"].get("streaming")]
+        complete = messages[-1]["data"]
+        
+        expected = "".join(f"{i}," for i in range(100))
+        assert len(chunks) < 10
+        assert "".join(chunks) == expected
+        assert complete["complete"] is True
+        assert complete["message"] == expected
+        assert len({m["data"]["stream_id"] for m in messages}) == 1
+
+
+@pytest.mark.unit
+class TestChatDispatch:
+    """チャットのタスク実行と中止のテスト"""
+    
+    @staticmethod
+    def chat_message(text, user_id="1"):
+        from app.websocket_manager import MessageType, WebSocketMessage
+        return WebSocketMessage(MessageType.CHAT, {"message": text}, user_id=user_id, session_id="session1")
+    
+    @pytest.mark.asyncio
+    async def test_dispatch_does_not_block(self):
+        """応答生成中も呼び出し元に制御が戻ることのテスト"""
+        started = asyncio.Event()
+        release = asyncio.Event()
+        
+        async def stream(message, session_id, *args, **kwargs):
+            started.set()
+            await release.wait()
+            yield "done"
+        
+        handler = ClaudeWebSocketHandler()
+        handler.claude_integration.send_message_stream = stream
+        
+        with patch("app.routers.websocket.manager") as mock_manager:
+            mock_manager.broadcast_chat = AsyncMock()
+            task = handler.dispatch_chat_message(self.chat_message("hello"), None)
+            await started.wait()
+            
+            assert handler.get_chat_task_count() == 1
+            release.set()
+            await task
+        
+        assert handler.get_chat_task_count() == 0
+        assert handler.chat_locks == {}
+        
+    @pytest.mark.asyncio
+    async def test_plan_resolved_before_task(self):
+        """プランはタスク作成前に取得され、タスクからDBセッションを使わないことのテスト"""
+        received = []
+        
+        async def stream(message, session_id, user_id=None, plan_type=None, **kwargs):
+            received.append(plan_type)
+            yield "done"
+        
+        handler = ClaudeWebSocketHandler()
+        handler.claude_integration.send_message_stream = stream
+        db = MagicMock()
+        
+        with patch("app.routers.websocket.manager") as mock_manager, \
+             patch("app.routers.websocket.get_user_plan_type", return_value="pro"):
+            mock_manager.broadcast_chat = AsyncMock()
+            task = handler.dispatch_chat_message(self.chat_message("hello"), db)
+            # 接続側でDBセッションが閉じられても影響しない
+            db.query.side_effect = RuntimeError("session closed")
+            await task
+        
+        assert received == ["pro"]
+
+    @pytest.mark.asyncio
+    async def test_chats_run_in_order(self):
+        """同一セッションのチャットが受信順に処理されることのテスト"""
+        order = []
+        
+        async def stream(message, session_id, *args, **kwargs):
+            order.append(f"start:{message}")
+            await asyncio.sleep(0.01)
+            order.append(f"end:{message}")
+            yield message
+        
+        handler = ClaudeWebSocketHandler()
+        handler.claude_integration.send_message_stream = stream
+        
+        with patch("app.routers.websocket.manager") as mock_manager:
+            mock_manager.broadcast_chat = AsyncMock()
+            first = handler.dispatch_chat_message(self.chat_message("a"), None)
+            second = handler.dispatch_chat_message(self.chat_message("b"), None)
+            await asyncio.gather(first, second)
+        
+        assert order == ["start:a", "end:a", "start:b", "end:b"]
+        
+    @pytest.mark.asyncio
+    async def test_cancel_stops_generation(self):
+        """cancelで応答が中止され、途中までの応答で完了することのテスト"""
+        closed = asyncio.Event()
+        
+        async def stream(message, session_id, *args, **kwargs):
+            try:
+                yield "partial"
+                await asyncio.sleep(10)
+                yield "never"
+            finally:
+                closed.set()
+        
+        handler = ClaudeWebSocketHandler()
+        handler.claude_integration.send_message_stream = stream
+        
+        with patch("app.routers.websocket.manager") as mock_manager:
+            mock_manager.broadcast_chat = AsyncMock()
+            running = handler.dispatch_chat_message(self.chat_message("a"), None)
+            queued = handler.dispatch_chat_message(self.chat_message("b"), None)
+            await asyncio.sleep(0.01)
+            
+            assert handler.cancel_chat("session1", "1") == 2
+            await asyncio.gather(running, queued, return_exceptions=True)
+        
+        assert closed.is_set()
+        assert running.cancelled() and queued.cancelled()
+        last = mock_manager.broadcast_chat.call_args.args[0]["data"]
+        assert last["cancelled"] is True
+        assert last["message"] == "partial"
+        assert handler.cancel_chat("session1", "1") == 0
+        
+    @pytest.mark.asyncio
+    async def test_cancel_only_own_chats(self):
+        """cancelで同じセッションの他のユーザーのチャットは中止されないことのテスト"""
+        async def stream(message, session_id, *args, **kwargs):
+            await asyncio.sleep(0.05)
+            yield message
+        
+        handler = ClaudeWebSocketHandler()
+        handler.claude_integration.send_message_stream = stream
+        
+        with patch("app.routers.websocket.manager") as mock_manager:
+            mock_manager.broadcast_chat = AsyncMock()
+            others = handler.dispatch_chat_message(self.chat_message("a", user_id="2"), None)
+            own = handler.dispatch_chat_message(self.chat_message("b", user_id="1"), None)
+            await asyncio.sleep(0.01)
+            
+            assert handler.cancel_chat("session1", "1") == 1
+            await asyncio.gather(others, own, return_exceptions=True)
+        
+        assert own.cancelled()
+        assert not others.cancelled()
+        assert handler.get_chat_task_count() == 0
@@ -0,0 +1,235 @@
+"""
+メッセージ履歴の保存のテスト
+"""
+
+import pytest
+import pytest_asyncio
+import asyncio
+import uuid
+from datetime import datetime
+from unittest.mock import patch
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.chat_history import ChatHistoryStore
+from app.claude_integration import ClaudeCodeSession, ClaudeIntegration
+from app.models import ClaudeMessage
+
+
+@pytest.fixture
+def session_factory():
+    """claude_messages テーブルだけを持つインメモリSQLite"""
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    ClaudeMessage.__table__.create(bind=engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+
+@pytest_asyncio.fixture
+async def store(session_factory):
+    store = ChatHistoryStore(session_factory, flush_interval=60)
+    yield store
+    await store.stop()
+
+
+def count_rows(session_factory):
+    db = session_factory()
+    try:
+        return db.query(ClaudeMessage).count()
+    finally:
+        db.close()
+
+
+@pytest.mark.unit
+class TestChatHistoryStore:
+    """ChatHistoryStoreのテスト"""
+
+    @pytest.mark.asyncio
+    async def test_write_behind(self, store, session_factory):
+        """追加時には書き込まず、まとめて書き込まれることのテスト"""
+        for i in range(3):
+            store.append("session-1", "user", f"message {i}", datetime.now())
+
+        assert count_rows(session_factory) == 0
+        assert await store.flush() is True
+        assert count_rows(session_factory) == 3
+        assert store.get_stats() == {"pending": 0, "written": 3, "dropped": 0, "rejected": 0, "failures": 0}
+
+    @pytest.mark.asyncio
+    async def test_flush_size_wakes_writer(self, session_factory):
+        """一定件数がたまると間隔を待たずに書き込まれることのテスト"""
+        store = ChatHistoryStore(session_factory, flush_interval=60, flush_size=2)
+        try:
+            store.append("session-1", "user", "a", datetime.now())
+            store.append("session-1", "claude", "b", datetime.now())
+            for _ in range(100):
+                if store.written == 2:
+                    break
+                await asyncio.sleep(0.01)
+            assert count_rows(session_factory) == 2
+        finally:
+            await store.stop()
+
+    @pytest.mark.asyncio
+    async def test_pagination(self, store):
+        """カーソルで古い方・新しい方へページングできることのテスト"""
+        for i in range(7):
+            store.append("session-1", "user", f"message {i}", datetime.now())
+        store.append("session-2", "user", "other", datetime.now())
+
+        latest = await store.get_page("session-1", limit=3)
+        assert [m["content"] for m in latest["messages"]] == ["message 4", "message 5", "message 6"]
+        assert latest["total"] == 7
+        assert latest["has_more"] is True
+
+        older = await store.get_page("session-1", before=latest["next_cursor"], limit=3)
+        assert [m["content"] for m in older["messages"]] == ["message 1", "message 2", "message 3"]
+        assert older["total"] is None  # 件数は最初のページでのみ数える
+        oldest = await store.get_page("session-1", before=older["next_cursor"], limit=3)
+        assert [m["content"] for m in oldest["messages"]] == ["message 0"]
+        assert oldest["has_more"] is False
+        assert oldest["next_cursor"] is None
+
+        newer = await store.get_page("session-1", after=oldest["messages"][0]["id"], limit=4)
+        assert [m["content"] for m in newer["messages"]] == [f"message {i}" for i in range(1, 5)]
+        assert newer["next_cursor"] == newer["messages"][-1]["id"]
+
+    @pytest.mark.asyncio
+    async def test_failed_write_is_retried(self, store, session_factory):
+        """書き込みに失敗したメッセージが失われず次回に書き込まれることのテスト"""
+        store.append("session-1", "user", "first", datetime.now())
+
+        with patch.object(store, "_write_batch", side_effect=RuntimeError("database is down")):
+            assert await store.flush() is False
+        store.append("session-1", "user", "second", datetime.now())
+        assert await store.flush() is True
+
+        page = await store.get_page("session-1")
+        assert [m["content"] for m in page["messages"]] == ["first", "second"]
+        assert store.failures == 1
+
+    @pytest.mark.asyncio
+    async def test_invalid_row_does_not_block_batch(self, store, session_factory):
+        """不正なメッセージだけが破棄され、同じバッチの他のメッセージは書き込まれることのテスト"""
+        store.append("session-1", "user", "before", datetime.now())
+        store.append("session-1", None, "invalid", datetime.now())  # NOT NULL違反
+        store.append("session-1", "user", "after", datetime.now())
+
+        assert await store.flush() is True
+
+        page = await store.get_page("session-1")
+        assert [m["content"] for m in page["messages"]] == ["before", "after"]
+        assert store.get_stats() == {"pending": 0, "written": 2, "dropped": 0, "rejected": 1, "failures": 0}
+
+    @pytest.mark.asyncio
+    async def test_row_retry_requeues_on_connection_error(self, session_factory):
+        """1件ずつの書き込み中に接続エラーになった場合は残りを再試行することのテスト"""
+        calls = []
+
+        def flaky_factory():
+            db = session_factory()
+            insert = db.bulk_insert_mappings
+
+            def bulk_insert_mappings(mapper, rows):
+                calls.append(len(rows))
+                if len(calls) == 1:
+                    raise IntegrityError("INSERT", {}, Exception("invalid row"))
+                if len(calls) == 3:
+                    raise OperationalError("INSERT", {}, Exception("connection lost"))
+                return insert(mapper, rows)
+
+            db.bulk_insert_mappings = bulk_insert_mappings
+            return db
+
+        store = ChatHistoryStore(flaky_factory, flush_interval=60)
+        try:
+            for content in ["a", "b", "c"]:
+                store.append("session-1", "user", content, datetime.now())
+
+            assert await store.flush() is False
+            assert calls == [3, 1, 1]
+            assert store.get_stats() == {"pending": 2, "written": 1, "dropped": 0, "rejected": 0, "failures": 1}
+
+            assert await store.flush() is True
+            assert count_rows(session_factory) == 3
+        finally:
+            await store.stop()
+
+    @pytest.mark.asyncio
+    async def test_pending_limit(self, session_factory):
+        """書き込み待ちが上限を超えると古いものから破棄されることのテスト"""
+        store = ChatHistoryStore(session_factory, flush_interval=60, flush_size=100, pending_limit=2)
+        try:
+            for i in range(3):
+                store.append("session-1", "user", f"message {i}", datetime.now())
+            assert store.dropped == 1
+            page = await store.get_page("session-1")
+            assert [m["content"] for m in page["messages"]] == ["message 1", "message 2"]
+        finally:
+            await store.stop()
+
+    def test_session_id_fits_terminal_sessions(self):
+        """ターミナルのClaudeセッションのIDが保存できる長さであることのテスト"""
+        terminal_session_id = f"{uuid.uuid4()}_claude"
+        assert ClaudeMessage.__table__.c.session_id.type.length >= len(terminal_session_id)
+
+    def test_reused_across_event_loops(self, session_factory):
+        """アプリの起動・停止を繰り返し、別のイベントループで使えることのテスト"""
+        store = ChatHistoryStore(session_factory, flush_interval=60)
+
+        async def lifecycle(content):
+            store.start()
+            store.append("session-1", "user", content, datetime.now())
+            await asyncio.sleep(0)  # 書き込みタスクを待機状態にする
+            await store.stop()
+
+        asyncio.run(lifecycle("first"))
+        asyncio.run(lifecycle("second"))
+        assert count_rows(session_factory) == 2
+
+
+@pytest.mark.unit
+class TestSessionHistory:
+    """ClaudeCodeSessionの履歴のテスト"""
+
+    @pytest.mark.asyncio
+    async def test_memory_is_bounded_and_history_persisted(self, store):
+        """メモリには直近のみ残り、全件をページで取得できることのテスト"""
+        with patch("app.claude_integration.chat_history", store), \
+             patch("app.claude_integration.CHAT_HISTORY_PERSIST", True), \
+             patch("app.claude_integration.CHAT_HISTORY_MEMORY_LIMIT", 5):
+            integration = ClaudeIntegration()
+            await integration.create_session("history-session", "/tmp")
+            session = await integration.manager.get_session("history-session")
+            for i in range(20):
+                session.add_message("user", f"message {i}")
+
+            assert len(session.messages) == 5
+            assert session.messages[-1]["content"] == "message 19"
+            info = await integration.get_session_info("history-session")
+            assert info["message_count"] == 21  # 開始メッセージを含む
+
+            # セッションを削除しても履歴は残る
+            await integration.remove_session("history-session")
+            page = await integration.get_session_history_page("history-session", limit=10)
+
+        assert page["total"] == 22  # 開始・停止メッセージを含む
+        assert page["messages"][-1]["content"] == "Claude Code セッションが停止されました"
+        assert page["has_more"] is True
+
+    @pytest.mark.asyncio
+    async def test_history_without_persistence(self):
+        """保存が無効な場合はメモリの履歴を返すことのテスト"""
+        with patch("app.claude_integration.CHAT_HISTORY_PERSIST", False):
+            session = ClaudeCodeSession("memory-session", "/tmp")
+            integration = ClaudeIntegration()
+            integration.manager.active_sessions["memory-session"] = session
+            session.add_message("user", "hello")
+            session.add_message("claude", "hi")
+
+            page = await integration.get_session_history_page("memory-session", limit=1)
+
+        assert [m["content"] for m in page["messages"]] == ["hi"]
+        assert page["total"] == 2
@@ -3,15 +3,72 @@ Claude Code SDK統合のテスト
 """
 
 import pytest
+import asyncio
+import os
+import sys
 from unittest.mock import AsyncMock, MagicMock, patch
 from datetime import datetime
 from pathlib import Path
 
 from app.claude_integration import (
-    ClaudeCodeSession, ClaudeIntegrationManager, ClaudeIntegration, SDK_AVAILABLE
+    CapabilityProbe, ClaudeCapabilities, ClaudeCLIWorker, ClaudeCodeSession, ClaudeIntegrationManager,
+    ClaudeIntegration, CLIWorkerError, SDK_AVAILABLE, claude_capabilities
 )
 
 
+def use_backends(sdk=False, cli=False):
+    """SDK/CLIの利用可否の確認結果を差し替える"""
+    return patch.object(claude_capabilities, "get", AsyncMock(return_value=ClaudeCapabilities(sdk, cli)))
+
+
+# stream-json で応答する偽のCLI
+# - 応答は受け取ったメッセージと通し番号（同じプロセスで何通目か）を1文字ずつ返す
+# - "crash" を受け取ると、最初の1回だけ応答せずに終了する
+# - "hang" を受け取ると、応答の途中で止まる
+# - "credit" を受け取ると、エラーの結果を返す
+FAKE_CLI = """
+import json, os, sys
+argv_log, crash_marker = sys.argv[1], sys.argv[2]
+with open(argv_log, "a") as f:
+    f.write(json.dumps(sys.argv[3:]) + "\\n")
+count = 0
+def emit(event):
+    sys.stdout.write(json.dumps(event) + "\\n")
+    sys.stdout.flush()
+emit({"type": "system", "subtype": "init", "session_id": "cli-session-1"})
+for line in sys.stdin:
+    text = json.loads(line)["message"]["content"][0]["text"]
+    count += 1
+    if text == "crash" and not os.path.exists(crash_marker):
+        open(crash_marker, "w").close()
+        sys.exit(1)
+    if text == "credit":
+        emit({"type": "result", "is_error": True, "result": "Credit balance is too low"})
+        continue
+    emit({"type": "stream_event", "event": {"type": "message_start"}})
+    reply = f"{count}:{text}"
+    for char in reply:
+        emit({"type": "stream_event", "event": {"type": "content_block_delta", "delta": {"type": "text_delta", "text": char}}})
+        if text == "hang":
+            sys.stdin.readline()
+    emit({"type": "assistant", "message": {"content": [{"type": "text", "text": reply}]}})
+    emit({"type": "result", "is_error": False, "result": reply, "session_id": "cli-session-1"})
+"""
+
+
+@pytest.fixture
+def fake_cli(tmp_path):
+    """偽のCLIを起動するコマンドと、起動時の引数の記録を返す"""
+    script = tmp_path / "fake_claude.py"
+    script.write_text(FAKE_CLI)
+    launcher = tmp_path / "claude"
+    launcher.write_text(
+        f"#!/bin/sh\nexec {sys.executable} {script} {tmp_path / 'argv.log'} {tmp_path / 'crashed'} \"$@\"\n"
+    )
+    launcher.chmod(0o755)
+    return str(launcher), tmp_path / "argv.log"
+
+
 @pytest.mark.unit
 class TestClaudeCodeSession:
     """ClaudeCodeSessionクラスのテスト"""
@@ -29,7 +86,7 @@ class TestClaudeCodeSession:
         assert session.system_prompt == system_prompt
         assert session.is_active is False
         assert isinstance(session.created_at, datetime)
-        assert session.messages == []
+        assert list(session.messages) == []
     
     @pytest.mark.asyncio
     async def test_start_session_success(self):
@@ -630,4 +687,275 @@ class TestClaudeCodeSDKIntegration:
             
         finally:
             # クリーンアップ
-            await integration.remove_session(session_id)
\ No newline at end of file
+            await integration.remove_session(session_id)
+
+@pytest.mark.unit
+class TestClaudeCodeSessionCancel:
+    """応答中止のテスト"""
+    
+    @pytest.mark.asyncio
+    async def test_cli_process_is_killed_on_cancel(self):
+        """中止時にCLIのプロセスが終了されることのテスト"""
+        import asyncio
+        
+        session = ClaudeCodeSession("test-session", "/tmp")
+        process = MagicMock()
+        process.returncode = None
+        process.stdout.read = AsyncMock(side_effect=asyncio.CancelledError)
+        process.stderr.read = AsyncMock(return_value=b"")
+        process.wait = AsyncMock()
+        
+        with use_backends(cli=True), \
+             patch("app.claude_integration.CLAUDE_CLI_PERSISTENT", False), \
+             patch("asyncio.create_subprocess_exec", AsyncMock(return_value=process)):
+            with pytest.raises(asyncio.CancelledError):
+                async for _ in session.send_message("hello"):
+                    pass
+        
+        process.kill.assert_called_once()
+        process.wait.assert_awaited_once()
+        assert session.messages[-1]["content"] == "応答が中止されました"
+
+
+@pytest.mark.unit
+class TestClaudeCLIWorker:
+    """常駐CLIワーカーのテスト"""
+    
+    @pytest.mark.asyncio
+    async def test_streams_and_reuses_process(self, tmp_path, fake_cli):
+        """応答が差分で届き、同じプロセスが使い回されることのテスト"""
+        command, argv_log = fake_cli
+        worker = ClaudeCLIWorker(tmp_path, {"PATH": "/usr/bin:/bin"}, "prompt", command=command)
+        
+        try:
+            first = [chunk async for chunk in worker.send("hello")]
+            pid = worker.process.pid
+            second = [chunk async for chunk in worker.send("again")]
+        finally:
+            await worker.stop()
+        
+        assert first == list("1:hello")
+        assert "".join(second) == "2:again"
+        assert worker.process is None
+        assert pid and worker.cli_session_id == "cli-session-1"
+        assert len(argv_log.read_text().splitlines()) == 1
+    
+    @pytest.mark.asyncio
+    async def test_restart_after_crash(self, tmp_path, fake_cli):
+        """CLIが終了した場合に --resume で起動し直して再送することのテスト"""
+        command, argv_log = fake_cli
+        worker = ClaudeCLIWorker(tmp_path, {"PATH": "/usr/bin:/bin"}, command=command)
+        
+        try:
+            response = "".join([chunk async for chunk in worker.send("crash")])
+        finally:
+            await worker.stop()
+        
+        assert response == "1:crash"
+        assert worker.restarts == 1
+        launches = argv_log.read_text().splitlines()
+        assert len(launches) == 2
+        assert "--resume" not in launches[0]
+        assert '"--resume", "cli-session-1"' in launches[1]
+    
+    @pytest.mark.asyncio
+    async def test_cancel_kills_worker(self, tmp_path, fake_cli):
+        """応答の途中で中止するとプロセスが終了し、次のメッセージで起動し直すことのテスト"""
+        command, _ = fake_cli
+        worker = ClaudeCLIWorker(tmp_path, {"PATH": "/usr/bin:/bin"}, command=command)
+        received = asyncio.Event()
+        
+        async def consume():
+            async for _ in worker.send("hang"):
+                received.set()
+        
+        task = asyncio.create_task(consume())
+        await asyncio.wait_for(received.wait(), 10.0)
+        process = worker.process
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        
+        assert process.returncode is not None
+        assert not worker.is_alive
+        try:
+            response = "".join([chunk async for chunk in worker.send("next")])
+        finally:
+            await worker.stop()
+        assert response == "1:next"
+    
+    @pytest.mark.asyncio
+    async def test_session_uses_worker(self, tmp_path, fake_cli):
+        """CLIモードのセッションが常駐ワーカー経由で応答し、エラーを分類することのテスト"""
+        command, _ = fake_cli
+        session = ClaudeCodeSession("test-session", str(tmp_path))
+        
+        def worker_factory(*args):
+            return ClaudeCLIWorker(*args, command=command)
+        
+        with use_backends(cli=True), \
+             patch("app.claude_integration.CLAUDE_CLI_PERSISTENT", True), \
+             patch("app.claude_integration.ClaudeCLIWorker", side_effect=worker_factory):
+            chunks = [chunk async for chunk in session.send_message("hi")]
+            errors = [chunk async for chunk in session.send_message("credit")]
+            await session.stop_session()
+        
+        assert "".join(chunks) == "1:hi"
+        assert session.messages[1] == {**session.messages[1], "sender": "claude", "content": "1:hi"}
+        assert "クレジット残高が不足" in errors[0]
+        assert session.messages[-2]["sender"] == "error"
+        assert session.cli_worker is None
+    
+    @pytest.mark.asyncio
+    async def test_missing_cli(self, tmp_path):
+        """CLIが存在しない場合のテスト"""
+        worker = ClaudeCLIWorker(tmp_path, {"PATH": "/usr/bin:/bin"}, command=str(tmp_path / "missing"))
+        
+        with pytest.raises(FileNotFoundError):
+            async for _ in worker.send("hello"):
+                pass
+        assert isinstance(CLIWorkerError("x"), Exception)
+
+
+@pytest.mark.unit
+class TestClaudeCLIOneshot:
+    """メッセージごとに起動するCLIのテスト"""
+    
+    @pytest.fixture
+    def oneshot_cli(self, tmp_path, monkeypatch):
+        """PATHの先頭に偽の claude を置く
+        
+        最初の1文字を書いてから少し待ち、残りは1バイトずつ書く。stderr にも大量に書く。
+        """
+        script = tmp_path / "claude"
+        script.write_text(
+            f"#!{sys.executable}\n"
+            "import sys, time\n"
+            "sys.stderr.write('x' * 200000)\n"
+            "out = sys.stdout.buffer\n"
+            "data = ('応答' + sys.argv[-1]).encode('utf-8')\n"
+            "out.write(data[:3]); out.flush(); time.sleep(0.3)\n"
+            "for i in range(3, len(data)):\n"
+            "    out.write(data[i:i + 1]); out.flush()\n"
+            "sys.stderr.write('Credit balance is too low' if sys.argv[-1] == 'credit' else '')\n"
+            "sys.exit(1 if sys.argv[-1] == 'credit' else 0)\n"
+        )
+        script.chmod(0o755)
+        monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+    
+    @pytest.mark.asyncio
+    async def test_streams_stdout_incrementally(self, tmp_path, oneshot_cli):
+        """出力が終了を待たずに届き、分割された文字が壊れないことのテスト"""
+        session = ClaudeCodeSession("test-session", str(tmp_path))
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        arrivals = []
+        
+        with use_backends(cli=True), \
+             patch("app.claude_integration.CLAUDE_CLI_PERSISTENT", False):
+            async for chunk in session.send_message("hi"):
+                arrivals.append((loop.time() - started, chunk))
+        
+        assert "".join(chunk for _, chunk in arrivals) == "応答hi"
+        assert arrivals[0][1] == "応"
+        assert arrivals[-1][0] - arrivals[0][0] >= 0.2
+        assert session.messages[-1]["content"] == "応答hi"
+    
+    @pytest.mark.asyncio
+    async def test_error_classified_at_end(self, tmp_path, oneshot_cli):
+        """終了コードが0以外の場合に最後にエラーを分類することのテスト"""
+        session = ClaudeCodeSession("test-session", str(tmp_path))
+        
+        with use_backends(cli=True), \
+             patch("app.claude_integration.CLAUDE_CLI_PERSISTENT", False):
+            chunks = [chunk async for chunk in session.send_message("credit")]
+        
+        assert "".join(chunks[:-1]) == "応答credit"
+        assert "クレジット残高が不足" in chunks[-1]
+        assert session.messages[-1]["sender"] == "error"
+
+
+@pytest.fixture
+def counting_cli(tmp_path):
+    """呼び出し回数を記録する偽の claude --version"""
+    calls = tmp_path / "calls.log"
+    script = tmp_path / "claude"
+    script.write_text(
+        "#!/bin/sh\n"
+        f"echo called >> {calls}\n"
+        "[ -n \"$CLAUDE_SLEEP\" ] && sleep \"$CLAUDE_SLEEP\"\n"
+        "echo '9.9.9 (Claude Code)'\n"
+    )
+    script.chmod(0o755)
+
+    def count():
+        return len(calls.read_text().splitlines()) if calls.exists() else 0
+
+    return str(script), count
+
+
+@pytest.mark.unit
+class TestCapabilityProbe:
+    """SDK/CLIの利用可否の確認のテスト"""
+    
+    def test_import_does_not_run_cli(self, tmp_path, counting_cli):
+        """モジュールのインポート時にCLIを起動しないことのテスト"""
+        import subprocess
+        command, count = counting_cli
+        env = {**os.environ, "PATH": f"{tmp_path}:{os.environ['PATH']}", "TESTING": "1"}
+        
+        subprocess.run(
+            [sys.executable, "-c", "import app.claude_integration"],
+            cwd=str(Path(__file__).resolve().parents[1]), env=env, check=True
+        )
+        
+        assert count() == 0
+    
+    @pytest.mark.asyncio
+    async def test_probe_is_cached_and_shared(self, counting_cli):
+        """確認結果がキャッシュされ、同時の呼び出しで確認が1回になることのテスト"""
+        command, count = counting_cli
+        probe = CapabilityProbe(ttl=60, command=command)
+        
+        with patch.object(CapabilityProbe, "_load_sdk", return_value=False):
+            results = await asyncio.gather(probe.get(), probe.get(), probe.get())
+            again = await probe.get()
+        
+        assert count() == 1
+        assert all(result is again for result in results)
+        assert again.mode == "cli"
+        assert again.cli_version == "9.9.9 (Claude Code)"
+        assert again.to_dict()["checked_at"] is not None
+    
+    @pytest.mark.asyncio
+    async def test_ttl_and_refresh(self, tmp_path, counting_cli):
+        """期限切れと明示的な確認し直しで結果が更新されることのテスト"""
+        command, count = counting_cli
+        probe = CapabilityProbe(ttl=0, command=command)
+        
+        with patch.object(CapabilityProbe, "_load_sdk", return_value=True):
+            await probe.get()
+            await probe.get()
+            assert count() == 2
+            assert probe.cached.mode == "sdk"
+            
+            probe.ttl = 60
+            probe.command = str(tmp_path / "missing")
+            refreshed = await probe.refresh()
+        
+        assert count() == 2
+        assert refreshed.cli_available is False
+        assert refreshed.mode == "sdk"
+    
+    @pytest.mark.asyncio
+    async def test_unresponsive_cli(self, counting_cli, monkeypatch):
+        """CLIが応答しない場合は利用できないものとして扱うことのテスト"""
+        command, _ = counting_cli
+        monkeypatch.setenv("CLAUDE_SLEEP", "5")
+        probe = CapabilityProbe(timeout=0.2, command=command)
+        
+        with patch.object(CapabilityProbe, "_load_sdk", return_value=False):
+            capabilities = await asyncio.wait_for(probe.get(), 3.0)
+        
+        assert capabilities.cli_available is False
+        assert capabilities.mode == "mock"
@@ -0,0 +1,185 @@
+"""
+Claudeリクエストのスケジューラーのテスト
+"""
+
+import pytest
+import asyncio
+from unittest.mock import AsyncMock, patch
+
+from app.claude_integration import ClaudeCapabilities, ClaudeIntegration, claude_capabilities
+from app.claude_scheduler import ClaudeScheduler, SchedulerFullError, parse_plan_weights
+
+
+class Holder:
+    """実行枠を確保したまま、指示があるまで保持する"""
+
+    def __init__(self, scheduler, user_id, plan_type="free", order=None, positions=None):
+        self.release = asyncio.Event()
+        self.admitted = asyncio.Event()
+        self.positions = positions if positions is not None else []
+
+        async def report(position, queue_length):
+            self.positions.append(position)
+
+        async def run():
+            async with scheduler.admit(user_id, plan_type, report):
+                if order is not None:
+                    order.append(user_id)
+                self.admitted.set()
+                await self.release.wait()
+
+        self.task = asyncio.create_task(run())
+
+    async def finish(self):
+        self.release.set()
+        await self.task
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+@pytest.mark.unit
+class TestClaudeScheduler:
+    """ClaudeSchedulerのテスト"""
+
+    def test_parse_plan_weights(self):
+        """プランの重みの読み込みのテスト"""
+        assert parse_plan_weights("free:1, pro:4,enterprise:8,broken,bad:x") == {
+            "free": 1.0, "pro": 4.0, "enterprise": 8.0
+        }
+
+    @pytest.mark.asyncio
+    async def test_global_limit(self):
+        """全体の上限を超えたリクエストが待機し、空きができると実行されることのテスト"""
+        scheduler = ClaudeScheduler(max_concurrent=2, max_per_user=5, plan_weights={"free": 1})
+        holders = [Holder(scheduler, f"user-{i}") for i in range(3)]
+        await settle()
+
+        assert [h.admitted.is_set() for h in holders] == [True, True, False]
+        assert holders[2].positions == [1]
+        assert scheduler.get_stats()["in_flight"] == 2
+        assert scheduler.get_stats()["waiting"] == 1
+
+        await asyncio.sleep(0.01)
+        await holders[0].finish()
+        await asyncio.wait_for(holders[2].admitted.wait(), 1.0)
+        for holder in holders[1:]:
+            await holder.finish()
+
+        stats = scheduler.get_stats()
+        assert stats["in_flight"] == 0
+        assert stats["admitted_total"] == 3
+        assert stats["wait_seconds"]["max"] > 0
+
+    @pytest.mark.asyncio
+    async def test_per_user_limit(self):
+        """ユーザーごとの上限に達したユーザーを飛ばして他のユーザーを実行することのテスト"""
+        scheduler = ClaudeScheduler(max_concurrent=3, max_per_user=2, plan_weights={"free": 1})
+        heavy = [Holder(scheduler, "heavy") for _ in range(3)]
+        await settle()
+        light = Holder(scheduler, "light")
+        await settle()
+
+        assert [h.admitted.is_set() for h in heavy] == [True, True, False]
+        assert light.admitted.is_set()
+
+        for holder in heavy[:2]:
+            await holder.finish()
+        await asyncio.wait_for(heavy[2].admitted.wait(), 1.0)
+        await heavy[2].finish()
+        await light.finish()
+
+    @pytest.mark.asyncio
+    async def test_weighted_fair_order(self):
+        """重みの大きいプランが多く実行され、重みの小さいプランも飢餓にならないことのテスト"""
+        scheduler = ClaudeScheduler(
+            max_concurrent=1, max_per_user=1, plan_weights={"free": 1, "enterprise": 3}
+        )
+        blocker = Holder(scheduler, "blocker")
+        await settle()
+
+        order = []
+        holders = []
+        for _ in range(4):
+            holders.append(Holder(scheduler, "free-user", "free", order))
+            holders.append(Holder(scheduler, "enterprise-user", "enterprise", order))
+        await settle()
+
+        await blocker.finish()
+        while len(order) < len(holders):
+            await settle()
+            for holder in holders:
+                if holder.admitted.is_set() and not holder.release.is_set():
+                    await holder.finish()
+
+        # 終了タグ: enterprise 1/3, 2/3, 1, 4/3 / free 1, 2, 3, 4（同じ値なら先着順）
+        assert order == ["enterprise-user"] * 2 + ["free-user"] + ["enterprise-user"] * 2 + ["free-user"] * 3
+
+    @pytest.mark.asyncio
+    async def test_cancel_while_waiting(self):
+        """待機中に中止されたリクエストが外れ、後続の待ち順が進むことのテスト"""
+        scheduler = ClaudeScheduler(max_concurrent=1, max_per_user=5, plan_weights={"free": 1})
+        running = Holder(scheduler, "a")
+        first, second = Holder(scheduler, "b"), Holder(scheduler, "c")
+        await settle()
+
+        assert second.positions == [2]
+        first.task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first.task
+        await settle()
+
+        assert second.positions == [2, 1]
+        assert scheduler.get_stats()["cancelled_total"] == 1
+        await running.finish()
+        await asyncio.wait_for(second.admitted.wait(), 1.0)
+        await second.finish()
+
+    @pytest.mark.asyncio
+    async def test_queue_limit(self):
+        """待機数が上限に達すると受け付けないことのテスト"""
+        scheduler = ClaudeScheduler(max_concurrent=1, max_per_user=1, queue_limit=1)
+        running, waiting = Holder(scheduler, "a"), Holder(scheduler, "b")
+        await settle()
+
+        with pytest.raises(SchedulerFullError):
+            async with scheduler.admit("c"):
+                pass
+        assert scheduler.get_stats()["rejected_total"] == 1
+
+        await running.finish()
+        await waiting.finish()
+
+
+@pytest.mark.unit
+class TestClaudeIntegrationScheduling:
+    """ClaudeIntegrationのスケジューラー利用のテスト"""
+
+    @pytest.mark.asyncio
+    async def test_send_message_waits_for_slot(self, tmp_path):
+        """実行枠が空くまで応答を待ち、待ち順を通知することのテスト"""
+        scheduler = ClaudeScheduler(max_concurrent=1, max_per_user=1, plan_weights={"free": 1})
+        integration = ClaudeIntegration()
+        await integration.create_session("scheduled-session", str(tmp_path))
+        positions = []
+
+        async def report(position, queue_length):
+            positions.append((position, queue_length))
+
+        with patch("app.claude_integration.claude_scheduler", scheduler), \
+             patch.object(claude_capabilities, "get", AsyncMock(return_value=ClaudeCapabilities())):
+            holder = Holder(scheduler, "other-user")
+            await settle()
+            task = asyncio.create_task(integration.send_message_stream(
+                "hello", "scheduled-session", "user-1", "pro", on_position=report
+            ).__anext__())
+            await settle()
+
+            assert positions == [(1, 1)]
+            assert not task.done()
+            await holder.finish()
+            assert "こんにちは" in await asyncio.wait_for(task, 1.0)
+
+        await integration.remove_session("scheduled-session")
@@ -0,0 +1,175 @@
+"""
+セッションイベントバスのテスト
+"""
+
+import pytest
+import asyncio
+import json
+from unittest.mock import Mock
+
+from app.event_bus import CoalesceRule, SessionEventBus, SessionEventType
+
+
+@pytest.mark.unit
+class TestSessionEventBus:
+    """SessionEventBusのテスト"""
+
+    @pytest.mark.asyncio
+    async def test_publish_assigns_seq_and_session(self):
+        """発行イベントへの連番・セッションID付与テスト"""
+        sink = Mock()
+        bus = SessionEventBus(sink=sink)
+
+        bus.publish("session1", json.dumps({"type": SessionEventType.FILE_UPDATED, "file_path": "a.py"}))
+        bus.publish("session1", {"type": SessionEventType.FILE_DELETED, "file_path": "b.py"})
+        bus.publish("session2", {"type": SessionEventType.FILE_CREATED, "file_path": "c.py"})
+
+        assert sink.call_count == 3
+        first = sink.call_args_list[0].args[1]
+        assert first["seq"] == 1
+        assert first["session_id"] == "session1"
+        assert first["file_path"] == "a.py"
+        assert "timestamp" in first
+        assert sink.call_args_list[1].args[1]["seq"] == 2
+        assert sink.call_args_list[2].args[1]["seq"] == 1
+        assert bus.get_last_seq("session1") == 2
+
+    @pytest.mark.asyncio
+    async def test_subscribe_with_type_filter(self):
+        """イベントタイプ指定の購読テスト"""
+        bus = SessionEventBus()
+        all_events = Mock()
+        cursor_only = Mock()
+
+        bus.subscribe("session1", all_events)
+        token = bus.subscribe("session1", cursor_only, event_types=[SessionEventType.USER_JOINED])
+
+        bus.publish("session1", {"type": SessionEventType.USER_JOINED, "user": {"id": 1}})
+        bus.publish("session1", {"type": SessionEventType.FILE_UPDATED})
+
+        assert all_events.call_count == 2
+        assert cursor_only.call_count == 1
+
+        bus.unsubscribe("session1", token)
+        bus.publish("session1", {"type": SessionEventType.USER_JOINED, "user": {"id": 2}})
+        assert cursor_only.call_count == 1
+        assert bus.get_stats()["subscriptions"] == 1
+
+    @pytest.mark.asyncio
+    async def test_subscriber_error_does_not_stop_delivery(self):
+        """購読者のエラーが他の配信を妨げないことのテスト"""
+        bus = SessionEventBus()
+        broken = Mock(side_effect=RuntimeError("boom"))
+        healthy = Mock()
+        bus.subscribe("session1", broken)
+        bus.subscribe("session1", healthy)
+
+        bus.publish("session1", {"type": SessionEventType.FILE_UPDATED})
+
+        healthy.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_build_output_is_coalesced(self):
+        """ビルド出力行が時間窓で結合されることのテスト"""
+        sink = Mock()
+        bus = SessionEventBus(sink=sink)
+
+        for i in range(5):
+            bus.publish("session1", {"type": SessionEventType.BUILD_OUTPUT, "output": f"line{i}"})
+        assert sink.call_count == 0
+
+        await asyncio.sleep(0.1)
+
+        sink.assert_called_once()
+        event = sink.call_args.args[1]
+        assert event["output"] == "line0\nline1\nline2\nline3\nline4"
+        assert event["lines"] == 5
+        assert event["seq"] == 1
+
+    @pytest.mark.asyncio
+    async def test_file_change_keeps_latest_per_path(self):
+        """ファイル変更イベントがパスごとに最新1件へまとめられることのテスト"""
+        sink = Mock()
+        bus = SessionEventBus(sink=sink)
+
+        for _ in range(3):
+            bus.publish("session1", {"type": SessionEventType.FILE_CHANGE, "event_type": "modified", "file_path": "a.py"})
+        bus.publish("session1", {"type": SessionEventType.FILE_CHANGE, "event_type": "modified", "file_path": "b.py"})
+        bus.flush("session1")
+
+        paths = [call.args[1]["file_path"] for call in sink.call_args_list]
+        assert paths == ["a.py", "b.py"]
+
+    @pytest.mark.asyncio
+    async def test_other_event_flushes_pending_in_order(self):
+        """別タイプのイベントが結合待ちを先に配信して順序を保つことのテスト"""
+        sink = Mock()
+        bus = SessionEventBus(sink=sink)
+
+        bus.publish("session1", {"type": SessionEventType.BUILD_OUTPUT, "output": "compiling"})
+        bus.publish("session1", {"type": SessionEventType.BUILD_COMPLETED, "success": True})
+
+        types = [call.args[1]["type"] for call in sink.call_args_list]
+        assert types == [SessionEventType.BUILD_OUTPUT, SessionEventType.BUILD_COMPLETED]
+        assert bus.get_stats()["pending_batches"] == 0
+
+    @pytest.mark.asyncio
+    async def test_max_batch_flushes_early(self):
+        """max_batch に達した時点で配信されることのテスト"""
+        sink = Mock()
+        bus = SessionEventBus(
+            sink=sink,
+            coalesce_rules={"burst": CoalesceRule(10.0, max_batch=3)}
+        )
+
+        for i in range(3):
+            bus.publish("session1", {"type": "burst", "n": i})
+
+        assert sink.call_count == 3
+
+    @pytest.mark.asyncio
+    async def test_replay_from_seq(self):
+        """連番からのリプレイテスト"""
+        bus = SessionEventBus(buffer_size=3)
+        for i in range(5):
+            bus.publish("session1", {"type": SessionEventType.FILE_UPDATED, "n": i})
+
+        events, complete = bus.replay("session1", 3)
+        assert [event["seq"] for event in events] == [4, 5]
+        assert complete is True
+
+        # バッファから押し出された範囲は欠落あり
+        events, complete = bus.replay("session1", 0)
+        assert [event["seq"] for event in events] == [3, 4, 5]
+        assert complete is False
+
+        # 最新まで受信済み
+        events, complete = bus.replay("session1", 5)
+        assert events == []
+        assert complete is True
+
+    @pytest.mark.asyncio
+    async def test_replay_after_reset(self):
+        """バッファ破棄後のリプレイが欠落ありになることのテスト"""
+        bus = SessionEventBus()
+        bus.publish("session1", {"type": SessionEventType.FILE_UPDATED})
+        bus.publish("session1", {"type": SessionEventType.FILE_UPDATED})
+        bus.drop_session("session1")
+        bus.publish("session1", {"type": SessionEventType.FILE_UPDATED})
+
+        events, complete = bus.replay("session1", 2)
+        assert [event["seq"] for event in events] == [1]
+        assert complete is False
+
+        assert bus.replay("unknown", 0) == ([], True)
+
+    @pytest.mark.asyncio
+    async def test_session_buffers_are_bounded(self):
+        """保持セッション数が上限を超えないことのテスト"""
+        bus = SessionEventBus(max_sessions=2)
+        for session_id in ["s1", "s2", "s3"]:
+            bus.publish(session_id, {"type": SessionEventType.FILE_UPDATED})
+
+        assert bus.get_stats()["sessions"] == 2
+        assert bus.get_last_seq("s1") == 0
+        assert bus.get_last_seq("s3") == 1
@@ -0,0 +1,105 @@
+"""
+プロセスのリソース制限のテスト
+"""
+
+import pytest
+import os
+import resource
+import subprocess
+from unittest.mock import patch
+
+from app.process_limits import (
+    LimitMode, apply_resource_limits, check_cgroup_support, get_resource_usage, remove_cgroup
+)
+
+LIMITS = {"cpu_limit": 0.5, "memory_limit_mb": 512, "storage_limit_mb": 1024, "process_limit": 50}
+
+
+@pytest.fixture
+def child():
+    process = subprocess.Popen(["sleep", "30"], preexec_fn=os.setsid)
+    yield process
+    process.kill()
+    process.wait()
+
+
+@pytest.mark.unit
+class TestResourceLimits:
+    """リソース制限のテスト"""
+    
+    def test_without_cgroup(self, child):
+        """cgroupが使えない場合はCPU時間のみRLIMIT_CPUで制限されることのテスト"""
+        before = {
+            limit: resource.prlimit(child.pid, limit)
+            for limit in (resource.RLIMIT_AS, resource.RLIMIT_DATA, resource.RLIMIT_NPROC)
+        }
+        with patch("app.process_limits.TERMINAL_CGROUP_ROOT", ""), \
+             patch("app.process_limits.TERMINAL_CPU_TIME_WINDOW", 60):
+            mode = apply_resource_limits(child.pid, LIMITS, "terminal-1")
+        
+        assert mode == LimitMode.RLIMIT
+        soft, hard = resource.prlimit(child.pid, resource.RLIMIT_CPU)
+        assert soft == 30
+        assert soft < hard
+        # メモリ・プロセス数はrlimitで代用しない
+        for limit, value in before.items():
+            assert resource.prlimit(child.pid, limit) == value
+    
+    def test_without_cgroup_or_cpu_limit(self, child):
+        """cgroupが使えずCPU制限もない場合は制限なしになることのテスト"""
+        before = resource.prlimit(child.pid, resource.RLIMIT_CPU)
+        limits = {"memory_limit_mb": 512, "process_limit": 50}
+        with patch("app.process_limits.TERMINAL_CGROUP_ROOT", ""):
+            assert apply_resource_limits(child.pid, limits, "terminal-1") == LimitMode.NONE
+        assert resource.prlimit(child.pid, resource.RLIMIT_CPU) == before
+    
+    def test_cgroup_support_warning(self, tmp_path, caplog):
+        """cgroupが使えない場合に起動時の確認で警告されることのテスト"""
+        with patch("app.process_limits.TERMINAL_CGROUP_ROOT", ""):
+            assert check_cgroup_support() is False
+        assert "TERMINAL_CGROUP_ROOT" in caplog.text
+        
+        (tmp_path / "cgroup.procs").write_text("")
+        with patch("app.process_limits.TERMINAL_CGROUP_ROOT", str(tmp_path)):
+            assert check_cgroup_support() is True
+    
+    def test_no_limits(self, child):
+        """制限なしのテスト"""
+        assert apply_resource_limits(child.pid, None, "terminal-1") == LimitMode.NONE
+    
+    def test_cgroup(self, child, tmp_path):
+        """cgroup v2 のファイルに制限が書き込まれることのテスト"""
+        (tmp_path / "cgroup.procs").write_text("")
+        
+        with patch("app.process_limits.TERMINAL_CGROUP_ROOT", str(tmp_path)):
+            mode = apply_resource_limits(child.pid, LIMITS, "terminal-1")
+            cgroup = tmp_path / "terminal-1"
+            
+            assert mode == LimitMode.CGROUP
+            assert (cgroup / "cpu.max").read_text() == "50000 100000"
+            assert (cgroup / "memory.max").read_text() == str(512 * 1024 * 1024)
+            assert (cgroup / "pids.max").read_text() == "50"
+            assert (cgroup / "cgroup.procs").read_text() == str(child.pid)
+            
+            for name in ["cpu.max", "memory.max", "pids.max", "cgroup.procs"]:
+                (cgroup / name).unlink()
+            remove_cgroup("terminal-1")
+            assert not cgroup.exists()
+    
+    def test_process_group_usage(self, child):
+        """プロセスグループの使用量が集計されることのテスト"""
+        with patch("app.process_limits.TERMINAL_CGROUP_ROOT", ""):
+            usage = get_resource_usage(child.pid, "terminal-1")
+        
+        assert usage["processes"] == 1
+        # exec 直後の sleep の常駐メモリは 0.1MB 未満に丸められることがある
+        assert usage["memory_mb"] >= 0
+        assert usage["cpu_seconds"] >= 0
+    
+    def test_process_group_memory(self):
+        """メモリを確保したプロセスのグループで使用量が集計されることのテスト"""
+        with patch("app.process_limits.TERMINAL_CGROUP_ROOT", ""):
+            usage = get_resource_usage(os.getpid(), "terminal-1")
+        
+        assert usage["processes"] >= 1
+        assert usage["memory_mb"] > 0
@@ -0,0 +1,159 @@
+"""
+PTYブローカーのテスト
+"""
+
+import pytest
+import pytest_asyncio
+import asyncio
+import json
+
+from app.pty_broker import (
+    BrokerError, BrokerFrame, PTYBroker, RemoteTerminalManager, read_frame, write_frame
+)
+from app.terminal_managers import ShellPool, has_active_terminal
+
+
+async def read_until(subscription, text, timeout=10.0):
+    """指定の文字列が出力されるまで読み取る"""
+    output = ""
+
+    async def collect():
+        nonlocal output
+        while text not in output:
+            chunk = await subscription.get()
+            if chunk is None:
+                break
+            output += chunk
+
+    await asyncio.wait_for(collect(), timeout)
+    return output
+
+
+@pytest_asyncio.fixture
+async def broker(tmp_path):
+    broker = PTYBroker(str(tmp_path / "broker.sock"), pool=ShellPool({}))
+    await broker.start()
+    yield broker
+    await broker.stop()
+
+
+def remote(broker, session_id="broker-terminal", **kwargs):
+    return RemoteTerminalManager(session_id, "basic", "/tmp", socket_path=broker.path, **kwargs)
+
+
+@pytest.mark.unit
+class TestFraming:
+    """フレームのテスト"""
+
+    @pytest.mark.asyncio
+    async def test_frame_roundtrip(self):
+        """フレームの書き込みと読み取りの往復テスト"""
+        reader = asyncio.StreamReader()
+        writer = type("Writer", (), {"write": lambda self, data: reader.feed_data(data)})()
+
+        write_frame(writer, BrokerFrame.OUTPUT, "出力".encode("utf-8"))
+        write_frame(writer, BrokerFrame.CLOSED, json.dumps({"overflowed": False}).encode())
+        reader.feed_eof()
+
+        assert await read_frame(reader) == (BrokerFrame.OUTPUT, "出力".encode("utf-8"))
+        assert (await read_frame(reader))[0] == BrokerFrame.CLOSED
+        with pytest.raises(asyncio.IncompleteReadError):
+            await read_frame(reader)
+
+
+@pytest.mark.unit
+class TestPTYBroker:
+    """ブローカー経由のターミナルのテスト"""
+
+    @pytest.mark.asyncio
+    async def test_terminal_survives_client_restart(self, broker):
+        """クライアントが切断してもシェルが残り、スクロールバックから再開できることのテスト"""
+        first = remote(broker)
+        await first.start_terminal()
+        subscription = first.subscribe()
+        assert first.created is True
+
+        await first.write_input("export BROKER_VALUE=$((40 + 2)); echo value-$BROKER_VALUE\n")
+        await read_until(subscription, "value-42")
+
+        # ワーカーの再起動に相当（ターミナルは終了しない）
+        await first.shutdown()
+        assert has_active_terminal("broker-terminal")
+
+        second = remote(broker)
+        await second.start_terminal()
+        subscription = second.subscribe()
+        assert second.created is False
+        assert "value-42" in subscription.scrollback
+
+        # 同じシェルが動き続けている
+        await second.write_input("echo again-$BROKER_VALUE\n")
+        await read_until(subscription, "again-42")
+
+        await second.cleanup()
+        assert not has_active_terminal("broker-terminal")
+
+    @pytest.mark.asyncio
+    async def test_multiple_clients_share_terminal(self, broker):
+        """複数のクライアントが同じターミナルの出力を受け取ることのテスト"""
+        worker_a, worker_b = remote(broker), remote(broker)
+        await worker_a.start_terminal()
+        await worker_b.start_terminal()
+        viewer_a, viewer_b = worker_a.subscribe(), worker_b.subscribe()
+
+        await worker_a.write_input("echo shared-$((1 + 1))\n")
+
+        await read_until(viewer_a, "shared-2")
+        await read_until(viewer_b, "shared-2")
+
+        worker_b.resize(40, 120)
+        await worker_b.write_input("stty size\n")
+        await read_until(viewer_a, "40 120")
+
+        usage = await worker_a.fetch_usage()
+        assert usage["processes"] >= 1
+
+        # 一方が終了するともう一方にも終了が伝わる
+        await worker_a.cleanup()
+
+        async def drain():
+            while await viewer_b.get() is not None:
+                pass
+
+        await asyncio.wait_for(drain(), 5.0)
+        assert worker_b.closed
+        await worker_b.shutdown()
+
+    @pytest.mark.asyncio
+    async def test_requests_answered_while_paused(self, broker):
+        """購読者が詰まって出力を止めている間も要求に応答することのテスト"""
+        worker = remote(broker)
+        await worker.start_terminal()
+        viewer = worker.subscribe(maxsize=2)
+
+        await worker.write_input("seq 1 200000; echo seq-done\n")
+        for _ in range(500):
+            if worker._paused:
+                break
+            await asyncio.sleep(0.01)
+        assert worker._paused
+
+        usage = await asyncio.wait_for(worker.fetch_usage(), 2.0)
+        assert usage["processes"] >= 1
+
+        # 止めている間の出力も失われずに届く
+        output = await read_until(viewer, "seq-done", timeout=30.0)
+        assert "200000" in output
+        assert not viewer.overflowed
+
+        await worker.cleanup()
+
+    @pytest.mark.asyncio
+    async def test_broker_unavailable(self, tmp_path):
+        """ブローカーに接続できない場合のテスト"""
+        terminal = RemoteTerminalManager("missing", socket_path=str(tmp_path / "missing.sock"))
+
+        with pytest.raises(OSError):
+            await terminal.start_terminal()
+        with pytest.raises(BrokerError):
+            await terminal._request("usage")
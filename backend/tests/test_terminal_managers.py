@@ -0,0 +1,603 @@
+"""
+ターミナルマネージャーのテスト
+"""
+
+import pytest
+import pytest_asyncio
+import asyncio
+import os
+import re
+import resource
+from unittest.mock import patch
+
+from app.terminal_managers import (
+    BasicTerminalManager, ScrollbackBuffer, ShellPool, TERMINAL_FRAME_SIZE,
+    has_active_terminal, reap_idle_terminals, remove_active_terminals, set_active_terminal, TERMINAL_READ_SIZE_MAX, TERMINAL_READ_SIZE_MIN
+)
+
+
+async def read_until(subscription, text, timeout=5.0):
+    """指定の文字列が出力されるまで読み取る"""
+    output = ""
+    
+    async def collect():
+        nonlocal output
+        while text not in output:
+            chunk = await subscription.get()
+            if chunk is None:
+                break
+            output += chunk
+    
+    await asyncio.wait_for(collect(), timeout)
+    return output
+
+
+def process_gone(pid):
+    """プロセスが終了しているか（ゾンビも終了とみなす）"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] == "Z"
+    except OSError:
+        return True
+
+
+async def start_stubborn_job(terminal):
+    """SIGHUP・SIGTERMを無視するジョブを起動し、そのpidを返す"""
+    subscription = terminal.subscribe()
+    await terminal.write_input("sh -c 'trap \"\" HUP TERM; sleep 100' &\necho JOB=$!\n")
+    output = await read_until(subscription, "\r\n", timeout=5.0)
+    while not re.search(r"JOB=(\d+)", output):
+        output += await read_until(subscription, "\r\n")
+    terminal.unsubscribe(subscription)
+    return int(re.search(r"JOB=(\d+)", output).group(1))
+
+
+@pytest_asyncio.fixture
+async def terminal(tmp_path):
+    terminal = BasicTerminalManager("test-terminal", str(tmp_path))
+    await terminal.start_terminal()
+    terminal.subscription = terminal.subscribe()
+    yield terminal
+    await terminal.cleanup()
+
+
+@pytest.mark.unit
+class TestTerminalReader:
+    """PTY読み取りのテスト"""
+    
+    @pytest.mark.asyncio
+    async def test_output_is_pushed_by_reader(self, terminal):
+        """入力したコマンドの出力が届くことのテスト"""
+        await terminal.write_input("echo reader-$((40 + 2))\n")
+        
+        output = await read_until(terminal.subscription, "reader-42")
+        
+        assert "reader-42" in output
+        assert terminal.slave_fd is None  # 親側のスレーブ端は閉じている
+    
+    @pytest.mark.asyncio
+    async def test_exit_returns_none(self, terminal):
+        """シェル終了後に None が返ることのテスト"""
+        await terminal.write_input("exit\n")
+        
+        async def drain():
+            while await terminal.subscription.get() is not None:
+                pass
+        
+        await asyncio.wait_for(drain(), 5.0)
+        assert await terminal.subscription.get() is None
+        # 終了後の購読は即座に終わる
+        assert await terminal.subscribe().get() is None
+    
+    @pytest.mark.asyncio
+    async def test_idle_terminal_does_not_block_loop(self, terminal):
+        """出力のないターミナルがイベントループを止めないことのテスト"""
+        await asyncio.sleep(0.3)  # 初期化出力を待つ
+        loop = asyncio.get_running_loop()
+        
+        start = loop.time()
+        for _ in range(100):
+            await asyncio.sleep(0)
+        
+        assert loop.time() - start < 0.05
+
+
+class PipeTerminal(BasicTerminalManager):
+    """パイプをPTYの代わりに使うテスト用ターミナル"""
+    
+    async def start_terminal(self):
+        self.master_fd, self.writer_fd = os.pipe()
+        self._start_reader()
+    
+    async def cleanup(self, *args):
+        await super().cleanup(*args)
+        try:
+            os.close(self.writer_fd)
+        except OSError:
+            pass
+
+
+@pytest_asyncio.fixture
+async def pipe_terminal():
+    terminal = PipeTerminal("pipe-terminal")
+    await terminal.start_terminal()
+    terminal.subscription = terminal.subscribe()
+    yield terminal
+    await terminal.cleanup()
+
+
+@pytest.mark.unit
+class TestTerminalFraming:
+    """出力のデコードとフレーム化のテスト"""
+    
+    @pytest.mark.asyncio
+    async def test_multibyte_split_across_reads(self, pipe_terminal):
+        """読み取り境界をまたぐマルチバイト文字が壊れないことのテスト"""
+        data = "日本語".encode("utf-8")
+        
+        os.write(pipe_terminal.writer_fd, data[:4])
+        await asyncio.sleep(0.02)
+        os.write(pipe_terminal.writer_fd, data[4:])
+        
+        output = await read_until(pipe_terminal.subscription, "日本語")
+        assert output == "日本語"
+    
+    @pytest.mark.asyncio
+    async def test_burst_is_coalesced(self, pipe_terminal):
+        """大量出力が少数の大きなフレームにまとめられることのテスト"""
+        line = b"x" * 99 + b"\n"
+        total = 2 * 1024 * 1024
+        
+        async def produce():
+            loop = asyncio.get_running_loop()
+            for _ in range(total // len(line) // 100):
+                await loop.run_in_executor(None, os.write, pipe_terminal.writer_fd, line * 100)
+            os.close(pipe_terminal.writer_fd)
+        
+        producer = asyncio.create_task(produce())
+        frames = []
+        while True:
+            frame = await asyncio.wait_for(pipe_terminal.subscription.get(), 5.0)
+            if frame is None:
+                break
+            frames.append(frame)
+        await producer
+        
+        received = sum(len(frame) for frame in frames)
+        assert received == total // len(line) // 100 * 100 * len(line)
+        assert len(frames) < received // 4096
+        assert max(len(frame) for frame in frames) <= TERMINAL_FRAME_SIZE + TERMINAL_READ_SIZE_MAX
+    
+    @pytest.mark.asyncio
+    async def test_full_frame_flushes_before_timer(self, pipe_terminal):
+        """1フレーム分たまるとタイマーを待たずに送信されることのテスト"""
+        pipe_terminal._pending = ["a"]
+        pipe_terminal._pending_size = 1
+        pipe_terminal._last_flush = pipe_terminal._loop.time()
+        pipe_terminal._schedule_flush()
+        handle = pipe_terminal._flush_handle
+        assert handle is not None
+
+        pipe_terminal._pending.append("b" * TERMINAL_FRAME_SIZE)
+        pipe_terminal._pending_size += TERMINAL_FRAME_SIZE
+        pipe_terminal._schedule_flush()
+
+        assert handle.cancelled()
+        assert pipe_terminal._flush_handle is None
+        assert pipe_terminal._pending_size == 0
+        assert await asyncio.wait_for(pipe_terminal.subscription.get(), 1.0) == "a" + "b" * TERMINAL_FRAME_SIZE
+
+    @pytest.mark.asyncio
+    async def test_read_size_adapts(self, pipe_terminal):
+        """読み取りサイズが出力量に応じて増減することのテスト"""
+        pipe_terminal._adapt_read_size(TERMINAL_READ_SIZE_MIN)
+        assert pipe_terminal._read_size == TERMINAL_READ_SIZE_MIN * 2
+        
+        for _ in range(20):
+            pipe_terminal._adapt_read_size(pipe_terminal._read_size)
+        assert pipe_terminal._read_size == TERMINAL_READ_SIZE_MAX
+        
+        for _ in range(20):
+            pipe_terminal._adapt_read_size(1)
+        assert pipe_terminal._read_size == TERMINAL_READ_SIZE_MIN
+
+
+@pytest.mark.unit
+class TestScrollback:
+    """スクロールバックのテスト"""
+    
+    def test_per_buffer_cap(self):
+        """ターミナルごとの上限を超えた古い出力が捨てられることのテスト"""
+        buffer = ScrollbackBuffer(max_bytes=10)
+        
+        buffer.append("abcdef")
+        buffer.append("ghijkl")
+        
+        assert buffer.snapshot() == "cdefghijkl"
+        assert buffer.size == 10
+        buffer.clear()
+        
+    def test_partial_multibyte_is_dropped(self):
+        """途中で切れたマルチバイト文字が残らないことのテスト"""
+        buffer = ScrollbackBuffer(max_bytes=7)
+        
+        buffer.append("あいう")  # 9バイト
+        
+        assert buffer.snapshot() == "いう"
+        assert buffer.size == 6
+        buffer.clear()
+        
+    def test_global_cap(self):
+        """全体の上限を超えると最も大きいバッファから捨てられることのテスト"""
+        with patch("app.terminal_managers.TERMINAL_SCROLLBACK_TOTAL_BYTES", ScrollbackBuffer.total_bytes + 15):
+            small = ScrollbackBuffer(max_bytes=100)
+            large = ScrollbackBuffer(max_bytes=100)
+            small.append("12345")
+            large.append("abcdefghij")
+            large.append("XYZ")
+            
+            assert small.snapshot() == "12345"
+            assert large.snapshot() == "defghijXYZ"
+            small.clear()
+            large.clear()
+
+    def test_global_cap_trims_several_buffers(self):
+        """最も大きいバッファだけでは足りない場合に、合計が収まるまで捨てられることのテスト"""
+        base = ScrollbackBuffer.total_bytes
+        buffers = [ScrollbackBuffer(max_bytes=100) for _ in range(3)]
+        with patch("app.terminal_managers.TERMINAL_SCROLLBACK_TOTAL_BYTES", base + 30):
+            buffers[0].append("1" * 11)
+            buffers[1].append("2" * 10)
+            buffers[2].append("3" * 8)
+
+        # 上限が下がった後の追加で、合計が上限に収まるまで大きい順に捨てる
+        with patch("app.terminal_managers.TERMINAL_SCROLLBACK_TOTAL_BYTES", base + 10):
+            buffers[2].append("4")
+
+        assert [buffer.snapshot() for buffer in buffers] == ["", "2", "333333334"]
+        assert ScrollbackBuffer.total_bytes == base + 10
+        for buffer in buffers:
+            buffer.clear()
+
+    @pytest.mark.asyncio
+    async def test_output_while_detached_is_replayed(self, pipe_terminal):
+        """未接続中の出力が再接続時に返されることのテスト"""
+        os.write(pipe_terminal.writer_fd, b"first\n")
+        assert await read_until(pipe_terminal.subscription, "first") == "first\n"
+        pipe_terminal.unsubscribe(pipe_terminal.subscription)
+        
+        os.write(pipe_terminal.writer_fd, b"while away\n")
+        await asyncio.sleep(0.05)
+        
+        subscription = pipe_terminal.subscribe()
+        assert subscription.scrollback == "first\nwhile away\n"
+        os.write(pipe_terminal.writer_fd, b"live\n")
+        assert await read_until(subscription, "live") == "live\n"
+
+
+@pytest.mark.unit
+class TestTerminalFanout:
+    """複数購読者への配信のテスト"""
+    
+    @pytest.mark.asyncio
+    async def test_all_subscribers_receive_everything(self, pipe_terminal):
+        """全購読者が同じ出力を欠けずに受け取ることのテスト"""
+        viewer = pipe_terminal.subscribe(readonly=True)
+        
+        for i in range(20):
+            os.write(pipe_terminal.writer_fd, f"line{i}\n".encode())
+            await asyncio.sleep(0.001)
+        
+        owner_output = await read_until(pipe_terminal.subscription, "line19")
+        viewer_output = await read_until(viewer, "line19")
+        
+        expected = "".join(f"line{i}\n" for i in range(20))
+        assert owner_output == viewer_output == expected
+        assert viewer.readonly is True
+    
+    @pytest.mark.asyncio
+    async def test_reader_pauses_when_everyone_is_slow(self, pipe_terminal):
+        """全購読者が詰まると読み取りが止まり、受信で再開することのテスト"""
+        pipe_terminal.unsubscribe(pipe_terminal.subscription)
+        subscription = pipe_terminal.subscribe(maxsize=2)
+        
+        for i in range(4):
+            os.write(pipe_terminal.writer_fd, f"{i}".encode())
+            await asyncio.sleep(0.02)
+        
+        assert pipe_terminal._paused is True
+        assert len(subscription.queue) == 2
+        
+        # 受信すると読み取りが再開され、PTYに残っていた出力が届く
+        output = await read_until(subscription, "3")
+        assert output == "0123"
+        assert pipe_terminal._paused is False
+    
+    @pytest.mark.asyncio
+    async def test_lagging_subscriber_is_dropped(self, pipe_terminal):
+        """一部の購読者だけが遅れた場合はその購読が打ち切られることのテスト"""
+        slow = pipe_terminal.subscribe(maxsize=1)
+        
+        for i in range(3):
+            os.write(pipe_terminal.writer_fd, f"{i}".encode())
+            await asyncio.sleep(0.02)
+        
+        assert await read_until(pipe_terminal.subscription, "2") == "012"
+        assert slow.overflowed is True
+        assert slow not in pipe_terminal.subscribers
+        assert await slow.get() == "0"
+        assert await slow.get() is None
+
+
+@pytest.mark.unit
+class TestIdleReaper:
+    """アイドルターミナル回収のテスト"""
+    
+    @pytest.mark.asyncio
+    async def test_idle_terminal_is_reaped(self, pipe_terminal):
+        """購読者がなくTTLを超えたターミナルが終了されることのテスト"""
+        ttl = pipe_terminal.get_idle_ttl()
+        set_active_terminal("idle-terminal", pipe_terminal)
+        now = pipe_terminal.last_activity + ttl + 1
+        
+        # 購読者がいる間は回収しない
+        assert await reap_idle_terminals(now) == 0
+        
+        pipe_terminal.unsubscribe(pipe_terminal.subscription)
+        assert await reap_idle_terminals(pipe_terminal.last_activity + ttl - 1) == 0
+        assert await reap_idle_terminals(pipe_terminal.last_activity + ttl + 1) == 1
+        assert not has_active_terminal("idle-terminal")
+    
+    @pytest.mark.asyncio
+    async def test_input_counts_as_activity(self, pipe_terminal):
+        """入力でアイドル時間がリセットされることのテスト"""
+        pipe_terminal.last_activity -= 100
+        before = pipe_terminal.last_activity
+        
+        await pipe_terminal.write_input("")
+        
+        assert pipe_terminal.last_activity > before
+    
+    @pytest.mark.asyncio
+    async def test_shell_limits_and_usage(self, tmp_path):
+        """シェルに制限が適用され、使用量が報告されることのテスト"""
+        terminal = BasicTerminalManager(
+            "limited-terminal", str(tmp_path),
+            resource_limits={"cpu_limit": 1.0, "memory_limit_mb": 256, "process_limit": 20}
+        )
+        with patch("app.process_limits.TERMINAL_CGROUP_ROOT", ""), \
+             patch("app.process_limits.TERMINAL_CPU_TIME_WINDOW", 600):
+            await terminal.start_terminal()
+            usage = terminal.get_usage()
+            cpu_rlimit = resource.prlimit(terminal.process.pid, resource.RLIMIT_CPU)
+        await terminal.cleanup()
+        
+        # cgroupがなければCPUのみRLIMIT_CPUで制限される
+        assert terminal.limit_mode == "rlimit"
+        assert cpu_rlimit[0] == 600
+        assert usage["processes"] >= 1
+        assert usage["limits"]["process_limit"] == 20
+        assert usage["enforcement"] == "rlimit"
+
+
+@pytest.mark.unit
+class TestShellPool:
+    """事前起動シェルのプールのテスト"""
+    
+    @pytest.mark.asyncio
+    async def test_claim_adopts_pooled_shell(self, tmp_path):
+        """プールのシェルが引き継がれ、セッション用に切り替わることのテスト"""
+        pool = ShellPool({"basic": 1})
+        await pool.start()
+        await pool.fill("basic")
+        pooled_pid = pool.shells["basic"][0].process.pid
+        
+        terminal = BasicTerminalManager("pooled-terminal", str(tmp_path), environment={"POOL_TEST": "value 1"})
+        with patch("app.terminal_managers.shell_pool", pool):
+            await terminal.start_terminal()
+        subscription = terminal.subscribe()
+        try:
+            assert terminal.process.pid == pooled_pid
+            await read_until(subscription, "[Basic]")
+            
+            await terminal.write_input("echo \"$PWD|$POOL_TEST\"\n")
+            output = await read_until(subscription, "value 1\r\n")
+            
+            assert f"{tmp_path}|value 1" in output
+            assert "echo" in output  # 切り替え後は入力がエコーされる
+            assert "stty" not in terminal.scrollback.snapshot()
+            
+            # バックグラウンドで補充される
+            await pool.fill("basic")
+            assert pool.get_stats() == {"basic": 1}
+        finally:
+            await terminal.cleanup()
+            await pool.stop()
+        assert pool.get_stats() == {"basic": 0}
+    
+    @pytest.mark.asyncio
+    async def test_dead_or_missing_shell_is_not_claimed(self):
+        """終了したシェルや未開始のプールからは取り出さないことのテスト"""
+        pool = ShellPool({"basic": 1})
+        assert pool.claim("basic") is None  # start() 前
+        
+        await pool.start()
+        await pool.fill("basic")
+        await pool.shells["basic"][0].close()
+        try:
+            assert pool.claim("basic") is None
+            assert pool.claim("unknown") is None
+        finally:
+            await pool.stop()
+
+
+@pytest.mark.unit
+class TestTermination:
+    """ターミナルの非同期終了のテスト"""
+    
+    @pytest.mark.asyncio
+    async def test_cleanup_kills_session_without_blocking(self, terminal):
+        """シグナルを無視するジョブも期限後に終了し、待機中もループが動くことのテスト"""
+        job = await start_stubborn_job(terminal)
+        shell = terminal.process
+        ticks = 0
+        
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+        
+        ticker_task = asyncio.create_task(ticker())
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await terminal.cleanup(timeout=0.5)
+        elapsed = loop.time() - start
+        ticker_task.cancel()
+        
+        assert 0.5 <= elapsed < 2.0
+        assert ticks >= 20
+        assert shell.returncode is not None  # シェルは回収済み
+        assert process_gone(job)
+        assert terminal.master_fd is None
+    
+    @pytest.mark.asyncio
+    async def test_bulk_termination_runs_concurrently(self, tmp_path):
+        """複数ターミナルの終了が並行して行われることのテスト"""
+        terminals = []
+        for index in range(3):
+            terminal = BasicTerminalManager(f"bulk-{index}", str(tmp_path))
+            await terminal.start_terminal()
+            await start_stubborn_job(terminal)
+            set_active_terminal(f"bulk-{index}", terminal)
+            terminals.append(terminal)
+        
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        removed = await remove_active_terminals(["bulk-0", "bulk-1", "bulk-2", "missing"], timeout=1.0)
+        
+        assert loop.time() - start < 2.5  # 直列なら3秒以上かかる
+        assert removed == ["bulk-0", "bulk-1", "bulk-2"]
+        assert not any(has_active_terminal(f"bulk-{index}") for index in range(3))
+        assert all(terminal.process.returncode is not None for terminal in terminals)
+
+
+class InputPipeTerminal(BasicTerminalManager):
+    """入力をパイプに書き込むテスト用ターミナル"""
+    
+    async def start_terminal(self):
+        self.reader_fd, self.master_fd = os.pipe()
+        os.set_blocking(self.reader_fd, False)
+        os.set_blocking(self.master_fd, False)
+    
+    async def read_all(self, size):
+        """パイプから size バイト読み取る（書き込み側と並行して少しずつ読む）"""
+        data = b""
+        while len(data) < size:
+            await asyncio.sleep(0)
+            try:
+                data += os.read(self.reader_fd, 65536)
+            except BlockingIOError:
+                await asyncio.sleep(0.001)
+        return data
+    
+    async def cleanup(self, *args):
+        await super().cleanup(*args)
+        os.close(self.reader_fd)
+
+
+@pytest.mark.unit
+class TestInputWriter:
+    """入力の書き込みのテスト"""
+    
+    @pytest.mark.asyncio
+    async def test_large_paste_is_written_completely(self):
+        """パイプ容量を超える入力が欠けずに、ループを止めずに書き込まれることのテスト"""
+        terminal = InputPipeTerminal("input-terminal")
+        await terminal.start_terminal()
+        paste = bytes(range(256)) * 4096  # 1MB
+        
+        # PTYが受け付けない分は書き込み待ちになり、呼び出しはすぐに戻る
+        await asyncio.wait_for(terminal.write_input(paste), 1.0)
+        assert 0 < terminal.get_pending_input() < len(paste)
+        
+        received = await asyncio.wait_for(terminal.read_all(len(paste)), 10.0)
+        
+        assert received == paste
+        assert terminal.get_pending_input() == 0
+        await terminal.cleanup()
+    
+    @pytest.mark.asyncio
+    async def test_sender_waits_when_buffer_is_full(self):
+        """書き込み待ちが上限を超えると送信元だけが待たされることのテスト"""
+        terminal = InputPipeTerminal("input-terminal")
+        await terminal.start_terminal()
+        
+        with patch("app.terminal_managers.TERMINAL_INPUT_BUFFER_BYTES", 1024):
+            await terminal.write_input(b"a" * (1024 * 1024))
+            second = asyncio.create_task(terminal.write_input(b"b"))
+            await asyncio.sleep(0.05)
+            assert not second.done()
+            
+            received = await asyncio.wait_for(terminal.read_all(1024 * 1024 + 1), 10.0)
+            await asyncio.wait_for(second, 1.0)
+        
+        assert received.endswith(b"ab")
+        await terminal.cleanup()
+    
+    @pytest.mark.asyncio
+    async def test_cleanup_releases_waiting_sender(self):
+        """終了時に書き込み待ちの送信元が解放されることのテスト"""
+        terminal = InputPipeTerminal("input-terminal")
+        await terminal.start_terminal()
+        
+        with patch("app.terminal_managers.TERMINAL_INPUT_BUFFER_BYTES", 1024):
+            await terminal.write_input(b"a" * (1024 * 1024))
+            waiting = asyncio.create_task(terminal.write_input(b"b"))
+            await asyncio.sleep(0.01)
+            await terminal.cleanup()
+            await asyncio.wait_for(waiting, 1.0)
+        
+        assert terminal.get_pending_input() == 0
+
+
+@pytest.mark.unit
+class TestTerminalControl:
+    """ウィンドウサイズ変更とシグナル送信のテスト"""
+    
+    @pytest.mark.asyncio
+    async def test_resize(self, terminal):
+        """ウィンドウサイズの変更がシェルに反映されることのテスト"""
+        terminal.resize(40, 120)
+        await terminal.write_input("stty size\n")
+        
+        output = await read_until(terminal.subscription, "40 120")
+        
+        assert "40 120" in output
+        with pytest.raises(ValueError):
+            terminal.resize(0, 80)
+    
+    @pytest.mark.asyncio
+    async def test_interrupt_foreground_job(self, terminal):
+        """フォアグラウンドのジョブにSIGINTが届くことのテスト"""
+        await terminal.write_input("sleep 100\n")
+        
+        async def sleep_in_foreground():
+            while True:
+                try:
+                    with open(f"/proc/{os.tcgetpgrp(terminal.master_fd)}/comm") as f:
+                        if f.read().strip() == "sleep":
+                            return
+                except OSError:
+                    pass
+                await asyncio.sleep(0.05)
+        
+        await asyncio.wait_for(sleep_in_foreground(), 10.0)
+        
+        terminal.send_signal("INT")
+        await terminal.write_input("echo done-$((1 + 1))\n")
+        
+        output = await read_until(terminal.subscription, "done-2\r\n", timeout=3.0)
+        assert "done-2" in output
+        with pytest.raises(ValueError):
+            terminal.send_signal("SIGUSR1")
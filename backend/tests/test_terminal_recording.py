@@ -0,0 +1,183 @@
+"""
+ターミナルの記録と再生のテスト
+"""
+
+import pytest
+import asyncio
+import json
+import time
+from unittest.mock import patch
+
+from app import terminal_recording
+from app.terminal_managers import BasicTerminalManager
+from app.terminal_recording import (
+    RecordingEvent, TerminalRecorder, get_recording_info, recording_directory, replay_recording
+)
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+async def replay(session_id, root, start=0.0, end=None):
+    lines = [line async for line in replay_recording(session_id, start, end, root=root)]
+    return json.loads(lines[0]), [json.loads(line) for line in lines[1:]]
+
+
+@pytest.fixture
+def clock():
+    clock = FakeClock()
+    with patch("app.terminal_recording.time.time", clock):
+        yield clock
+
+
+@pytest.mark.unit
+class TestTerminalRecorder:
+    """TerminalRecorderのテスト"""
+
+    @pytest.mark.asyncio
+    async def test_record_and_seek(self, tmp_path, clock):
+        """記録したイベントを経過時間で切り出して再生できることのテスト"""
+        recorder = TerminalRecorder("session_basic", root=str(tmp_path), chunk_seconds=60)
+
+        recorder.record_output("hello\r\n")
+        clock.now += 1.5
+        recorder.record_input("ls\r")
+        await recorder.flush()
+        clock.now += 3.5
+        recorder.record_resize(40, 120)
+        recorder.record_output("world\r\n")
+        await recorder.close()
+
+        info = await get_recording_info("session_basic", root=str(tmp_path))
+        assert info["chunks"] == 2
+        assert info["events"] == 4
+        assert info["end"] == 5.0
+
+        header, events = await replay("session_basic", str(tmp_path), start=1.0)
+        assert header["version"] == 2
+        assert header["timestamp"] == 1001
+        assert events == [
+            [0.5, RecordingEvent.INPUT, "ls\r"],
+            [4.0, RecordingEvent.RESIZE, "120x40"],
+            [4.0, RecordingEvent.OUTPUT, "world\r\n"],
+        ]
+
+        # 範囲外のチャンクは展開しない
+        with patch("app.terminal_recording._read_chunk", wraps=terminal_recording._read_chunk) as read_chunk:
+            _, events = await replay("session_basic", str(tmp_path), start=0.0, end=2.0)
+        assert [event[1] for event in events] == ["o", "i"]
+        assert read_chunk.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_live_path_does_no_io(self, tmp_path, clock):
+        """記録の呼び出しではディスクに書き込まないことのテスト"""
+        recorder = TerminalRecorder("session_basic", root=str(tmp_path), chunk_seconds=60)
+
+        recorder.record_output("x" * 100)
+
+        assert not recording_directory("session_basic", str(tmp_path)).exists()
+        await recorder.close()
+        assert recording_directory("session_basic", str(tmp_path)).exists()
+
+    @pytest.mark.asyncio
+    async def test_buffer_limit_drops_events(self, tmp_path, clock):
+        """書き出しが追いつかない場合に記録を諦めることのテスト"""
+        recorder = TerminalRecorder("session_basic", root=str(tmp_path), chunk_seconds=60)
+
+        with patch("app.terminal_recording.TERMINAL_RECORDING_BUFFER_SIZE", 10):
+            recorder.record_output("12345678")
+            recorder.record_output("12345678")
+
+        assert recorder.dropped == 1
+        await recorder.close()
+
+    @pytest.mark.asyncio
+    async def test_close_waits_for_writer(self, tmp_path, clock):
+        """書き出し中に終了しても取り出し済みのイベントが失われないことのテスト"""
+        recorder = TerminalRecorder("session_basic", root=str(tmp_path), chunk_seconds=60, chunk_size=1)
+        write_chunk = recorder._write_chunk
+        writing = asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        def slow_write_chunk(events):
+            loop.call_soon_threadsafe(writing.set)
+            time.sleep(0.1)
+            write_chunk(events)
+
+        with patch.object(recorder, "_write_chunk", side_effect=slow_write_chunk):
+            recorder.record_output("first")
+            await asyncio.wait_for(writing.wait(), 5.0)
+            clock.now += 1
+            recorder.record_output("second")
+            await recorder.close()
+
+        _, events = await replay("session_basic", str(tmp_path))
+        assert [event[2] for event in events] == ["first", "second"]
+        assert recorder._task is None
+
+    @pytest.mark.asyncio
+    async def test_disk_limit(self, tmp_path, clock):
+        """上限を超えると古いチャンクから削除されることのテスト"""
+        recorder = TerminalRecorder("session_basic", root=str(tmp_path), max_bytes=2048, chunk_seconds=60)
+
+        for index in range(20):
+            clock.now += 1
+            recorder.record_output(f"{index}:" + "".join(chr(0x3041 + (index * 7 + i) % 80) for i in range(400)))
+            await recorder.flush()
+        await recorder.close()
+
+        info = await get_recording_info("session_basic", root=str(tmp_path))
+        directory = recording_directory("session_basic", str(tmp_path))
+        assert info["bytes"] <= 2048
+        assert info["chunks"] < 20
+        assert len(list(directory.glob("chunk-*.jsonl.gz"))) == info["chunks"]
+        _, events = await replay("session_basic", str(tmp_path))
+        assert events[-1][2].startswith("19:")
+
+    @pytest.mark.asyncio
+    async def test_recording_continues_after_restart(self, tmp_path, clock):
+        """ターミナルを作り直しても同じ時間軸で追記されることのテスト"""
+        first = TerminalRecorder("session_basic", root=str(tmp_path))
+        first.record_output("before")
+        await first.close()
+
+        clock.now += 60
+        second = TerminalRecorder("session_basic", root=str(tmp_path))
+        second.record_output("after")
+        await second.close()
+
+        _, events = await replay("session_basic", str(tmp_path))
+        assert events == [[0.0, "o", "before"], [60.0, "o", "after"]]
+
+
+@pytest.mark.unit
+class TestTerminalRecordingIntegration:
+    """ターミナルの入出力が記録されることのテスト"""
+
+    @pytest.mark.asyncio
+    async def test_terminal_io_is_recorded(self, tmp_path):
+        """シェルの入出力が記録されることのテスト"""
+        with patch("app.terminal_managers.TERMINAL_RECORDING", True), \
+                patch("app.terminal_recording.TERMINAL_RECORDING_DIR", str(tmp_path / "recordings")):
+            terminal = BasicTerminalManager("recorded_basic", str(tmp_path))
+            await terminal.start_terminal()
+            subscription = terminal.subscribe()
+
+            await terminal.write_input("echo recorded-$((20 + 1))\n")
+            output = ""
+            while "recorded-21\r\n" not in output:
+                output += await asyncio.wait_for(subscription.get(), 10.0)
+            await terminal.cleanup()
+
+            _, events = await replay("recorded_basic", None)
+
+        inputs = "".join(data for _, kind, data in events if kind == RecordingEvent.INPUT)
+        outputs = "".join(data for _, kind, data in events if kind == RecordingEvent.OUTPUT)
+        assert "echo recorded-$((20 + 1))" in inputs
+        assert "recorded-21" in outputs
+        assert all(a[0] <= b[0] for a, b in zip(events, events[1:]))
@@ -3,11 +3,12 @@ WebSocket機能のテスト
 """
 
 import pytest
+import asyncio
 import json
 from fastapi.testclient import TestClient
 from unittest.mock import Mock, patch, AsyncMock
 
-from app.websocket_manager import ConnectionManager, MessageType, WebSocketMessage
+from app.websocket_manager import ConnectionManager, MessageType, OutboundFrame, OverflowPolicy, WebSocketMessage
 from app.main import app
 from app.models import User, Session
 
@@ -18,7 +19,7 @@ class TestConnectionManager:
         """ConnectionManagerの初期化テスト"""
         manager = ConnectionManager()
         assert len(manager.active_connections) == 0
-        assert len(manager.user_sessions) == 0
+        assert len(manager.user_connections) == 0
         assert len(manager.session_connections) == 0
         
     @pytest.mark.asyncio
@@ -31,18 +32,72 @@ class TestConnectionManager:
         connection_id = await manager.connect(mock_websocket, "user1", "session1")
         
         assert connection_id in manager.active_connections
-        assert manager.user_sessions["user1"] == "session1"
-        assert "user1" in manager.session_connections["session1"]
+        assert manager.get_connection(connection_id).websocket is mock_websocket
+        assert manager.get_user_sessions("user1") == {"session1"}
+        assert manager.get_session_users("session1") == ["user1"]
         assert manager.get_connection_count() == 1
         
         # 切断テスト
         manager.disconnect(connection_id, "user1", "session1")
         
         assert connection_id not in manager.active_connections
-        assert "user1" not in manager.user_sessions
+        assert manager.get_user_sessions("user1") == set()
+        assert len(manager.user_connections) == 0
         assert len(manager.session_connections) == 0
         assert manager.get_connection_count() == 0
         
+        # 二重切断は無視される
+        manager.disconnect(connection_id)
+        
+    @pytest.mark.asyncio
+    async def test_multiple_tabs_same_user(self):
+        """同一ユーザーの複数タブ・複数セッション接続テスト"""
+        manager = ConnectionManager()
+        tab1 = AsyncMock()
+        tab2 = AsyncMock()
+        other_session = AsyncMock()
+        
+        connection_id1 = await manager.connect(tab1, "user1", "session1")
+        await manager.connect(tab2, "user1", "session1")
+        await manager.connect(other_session, "user1", "session2")
+        
+        assert connection_id1 in manager.active_connections
+        assert len(manager.user_connections["user1"]) == 3
+        assert len(manager.session_connections["session1"]) == 2
+        assert manager.get_session_users("session1") == ["user1"]
+        assert manager.get_user_sessions("user1") == {"session1", "session2"}
+        
+        # 1タブを閉じても他の接続は残る
+        manager.disconnect(connection_id1)
+        assert manager.get_user_sessions("user1") == {"session1", "session2"}
+        assert manager.get_session_users("session1") == ["user1"]
+        
+        # セッションへのブロードキャストは他セッションの接続に届かない
+        message = {"type": "test", "data": "session1 only"}
+        await manager.broadcast_to_session(message, "session1")
+        await manager.drain()
+        
+        tab1.send_text.assert_not_called()
+        tab2.send_text.assert_called_once_with(json.dumps(message, ensure_ascii=False))
+        other_session.send_text.assert_not_called()
+        
+    @pytest.mark.asyncio
+    async def test_send_to_user_does_not_match_prefix(self):
+        """user_idの前方一致で他ユーザーに送信されないことのテスト"""
+        manager = ConnectionManager()
+        user1 = AsyncMock()
+        user10 = AsyncMock()
+        
+        await manager.connect(user1, "1", "session1")
+        await manager.connect(user10, "10", "session1")
+        
+        message = {"type": "test", "data": "only user 1"}
+        await manager.send_to_user(message, "1")
+        await manager.drain()
+        
+        user1.send_text.assert_called_once_with(json.dumps(message, ensure_ascii=False))
+        user10.send_text.assert_not_called()
+        
     @pytest.mark.asyncio
     async def test_send_personal_message(self):
         """Personalメッセージ送信テスト"""
@@ -53,6 +108,7 @@ class TestConnectionManager:
         message = {"type": "test", "data": "hello"}
         
         await manager.send_personal_message(message, connection_id)
+        await manager.drain()
         
         mock_websocket.send_text.assert_called_once_with(json.dumps(message, ensure_ascii=False))
         
@@ -69,26 +125,190 @@ class TestConnectionManager:
         
         message = {"type": "test", "data": "broadcast"}
         await manager.broadcast_to_session(message, "session1")
+        await manager.drain()
         
         expected_call = json.dumps(message, ensure_ascii=False)
         mock_websocket1.send_text.assert_called_with(expected_call)
         mock_websocket2.send_text.assert_called_with(expected_call)
         
-    def test_get_active_sessions(self):
+    @pytest.mark.asyncio
+    async def test_broadcast_encodes_once(self):
+        """ブロードキャスト時のエンコードが1回だけであることのテスト"""
+        manager = ConnectionManager()
+        for i in range(5):
+            await manager.connect(AsyncMock(), f"user{i}", "session1")
+        
+        with patch("app.websocket_protocol.json.dumps", wraps=json.dumps) as mock_dumps:
+            await manager.broadcast_to_session({"type": "test", "data": "once"}, "session1")
+            await manager.drain()
+        
+        assert mock_dumps.call_count == 1
+        
+    @pytest.mark.asyncio
+    async def test_slow_connection_is_evicted(self):
+        """遅い接続がタイムアウトで切断され、他の接続を妨げないことのテスト"""
+        manager = ConnectionManager(send_timeout=0.05)
+        fast = AsyncMock()
+        slow = AsyncMock()
+        
+        async def stall(frame):
+            await asyncio.sleep(10)
+        slow.send_text.side_effect = stall
+        
+        await manager.connect(fast, "user1", "session1")
+        slow_id = await manager.connect(slow, "user2", "session1")
+        
+        await asyncio.wait_for(
+            manager.broadcast_to_session({"type": "test"}, "session1"), timeout=1
+        )
+        await asyncio.wait_for(manager.drain(), timeout=1)
+        
+        fast.send_text.assert_called_once()
+        slow.close.assert_called_once()
+        assert slow_id not in manager.active_connections
+        assert manager.get_session_users("session1") == ["user1"]
+        
+    @pytest.mark.asyncio
+    async def test_failed_send_is_evicted(self):
+        """送信エラーの接続が切断されることのテスト"""
+        manager = ConnectionManager()
+        broken = AsyncMock()
+        broken.send_text.side_effect = RuntimeError("closed")
+        connection_id = await manager.connect(broken, "user1", "session1")
+        
+        await manager.send_personal_message({"type": "test"}, connection_id)
+        await manager.drain()
+        
+        assert manager.get_connection_count() == 0
+        
+    @pytest.mark.asyncio
+    async def test_producer_does_not_wait_for_socket(self):
+        """送信がソケットの書き込み完了を待たないことのテスト"""
+        manager = ConnectionManager()
+        stalled = AsyncMock()
+        release = asyncio.Event()
+        
+        async def stall(frame):
+            await release.wait()
+        stalled.send_text.side_effect = stall
+        
+        connection_id = await manager.connect(stalled, "user1", "session1")
+        for i in range(10):
+            await asyncio.wait_for(
+                manager.send_personal_message({"type": "test", "data": i}, connection_id), timeout=0.1
+            )
+        
+        assert manager.get_queue_stats()["total_depth"] >= 9
+        release.set()
+        await manager.drain()
+        assert manager.get_connection(connection_id).sent_count == 10
+        
+    @pytest.mark.asyncio
+    async def test_overflow_drop_oldest(self):
+        """drop_oldest方針で古いフレームが破棄されることのテスト"""
+        manager = ConnectionManager(queue_size=3, overflow_policy=OverflowPolicy.DROP_OLDEST)
+        connection_id = await manager.connect(AsyncMock(), "user1", "session1")
+        connection = manager.get_connection(connection_id)
+        
+        for i in range(5):
+            connection.enqueue(OutboundFrame({"type": "test", "data": i}))
+        
+        assert [frame.message["data"] for frame in connection.queue] == [2, 3, 4]
+        assert connection.get_stats()["dropped"] == 2
+        assert connection.get_stats()["max_depth"] == 3
+        
+    @pytest.mark.asyncio
+    async def test_overflow_coalesce_streaming_chunks(self):
+        """coalesce方針でストリーミングチャンクが結合されることのテスト"""
+        manager = ConnectionManager(queue_size=2, overflow_policy=OverflowPolicy.COALESCE)
+        connection_id = await manager.connect(AsyncMock(), "user1", "session1")
+        connection = manager.get_connection(connection_id)
+        
+        connection.enqueue(OutboundFrame({"type": "system", "data": {"message": "hello"}}))
+        for chunk in ["a", "b", "c", "d"]:
+            connection.enqueue(OutboundFrame({
+                "type": "chat",
+                "session_id": "session1",
+                "data": {"message_chunk": chunk, "streaming": True}
+            }))
+        
+        assert len(connection.queue) == 2
+        assert connection.queue[0].message["data"]["message"] == "hello"
+        assert connection.queue[1].message["data"]["message_chunk"] == "abcd"
+        assert json.loads(connection.queue[1].text)["data"]["message_chunk"] == "abcd"
+        assert connection.get_stats()["coalesced"] == 3
+        assert connection.get_stats()["dropped"] == 0
+        
+    @pytest.mark.asyncio
+    async def test_overflow_coalesce_falls_back_to_drop(self):
+        """結合できないフレームのみの場合は最古を破棄することのテスト"""
+        manager = ConnectionManager(queue_size=2, overflow_policy=OverflowPolicy.COALESCE)
+        connection_id = await manager.connect(AsyncMock(), "user1", "session1")
+        connection = manager.get_connection(connection_id)
+        
+        for i in range(3):
+            connection.enqueue(OutboundFrame({"type": "test", "data": i}))
+        
+        assert [frame.message["data"] for frame in connection.queue] == [1, 2]
+        assert connection.get_stats()["dropped"] == 1
+        
+    @pytest.mark.asyncio
+    async def test_overflow_disconnect(self):
+        """disconnect方針でキューあふれ時に切断されることのテスト"""
+        manager = ConnectionManager(queue_size=1, overflow_policy=OverflowPolicy.DISCONNECT)
+        websocket = AsyncMock()
+        release = asyncio.Event()
+        
+        async def stall(frame):
+            await release.wait()
+        websocket.send_text.side_effect = stall
+        
+        connection_id = await manager.connect(websocket, "user1", "session1")
+        await manager.send_personal_message({"type": "test", "data": 1}, connection_id)
+        await asyncio.sleep(0)  # ライターが1件目を取り出して送信中になる
+        await manager.send_personal_message({"type": "test", "data": 2}, connection_id)
+        await manager.send_personal_message({"type": "test", "data": 3}, connection_id)
+        await asyncio.sleep(0)
+        
+        assert connection_id not in manager.active_connections
+        websocket.close.assert_called_once()
+        
+    @pytest.mark.asyncio
+    async def test_queue_stats(self):
+        """送信キュー統計のテスト"""
+        manager = ConnectionManager(queue_size=8)
+        await manager.connect(AsyncMock(), "user1", "session1")
+        await manager.broadcast_to_session({"type": "test"}, "session1")
+        
+        stats = manager.get_queue_stats()
+        assert stats["queue_size"] == 8
+        assert "connections" not in stats
+        
+        await manager.drain()
+        detailed = manager.get_queue_stats(detailed=True)
+        assert detailed["total_depth"] == 0
+        assert detailed["connections"][0]["sent"] == 1
+        assert detailed["connections"][0]["user_id"] == "user1"
+        
+    @pytest.mark.asyncio
+    async def test_get_active_sessions(self):
         """アクティブセッション取得テスト"""
         manager = ConnectionManager()
-        manager.session_connections["session1"] = ["user1"]
-        manager.session_connections["session2"] = ["user2"]
+        await manager.connect(AsyncMock(), "user1", "session1")
+        await manager.connect(AsyncMock(), "user2", "session2")
         
         active_sessions = manager.get_active_sessions()
         assert "session1" in active_sessions
         assert "session2" in active_sessions
         assert len(active_sessions) == 2
         
-    def test_get_session_users(self):
+    @pytest.mark.asyncio
+    async def test_get_session_users(self):
         """セッションユーザー取得テスト"""
         manager = ConnectionManager()
-        manager.session_connections["session1"] = ["user1", "user2"]
+        await manager.connect(AsyncMock(), "user1", "session1")
+        await manager.connect(AsyncMock(), "user2", "session1")
+        await manager.connect(AsyncMock(), "user2", "session1")
         
         users = manager.get_session_users("session1")
         assert "user1" in users
@@ -99,6 +319,161 @@ class TestConnectionManager:
         empty_users = manager.get_session_users("nonexistent")
         assert len(empty_users) == 0
 
+    @pytest.mark.asyncio
+    async def test_send_to_session_publishes_event(self):
+        """send_to_sessionがイベントバス経由で配信されることのテスト"""
+        manager = ConnectionManager()
+        mock_websocket = AsyncMock()
+        await manager.connect(mock_websocket, "user1", "session1")
+        
+        await manager.send_to_session("session1", json.dumps({"type": "file_updated", "file_path": "a.py"}))
+        await manager.drain()
+        
+        sent = json.loads(mock_websocket.send_text.call_args.args[0])
+        assert sent["type"] == "file_updated"
+        assert sent["seq"] == 1
+        assert sent["session_id"] == "session1"
+        
+    @pytest.mark.asyncio
+    async def test_replay_events_on_reconnect(self):
+        """再接続時のセッションイベント再送テスト"""
+        manager = ConnectionManager()
+        for i in range(3):
+            await manager.send_to_session("session1", {"type": "file_updated", "n": i})
+        
+        mock_websocket = AsyncMock()
+        connection_id = await manager.connect(mock_websocket, "user1", "session1")
+        complete = await manager.replay_events(connection_id, 1)
+        await manager.drain()
+        
+        assert complete is True
+        seqs = [json.loads(call.args[0])["seq"] for call in mock_websocket.send_text.call_args_list]
+        assert seqs == [2, 3]
+        assert await manager.replay_events("unknown", 0) is False
+        
+    @pytest.mark.asyncio
+    async def test_resume_chat_stream_mid_answer(self):
+        """応答途中で再接続したクライアントが欠落分と続きを受信することのテスト"""
+        manager = ConnectionManager()
+        chunk = lambda text: {"type": "chat", "data": {"message_chunk": text, "stream_id": "s1", "streaming": True}}
+        
+        first = AsyncMock()
+        await manager.connect(first, "user1", "session1")
+        await manager.broadcast_chat(chunk("a"), "session1")
+        await manager.drain()
+        last_seq = json.loads(first.send_text.call_args.args[0])["seq"]
+        
+        # 切断中に配信されたチャンク
+        manager.disconnect(next(iter(manager.active_connections)))
+        await manager.broadcast_chat(chunk("b"), "session1")
+        await manager.broadcast_chat(chunk("c"), "session1")
+        
+        second = AsyncMock()
+        connection_id = await manager.connect(second, "user1", "session1")
+        complete = await manager.replay_stream(connection_id, last_seq)
+        await manager.broadcast_chat(chunk("d"), "session1")
+        await manager.drain()
+        
+        assert complete is True
+        received = [json.loads(call.args[0]) for call in second.send_text.call_args_list]
+        assert [m["data"]["message_chunk"] for m in received] == ["b", "c", "d"]
+        assert [m["seq"] for m in received] == [2, 3, 4]
+        # セッションイベントとは独立した連番
+        assert manager.event_bus.get_last_seq("session1") == 0
+
+class TestHeartbeat:
+    """ハートビートとスイーパーのテスト"""
+    
+    @pytest.mark.asyncio
+    async def test_ping_sent_to_silent_connection(self):
+        """無通信の接続にpingが送られることのテスト"""
+        manager = ConnectionManager(heartbeat_interval=20, heartbeat_timeout=60)
+        mock_websocket = AsyncMock()
+        connection_id = await manager.connect(mock_websocket, "user1", "session1")
+        connection = manager.get_connection(connection_id)
+        
+        # 受信直後はpingを送らない
+        assert manager.sweep(now=connection.last_seen + 5) == 0
+        assert manager.sweep(now=connection.last_seen + 25) == 0
+        await manager.drain()
+        
+        sent = json.loads(mock_websocket.send_text.call_args.args[0])
+        assert sent["type"] == MessageType.PING
+        assert manager.get_heartbeat_stats()["pings_sent"] == 1
+        
+    @pytest.mark.asyncio
+    async def test_unresponsive_connection_is_reaped(self):
+        """応答のない接続が回収されることのテスト"""
+        manager = ConnectionManager(heartbeat_interval=20, heartbeat_timeout=60)
+        alive, dead = AsyncMock(), AsyncMock()
+        alive_id = await manager.connect(alive, "user1", "session1")
+        dead_id = await manager.connect(dead, "user2", "session1")
+        
+        now = manager.get_connection(dead_id).last_seen + 61
+        manager.get_connection(alive_id).last_seen = now - 1
+        
+        assert manager.sweep(now=now) == 1
+        await asyncio.sleep(0)
+        
+        assert manager.get_connection(dead_id) is None
+        assert manager.get_session_users("session1") == ["user1"]
+        dead.close.assert_called_once_with(code=1001, reason="応答がありません")
+        stats = manager.get_heartbeat_stats()
+        assert stats["reaped"] == 1
+        assert stats["reaped_by_reason"] == {"unresponsive": 1}
+        
+    @pytest.mark.asyncio
+    async def test_pong_keeps_connection_but_not_activity(self):
+        """pongで生存は確認されるがアイドル判定は進むことのテスト"""
+        manager = ConnectionManager(heartbeat_interval=20, heartbeat_timeout=60, idle_timeout=300)
+        mock_websocket = AsyncMock()
+        connection_id = await manager.connect(mock_websocket, "user1", "session1")
+        connection = manager.get_connection(connection_id)
+        start = connection.last_activity
+        
+        manager.touch(connection_id, activity=False)
+        assert connection.last_activity == start
+        
+        # pongは届き続けているが操作はない
+        connection.last_seen = start + 290
+        assert manager.sweep(now=start + 295) == 0
+        
+        connection.last_seen = start + 300
+        assert manager.sweep(now=start + 301) == 1
+        await asyncio.sleep(0)
+        
+        assert manager.get_connection_count() == 0
+        assert manager.get_heartbeat_stats()["reaped_by_reason"] == {"idle": 1}
+        
+    @pytest.mark.asyncio
+    async def test_closed_socket_is_removed(self):
+        """閉じたソケットが索引から取り除かれることのテスト"""
+        from starlette.websockets import WebSocketState
+        
+        manager = ConnectionManager()
+        mock_websocket = AsyncMock()
+        mock_websocket.client_state = WebSocketState.DISCONNECTED
+        await manager.connect(mock_websocket, "user1", "session1")
+        
+        assert manager.sweep() == 1
+        assert manager.get_active_sessions() == []
+        mock_websocket.close.assert_not_called()
+        
+    @pytest.mark.asyncio
+    async def test_sweeper_lifecycle(self):
+        """start/stopでスイーパーが起動・停止することのテスト"""
+        manager = ConnectionManager(heartbeat_interval=0.01, heartbeat_timeout=0.02)
+        mock_websocket = AsyncMock()
+        await manager.connect(mock_websocket, "user1", "session1")
+        
+        await manager.start()
+        assert manager.get_heartbeat_stats()["running"] is True
+        await asyncio.sleep(0.1)
+        await manager.stop()
+        
+        assert manager.get_connection_count() == 0
+        assert manager.get_heartbeat_stats()["running"] is False
+
 class TestWebSocketMessage:
     """WebSocketMessageのテスト"""
     
@@ -159,6 +534,7 @@ class TestWebSocketAPI:
         data = response.json()
         assert "active_connections" in data
         assert "active_sessions" in data
+        assert "queues" in data
         assert "status" in data
         assert data["status"] == "running"
 
@@ -173,3 +549,5 @@ class TestMessageType:
         assert MessageType.SYSTEM == "system"
         assert MessageType.STATUS == "status"
         assert MessageType.ERROR == "error"
+        assert MessageType.PING == "ping"
+        assert MessageType.PONG == "pong"
@@ -0,0 +1,261 @@
+"""
+WebSocketバックプレーンのテスト
+"""
+
+import pytest
+import asyncio
+import json
+import socket
+from unittest.mock import AsyncMock, MagicMock, Mock
+
+from app.websocket_backplane import (
+    InProcessBackplane, PostgresBackplane, create_backplane
+)
+from app.websocket_manager import ConnectionManager
+
+
+@pytest.mark.unit
+class TestInProcessBackplane:
+    """InProcessBackplaneのテスト"""
+
+    def test_single_worker_delivers_to_self(self):
+        """単一ワーカーで自身に配信されることのテスト"""
+        backplane = InProcessBackplane()
+        handler = Mock()
+        backplane.set_handler(handler)
+
+        backplane.publish({"scope": "all", "message": {"type": "test"}})
+
+        handler.assert_called_once_with({"scope": "all", "message": {"type": "test"}})
+
+    @pytest.mark.asyncio
+    async def test_shared_hub_delivers_to_all_workers(self):
+        """hubを共有する全ワーカーに一度ずつ配信されることのテスト"""
+        hub = []
+        worker_a, worker_b = InProcessBackplane(hub), InProcessBackplane(hub)
+        handler_a, handler_b = Mock(), Mock()
+        worker_a.set_handler(handler_a)
+        worker_b.set_handler(handler_b)
+
+        worker_a.publish({"scope": "all"})
+
+        handler_a.assert_called_once()
+        handler_b.assert_called_once()
+
+        await worker_b.stop()
+        worker_a.publish({"scope": "all"})
+        assert handler_b.call_count == 1
+
+    def test_handler_error_is_isolated(self):
+        """ハンドラーのエラーが発行元に伝播しないことのテスト"""
+        backplane = InProcessBackplane()
+        backplane.set_handler(Mock(side_effect=RuntimeError("boom")))
+
+        backplane.publish({"scope": "all"})
+
+
+@pytest.mark.unit
+class TestPostgresBackplane:
+    """PostgresBackplaneのテスト（DB接続なし）"""
+
+    def test_invalid_channel(self):
+        """無効なチャンネル名のテスト"""
+        with pytest.raises(ValueError):
+            PostgresBackplane("postgresql://localhost/db", channel="bad; DROP")
+
+    def test_large_message_roundtrip(self):
+        """分割された大きなメッセージが他ワーカーで組み立てられることのテスト"""
+        sender = PostgresBackplane("postgresql://localhost/db")
+        receiver = PostgresBackplane("postgresql://localhost/db")
+        handler = Mock()
+        receiver.set_handler(handler)
+
+        message = {"scope": "session", "target": "s1", "message": {"text": "日本語" * 5000}}
+        payloads = sender._split_payload(message)
+
+        assert len(payloads) > 1
+        assert all(len(payload.encode("utf-8")) < 8000 for payload in payloads)
+
+        # 順不同で届いても組み立てられる
+        for payload in reversed(payloads):
+            receiver._on_payload(payload)
+
+        handler.assert_called_once_with(message)
+        assert receiver._partials == {}
+
+    def test_own_notifications_are_ignored(self):
+        """自ワーカーの通知が二重配信されないことのテスト"""
+        backplane = PostgresBackplane("postgresql://localhost/db")
+        handler = Mock()
+        backplane.set_handler(handler)
+
+        for payload in backplane._split_payload({"scope": "all"}):
+            backplane._on_payload(payload)
+
+        handler.assert_not_called()
+
+    def test_malformed_payload_is_ignored(self):
+        """不正な通知を無視することのテスト"""
+        backplane = PostgresBackplane("postgresql://localhost/db")
+        handler = Mock()
+        backplane.set_handler(handler)
+
+        backplane._on_payload("garbage")
+        backplane._on_payload("other|id|0|1|{not json")
+
+        handler.assert_not_called()
+
+    def test_publish_before_start_delivers_locally(self):
+        """開始前でもローカルには配信されることのテスト"""
+        backplane = PostgresBackplane("postgresql://localhost/db")
+        handler = Mock()
+        backplane.set_handler(handler)
+
+        backplane.publish({"scope": "all"})
+
+        handler.assert_called_once()
+
+    def test_notify_uses_parameters(self):
+        """NOTIFYがパラメータ化されたクエリで発行されることのテスト"""
+        backplane = PostgresBackplane("postgresql://localhost/db")
+        cursor = MagicMock()
+        backplane._publish_conn = MagicMock()
+        backplane._publish_conn.cursor.return_value.__enter__.return_value = cursor
+
+        backplane._notify(["a", "b"])
+
+        cursor.execute.assert_any_call("SELECT pg_notify(%s, %s)", ("ws_backplane", "a"))
+        assert cursor.execute.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_listener_reconnects_with_backoff(self):
+        """LISTEN用の接続が切れると間隔を延ばしながら再接続することのテスト"""
+        backplane = PostgresBackplane("postgresql://localhost/db")
+        backplane.RECONNECT_MIN_DELAY = 0.01
+        handler = Mock()
+        backplane.set_handler(handler)
+        loop = asyncio.get_running_loop()
+
+        broken, peer = socket.socketpair()
+        backplane._listen_conn = MagicMock()
+        backplane._listen_conn.fileno.return_value = broken.fileno()
+        backplane._listen_conn.poll.side_effect = RuntimeError("server closed the connection")
+
+        reader, writer = socket.socketpair()
+        restored = MagicMock()
+        restored.fileno.return_value = reader.fileno()
+        restored.notifies = []
+        attempts = []
+
+        def open_listener():
+            attempts.append(loop.time())
+            if len(attempts) < 3:
+                raise RuntimeError("connection refused")
+            return restored
+
+        backplane._open_listener = open_listener
+        try:
+            backplane._on_readable()
+            assert backplane._listen_conn is None
+            await asyncio.wait_for(backplane._reconnect_task, 1.0)
+
+            assert len(attempts) == 3
+            assert attempts[2] - attempts[1] > attempts[1] - attempts[0]
+            assert backplane._listen_conn is restored
+            assert backplane._reconnect_task is None
+
+            # 再接続後の通知を受け取れる
+            other = PostgresBackplane("postgresql://localhost/db")
+            restored.notifies = [Mock(payload=payload) for payload in other._split_payload({"scope": "all"})]
+            writer.send(b"x")
+            for _ in range(100):
+                if handler.called:
+                    break
+                await asyncio.sleep(0.01)
+            handler.assert_called_once_with({"scope": "all"})
+        finally:
+            await backplane.stop()
+            for sock in (broken, peer, reader, writer):
+                sock.close()
+
+    def test_create_backplane(self):
+        """設定からのバックプレーン作成テスト"""
+        assert isinstance(create_backplane(""), InProcessBackplane)
+        assert isinstance(create_backplane("postgresql://localhost/db"), PostgresBackplane)
+
+
+@pytest.mark.unit
+class TestMultiWorkerConnectionManager:
+    """複数ワーカー構成でのConnectionManagerのテスト"""
+
+    @pytest.mark.asyncio
+    async def test_broadcast_reaches_other_worker(self):
+        """他ワーカーの接続にブロードキャストが届くことのテスト"""
+        hub = []
+        worker_a = ConnectionManager(backplane=InProcessBackplane(hub))
+        worker_b = ConnectionManager(backplane=InProcessBackplane(hub))
+        viewer_a, viewer_b = AsyncMock(), AsyncMock()
+        await worker_a.connect(viewer_a, "user1", "session1")
+        await worker_b.connect(viewer_b, "user2", "session1")
+
+        message = {"type": "chat", "data": {"message": "hello"}}
+        await worker_a.broadcast_to_session(message, "session1")
+        await worker_a.drain()
+        await worker_b.drain()
+
+        expected = json.dumps(message, ensure_ascii=False)
+        viewer_a.send_text.assert_called_once_with(expected)
+        viewer_b.send_text.assert_called_once_with(expected)
+
+    @pytest.mark.asyncio
+    async def test_user_and_all_scopes(self):
+        """ユーザー宛・全体宛が他ワーカーに届くことのテスト"""
+        hub = []
+        worker_a = ConnectionManager(backplane=InProcessBackplane(hub))
+        worker_b = ConnectionManager(backplane=InProcessBackplane(hub))
+        websocket = AsyncMock()
+        await worker_b.connect(websocket, "user1", "session1")
+
+        await worker_a.send_to_user({"type": "user"}, "user1")
+        await worker_a.broadcast_to_all({"type": "all"})
+        await worker_b.drain()
+
+        types = [json.loads(call.args[0])["type"] for call in websocket.send_text.call_args_list]
+        assert types == ["user", "all"]
+
+    @pytest.mark.asyncio
+    async def test_session_events_sequenced_on_every_worker(self):
+        """セッションイベントが各ワーカーで記録されることのテスト"""
+        hub = []
+        worker_a = ConnectionManager(backplane=InProcessBackplane(hub))
+        worker_b = ConnectionManager(backplane=InProcessBackplane(hub))
+        websocket = AsyncMock()
+        await worker_b.connect(websocket, "user1", "session1")
+
+        await worker_a.send_to_session("session1", {"type": "file_updated", "file_path": "a.py"})
+        await worker_b.drain()
+
+        sent = json.loads(websocket.send_text.call_args.args[0])
+        assert sent["seq"] == 1
+        assert worker_a.event_bus.get_last_seq("session1") == 1
+        assert worker_b.event_bus.get_last_seq("session1") == 1
+
+    @pytest.mark.asyncio
+    async def test_session_event_seq_assigned_by_publisher(self):
+        """途中から参加したワーカーでも発行元と同じ連番で記録・リプレイされることのテスト"""
+        hub = []
+        worker_a = ConnectionManager(backplane=InProcessBackplane(hub))
+        for i in range(2):
+            await worker_a.send_to_session("session1", {"type": "file_updated", "file_path": f"{i}.py"})
+
+        worker_b = ConnectionManager(backplane=InProcessBackplane(hub))
+        await worker_a.send_to_session("session1", {"type": "file_updated", "file_path": "2.py"})
+        await worker_b.send_to_session("session1", {"type": "file_updated", "file_path": "3.py"})
+
+        for worker in (worker_a, worker_b):
+            assert worker.event_bus.get_last_seq("session1") == 4
+        events, complete = worker_b.event_bus.replay("session1", 2)
+        assert [(event["seq"], event["file_path"]) for event in events] == [(3, "2.py"), (4, "3.py")]
+        assert complete is True
+        events, _ = worker_a.event_bus.replay("session1", 2)
+        assert [(event["seq"], event["file_path"]) for event in events] == [(3, "2.py"), (4, "3.py")]
@@ -0,0 +1,170 @@
+"""
+WebSocketプロトコルネゴシエーションのテスト
+"""
+
+import pytest
+import json
+from unittest.mock import AsyncMock, MagicMock
+
+import msgpack
+from fastapi import WebSocketDisconnect
+
+from app.websocket_manager import ConnectionManager, WebSocketMessage, MessageType
+from app.websocket_protocol import (
+    DEFAULT_CODEC, CompactJsonCodec, JsonCodec, MsgpackCodec, TerminalProtocol,
+    TerminalControl, compact_message, encode_terminal_control, expand_message, negotiate_codec,
+    negotiate_terminal_protocol, parse_terminal_control, receive_message
+)
+
+
+def make_websocket(subprotocols=None):
+    websocket = MagicMock()
+    websocket.scope = {"subprotocols": subprotocols or []}
+    return websocket
+
+
+def stream_chunk():
+    return WebSocketMessage(
+        MessageType.CHAT,
+        {
+            "message_chunk": "こんにちは",
+            "sender": "claude",
+            "model": "claude-code",
+            "streaming": True,
+            "timestamp": "2024-01-01T00:00:00"
+        },
+        session_id="session-123"
+    ).to_dict()
+
+
+@pytest.mark.unit
+class TestCompactMessage:
+    """短縮形式への変換のテスト"""
+
+    def test_compact_and_expand(self):
+        """短縮と復元のテスト"""
+        message = stream_chunk()
+
+        compact = compact_message(message)
+
+        assert compact["t"] == "chat"
+        assert compact["d"]["c"] == "こんにちは"
+        assert "s" not in compact  # session_idは接続から自明
+        assert "u" not in compact  # Noneは省略
+
+        expanded = expand_message(compact)
+        assert expanded["type"] == "chat"
+        assert expanded["data"]["message_chunk"] == "こんにちは"
+        assert expanded["data"]["sender"] == "claude"
+
+    def test_encoded_size_is_smaller(self):
+        """短縮形式のフレームが小さくなることのテスト"""
+        message = stream_chunk()
+
+        plain = DEFAULT_CODEC.encode(message).encode("utf-8")
+        compact = CompactJsonCodec().encode(message).encode("utf-8")
+        binary = MsgpackCodec().encode(message)
+
+        assert len(compact) < len(plain)
+        assert len(binary) < len(compact)
+
+    def test_codec_roundtrip(self):
+        """各方式のエンコード・デコードの往復テスト"""
+        message = {"type": "chat", "data": {"message": "hello", "stream": True}}
+
+        for codec in [DEFAULT_CODEC, JsonCodec(), CompactJsonCodec(), MsgpackCodec()]:
+            assert codec.decode(codec.encode(message)) == message
+
+        # MessagePack接続でもテキストフレームのJSONを受け付ける
+        assert MsgpackCodec().decode(json.dumps({"t": "chat"})) == {"type": "chat"}
+
+
+@pytest.mark.unit
+class TestNegotiation:
+    """ネゴシエーションのテスト"""
+
+    def test_default_is_plain_json(self):
+        """提示なしは従来のJSONであることのテスト"""
+        codec = negotiate_codec(make_websocket())
+
+        assert codec is DEFAULT_CODEC
+        assert codec.subprotocol is None
+
+    def test_server_preference(self):
+        """サーバーの優先順で選択されることのテスト"""
+        codec = negotiate_codec(make_websocket(["json.compact.v1", "msgpack.v1"]))
+        assert codec.name == "msgpack.v1"
+
+        codec = negotiate_codec(make_websocket(["unknown", "json.compact.v1"]))
+        assert codec.name == "json.compact.v1"
+
+    def test_terminal_protocol(self):
+        """ターミナルの送信方式選択テスト"""
+        assert negotiate_terminal_protocol(make_websocket()) == TerminalProtocol.TEXT
+        assert negotiate_terminal_protocol(make_websocket(["terminal.binary.v1"])) == TerminalProtocol.BINARY
+
+    @pytest.mark.asyncio
+    async def test_receive_message(self):
+        """受信フレームのデコードテスト"""
+        websocket = make_websocket()
+        websocket.receive = AsyncMock(side_effect=[
+            {"type": "websocket.receive", "bytes": msgpack.packb({"t": "chat", "d": {"m": "hi"}})},
+            {"type": "websocket.receive", "text": "not json"},
+            {"type": "websocket.disconnect", "code": 1001},
+        ])
+        codec = MsgpackCodec()
+
+        message = await receive_message(websocket, codec)
+        assert message == {"type": "chat", "data": {"message": "hi"}}
+
+        with pytest.raises(ValueError):
+            await receive_message(websocket, codec)
+
+        with pytest.raises(WebSocketDisconnect):
+            await receive_message(websocket, codec)
+
+
+@pytest.mark.unit
+class TestTerminalControl:
+    """ターミナルの制御メッセージのテスト"""
+
+    def test_parse_control(self):
+        """制御メッセージと入力の区別のテスト"""
+        assert parse_terminal_control("ls -la\n") is None
+        assert parse_terminal_control('\x00{"type": "resize", "rows": 40, "cols": 120}') == {
+            "type": TerminalControl.RESIZE, "rows": 40, "cols": 120
+        }
+
+        with pytest.raises(ValueError):
+            parse_terminal_control("\x00not json")
+        with pytest.raises(ValueError):
+            parse_terminal_control('\x00{"rows": 40}')
+
+    def test_encode_control(self):
+        """サーバーからの制御メッセージのエンコードテスト"""
+        encoded = encode_terminal_control({"type": TerminalControl.ERROR, "message": "不正です"})
+
+        assert encoded.startswith("\x00")
+        assert parse_terminal_control(encoded)["message"] == "不正です"
+
+
+@pytest.mark.unit
+class TestProtocolFanout:
+    """方式の異なる接続へのブロードキャストのテスト"""
+
+    @pytest.mark.asyncio
+    async def test_mixed_protocol_broadcast(self):
+        """接続ごとの方式でフレームが送信されることのテスト"""
+        manager = ConnectionManager()
+        legacy, binary = AsyncMock(), AsyncMock()
+        await manager.connect(legacy, "user1", "session-123")
+        await manager.connect(binary, "user2", "session-123", codec=MsgpackCodec())
+
+        message = stream_chunk()
+        await manager.broadcast_to_session(message, "session-123")
+        await manager.drain()
+
+        legacy.send_text.assert_called_once_with(json.dumps(message, ensure_ascii=False))
+        binary.send_text.assert_not_called()
+        sent = binary.send_bytes.call_args.args[0]
+        assert msgpack.unpackb(sent)["d"]["c"] == "こんにちは"